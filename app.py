@@ -1,6 +1,10 @@
+import argparse
 import logging
+import os
 import sys
-from utils.iptv_recorder import IptvRecorder
+import time
+
+STARTED = time.monotonic()
 
 #TODO have a separate logger for iptv-recorder and vpn-manager, we need custom log levels
 logging.basicConfig(
@@ -10,16 +14,101 @@ logging.basicConfig(
     force=True          # override any existing config
 )
 logger = logging.getLogger(__name__)
-logger.info(f"starting...")
 
-iptv_recorder = IptvRecorder(logger)
 
-if __name__ == "__main__":
-    iptv_recorder.narrow_channels('uk')
-    iptv_recorder.streams_for_channels()
-    iptv_recorder.test_channels_with_streams('uk')
-    iptv_recorder.snooze_loop()
+def parse_args(argv=None):
+    # no subcommand keeps the container's old behaviour: the uk sweep, or a
+    # coordinator/worker sweep when SWEEP_ROLE is set, then snooze
+    parser = argparse.ArgumentParser(description="IPTV recorder")
+    parser.add_argument('--eager', action='store_true', help='load every catalog at startup, as before lazy loading')
+    commands = parser.add_subparsers(dest='command')
+
+    match = commands.add_parser('match', help='match streams to channels and write channels_with_streams.json')
+    match.add_argument('--country', help='only channels of this country code')
+
+    probe = commands.add_parser('probe', help='probe streams through a VPN tunnel of the country')
+    probe.add_argument('--country', default='uk')
+    probe.add_argument('--limit', type=int, help='probe at most this many streams')
+    probe.add_argument('--url', help='probe just this url')
+
+    epg = commands.add_parser('epg', help='look up guide listings')
+    epg.add_argument('--country', help='scan every stream of this country for guide listings')
+    epg.add_argument('--channel', help='listings for one channel id, needs --country and --provider')
+    epg.add_argument('--provider', action='append', default=[], help='guide provider, repeatable')
+
+    commands.add_parser('record', help='run the recording scheduler and capture engine')
+
+    sweep = commands.add_parser('sweep', help='sharded sweep of every country')
+    sweep.add_argument('role', choices=('coordinator', 'worker'))
+    sweep.add_argument('--sweep-id', help='defaults to SWEEP_ID or today (UTC)')
+
+    commands.add_parser('snooze', help='start up and idle')
+    args = parser.parse_args(argv)
+    if args.command == 'epg' and args.channel and not (args.country and args.provider):
+        parser.error('epg --channel needs --country and at least one --provider')
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    from utils.iptv_recorder import IptvRecorder
+    from utils.metrics import start_metrics_server
+
+    logger.info(f"starting {args.command or 'default'}...")
+    metrics_port = int(os.getenv("METRICS_PORT", "9100"))
+    # only the long running modes serve /metrics, a one off probe or match next to a running recorder
+    # would find the port taken
+    if metrics_port and args.command in (None, 'record', 'sweep'):
+        try:
+            server = start_metrics_server(metrics_port)
+            logger.info(f"serving /metrics on {server.server_address[0]}:{metrics_port}")
+        except OSError as e:
+            logger.warning(f"not serving /metrics, port {metrics_port} unavailable: {e}")
+
+    sweep_role = args.role if args.command == 'sweep' else None if args.command else os.getenv("SWEEP_ROLE")
+    if args.command in ('match', 'probe', 'epg'):
+        country = getattr(args, 'country', None)
+    else:
+        country = None if sweep_role else 'uk'
+    iptv_recorder = IptvRecorder(logger, country=country)
+    if args.eager:
+        iptv_recorder.load_channels_etc()
+    logger.info(f"ready after {time.monotonic() - STARTED:.2f}s")
+
+    if args.command == 'match':
+        iptv_recorder.streams_for_channels()
+        logger.info(f"[{len(iptv_recorder.channels_with_streams)}] channels with streams")
+    elif args.command == 'probe' and args.url:
+        with iptv_recorder.vpn_manager.session(args.country) as vpn_session:
+            logger.info(f"probe of {args.url} through {vpn_session.ovpn_file}: {vpn_session.probe(args.url)}")
+    elif args.command == 'probe':
+        iptv_recorder.streams_for_channels()
+        iptv_recorder.test_channels_with_streams(args.country, limit=args.limit)
+    elif args.command == 'epg' and args.channel:
+        programmes = iptv_recorder.get_epg_for_channel(args.channel, args.country, args.provider)
+        logger.info(f"[{len(programmes)}] programmes for {args.channel}")
+    elif args.command == 'epg':
+        valid_streams = iptv_recorder.scan_for_valid_streams(country_in=args.country)
+        for stream in valid_streams[:20]:
+            logger.info(f"{stream['id']} [{stream['epg_count']}] programmes, probed ok {stream['probed_ok']}: {stream['stream_url']}")
+    elif args.command == 'record':
+        iptv_recorder.main_loop()
+    elif args.command == 'snooze':
+        iptv_recorder.snooze_loop()
+    else:
+        iptv_recorder.streams_for_channels()
+        if sweep_role == 'coordinator':
+            iptv_recorder.coordinate_sweep(getattr(args, 'sweep_id', None))
+        elif sweep_role == 'worker':
+            iptv_recorder.run_sweep_worker(getattr(args, 'sweep_id', None))
+        else:
+            iptv_recorder.test_channels_with_streams('uk')
+        if not args.command:
+            iptv_recorder.snooze_loop()
 #    iptv_recorder.scan_for_valid_streams()
 #    iptv_recorder.scan_for_valid_streams(country_in='gb')
 #    iptv_recorder.scan_for_valid_streams(country_in='uk')
-#    iptv_recorder.main_loop()
+
+
+if __name__ == "__main__":
+    main()
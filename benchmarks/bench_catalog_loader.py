@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# Startup time and peak RSS of the streaming catalog loader vs plain json.load.
+# Each variant runs in its own process so ru_maxrss is not shared between them.
+#   python benchmarks/bench_catalog_loader.py --channels 40000 --streams 40000
+#   python benchmarks/bench_catalog_loader.py --channel-files /channel_files --country uk
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+JSON_LOAD = '''
+import json, os
+d = os.environ["CHANNEL_FILES_DIR"]
+country = os.environ.get("BENCH_COUNTRY")
+channels = json.load(open(os.path.join(d, "channels.json")))
+if country:
+    channels = [x for x in channels if x.get("country").upper() == country.upper()]
+streams = json.load(open(os.path.join(d, "streams.json")))
+countries = json.load(open(os.path.join(d, "countries.json")))
+lookup = json.load(open(os.path.join(d, "sd_iptv_channels_lookup.json")))
+'''
+
+STREAMING = '''
+import os
+from utils.catalog_loader import load_channels, load_countries, load_sd_iptv_channels_lookup, load_streams
+channels = load_channels(os.environ.get("BENCH_COUNTRY"))
+streams = load_streams()
+countries = load_countries()
+lookup = load_sd_iptv_channels_lookup()
+'''
+
+MEASURE = '''
+import resource, time
+start = time.perf_counter()
+exec(compile(BODY, "bench", "exec"))
+elapsed = time.perf_counter() - start
+print(elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+'''
+
+
+def write_synthetic_catalogs(directory, num_channels, num_streams, seed=0):
+    rng = random.Random(seed)
+    codes = ['UK', 'US', 'CA', 'FR', 'DE', 'IT', 'ES', 'NL', 'SE', 'PL']
+    channels = [{
+        'id': f"Channel{i}.{codes[i % len(codes)].lower()}",
+        'name': f"Channel {i}",
+        'alt_names': [f"Chan {i}", f"C{i}"],
+        'network': None,
+        'owners': [f"Owner {rng.randint(0, 500)}"],
+        'country': codes[i % len(codes)],
+        'categories': ['general', 'news'],
+        'is_nsfw': False,
+        'launched': '1990-01-01',
+        'closed': None,
+        'replaced_by': None,
+        'website': f"https://channel{i}.example.com",
+    } for i in range(num_channels)]
+    streams = [{
+        'channel': f"Channel{rng.randrange(num_channels)}.uk" if rng.random() < 0.5 else None,
+        'feed': None,
+        'title': f"Channel {rng.randrange(num_channels)} HD",
+        'url': f"https://cdn{rng.randint(0, 50)}.example.com/live/{i}/playlist.m3u8",
+        'referrer': None,
+        'user_agent': None,
+        'quality': rng.choice(['720p', '1080p', None]),
+        'label': None,
+    } for i in range(num_streams)]
+    countries = [{'name': f"Country {code}", 'code': code, 'languages': ['eng'], 'flag': ''} for code in codes]
+    lookup = [{'iptv_id': ch['id'], 'sd_id': str(i)} for i, ch in enumerate(channels[:num_channels // 4])]
+    for name, data in (('channels.json', channels), ('streams.json', streams),
+                       ('countries.json', countries), ('sd_iptv_channels_lookup.json', lookup)):
+        with open(os.path.join(directory, name), 'w') as outfile:
+            json.dump(data, outfile, indent=2)
+
+
+def run_variant(body, channel_files, country):
+    env = dict(os.environ, CHANNEL_FILES_DIR=channel_files, PYTHONPATH=REPO_DIR)
+    if country:
+        env['BENCH_COUNTRY'] = country
+    code = f"BODY = {body!r}\n{MEASURE}"
+    out = subprocess.run([sys.executable, '-c', code], env=env, cwd=REPO_DIR,
+                         capture_output=True, text=True, check=True).stdout.split()
+    return {'secs': round(float(out[0]), 3), 'peak_rss_mb': round(int(out[1]) / 1024, 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--channels', type=int, default=40000)
+    parser.add_argument('--streams', type=int, default=40000)
+    parser.add_argument('--channel-files')
+    parser.add_argument('--country', default='uk')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        channel_files = args.channel_files
+        if not channel_files:
+            write_synthetic_catalogs(tmpdir, args.channels, args.streams)
+            channel_files = tmpdir
+        results = {
+            'json_load': run_variant(JSON_LOAD, channel_files, args.country),
+            'streaming': run_variant(STREAMING, channel_files, args.country),
+        }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
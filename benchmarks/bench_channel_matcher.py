@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# Compares ChannelMatcher against the original full SequenceMatcher scan.
+#   python benchmarks/bench_channel_matcher.py --channels 5000 --streams 500
+#   python benchmarks/bench_channel_matcher.py --similar --channels 2400 --streams 3000 --threshold 0.75
+#   python benchmarks/bench_channel_matcher.py --channel-files /channel_files --streams 500
+# agreement is how many titles got the same channel from both, it should be all of them
+import argparse
+import json
+import os
+import random
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.channel_matcher import ChannelMatcher
+
+
+def synthetic_catalog(num_channels, num_streams, seed=0):
+    rng = random.Random(seed)
+    words = [''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(3, 8))) for _ in range(2000)]
+    name_to_id = {}
+    while len(name_to_id) < num_channels:
+        name = ' '.join(rng.choice(words) for _ in range(rng.randint(1, 3)))
+        name_to_id[name] = f"{name.replace(' ', '')}.{len(name_to_id)}"
+    names = list(name_to_id)
+    titles = []
+    for _ in range(num_streams):
+        title = rng.choice(names)
+        roll = rng.random()
+        if roll < 0.3:
+            title = title + rng.choice([' HD', ' SD', ' TV', ' +1'])
+        elif roll < 0.6 and len(title) > 4:
+            pos = rng.randrange(len(title))
+            title = title[:pos] + rng.choice(string.ascii_lowercase) + title[pos + 1:]
+        elif roll < 0.8:
+            title = ' '.join(rng.choice(words) for _ in range(2))
+        titles.append(title.title())
+    return name_to_id, titles
+
+
+def similar_catalog(num_channels, num_streams, seed=0):
+    # near duplicate names ('abc sports 2', 'abc sports 12', 'abd sports 2') where a
+    # shortlist of the closest few by trigrams is most likely to miss the best ratio
+    rng = random.Random(seed)
+    brands = [''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(2, 5))) for _ in range(60)]
+    kinds = ['sports', 'news', 'movies', 'kids', 'music', 'one', 'two', 'plus', 'world', 'max']
+    name_to_id = {}
+    while len(name_to_id) < num_channels:
+        name = f"{rng.choice(brands)} {rng.choice(kinds)}"
+        if rng.random() < 0.6:
+            name += f" {rng.randint(1, 12)}"
+        name_to_id.setdefault(name, f"{name.replace(' ', '')}.{len(name_to_id)}")
+    names = list(name_to_id)
+    titles = []
+    for _ in range(num_streams):
+        title = rng.choice(names)
+        roll = rng.random()
+        if roll < 0.4 and len(title) > 4:
+            pos = rng.randrange(len(title))
+            title = title[:pos] + rng.choice(string.ascii_lowercase) + title[pos + 1:]
+        elif roll < 0.7:
+            title = f"{rng.choice(brands)} {rng.choice(kinds)}{rng.choice(['', ' 2', ' hd', 's'])}"
+        titles.append(title.title())
+    return name_to_id, titles
+
+
+def catalog_from_files(channel_files, num_streams):
+    with open(os.path.join(channel_files, 'channels.json')) as file:
+        channels = json.load(file)
+    with open(os.path.join(channel_files, 'streams.json')) as file:
+        streams = json.load(file)
+    name_to_id = {ch['name'].lower(): ch['id'] for ch in channels}
+    return name_to_id, [x['title'] for x in streams[:num_streams]]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--channels', type=int, default=5000)
+    parser.add_argument('--streams', type=int, default=500)
+    parser.add_argument('--channel-files')
+    parser.add_argument('--similar', action='store_true', help='synthetic catalog of near duplicate names')
+    parser.add_argument('--threshold', type=float, default=0.8)
+    args = parser.parse_args()
+
+    if args.channel_files:
+        name_to_id, titles = catalog_from_files(args.channel_files, args.streams)
+    elif args.similar:
+        name_to_id, titles = similar_catalog(args.channels, args.streams)
+    else:
+        name_to_id, titles = synthetic_catalog(args.channels, args.streams)
+
+    start = time.perf_counter()
+    matcher = ChannelMatcher(name_to_id)
+    build_secs = time.perf_counter() - start
+
+    start = time.perf_counter()
+    indexed = [matcher.best_match(title, args.threshold)[0] for title in titles]
+    indexed_secs = time.perf_counter() - start
+
+    start = time.perf_counter()
+    full = [matcher.full_scan_match(title, args.threshold)[0] for title in titles]
+    full_secs = time.perf_counter() - start
+
+    agree = sum(1 for a, b in zip(indexed, full) if a == b)
+    for title, a, b in zip(titles, indexed, full):
+        if a != b:
+            print(f"disagree on {title!r}: indexed {a}, full scan {b}", file=sys.stderr)
+    print(json.dumps({
+        'channels': len(name_to_id),
+        'streams': len(titles),
+        'index_build_secs': round(build_secs, 4),
+        'indexed_secs': round(indexed_secs, 4),
+        'full_scan_secs': round(full_secs, 4),
+        'speedup': round(full_secs / indexed_secs, 1) if indexed_secs else None,
+        'agreement': f"{agree}/{len(titles)}",
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
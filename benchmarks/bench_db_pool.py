@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# Connection churn and throughput of Recording status updates from N concurrent
+# recorder threads: a fresh connection per update (NullPool) vs the pooled,
+# scoped-session DatabaseConnection with bulk updates.
+#   DB_URL=postgresql://... python benchmarks/bench_db_pool.py --recordings 20 --updates 50
+#   python benchmarks/bench_db_pool.py            # temp SQLite file
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from sqlalchemy import create_engine, event, update
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
+from tv_detection_common.models import Base, Recording, RecordingStatus
+from utils.database_connection import DatabaseConnection
+
+
+def count_connects(engine):
+    counter = {'connects': 0}
+
+    def on_connect(dbapi_conn, record):
+        counter['connects'] += 1
+    event.listen(engine, 'connect', on_connect)
+    return counter
+
+
+def run_threads(num_threads, work):
+    threads = [threading.Thread(target=work, args=(i,)) for i in range(num_threads)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--recordings', type=int, default=20, help='concurrent recordings (threads)')
+    parser.add_argument('--updates', type=int, default=50, help='status updates per recording')
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    os.environ.setdefault('DB_URL', f"sqlite:///{os.path.join(tmpdir, 'bench.db')}")
+    db_url = os.environ['DB_URL']
+    logger = logging.getLogger(__name__)
+
+    setup_engine = create_engine(db_url)
+    Base.metadata.create_all(setup_engine)
+    with sessionmaker(bind=setup_engine)() as session:
+        recordings = [Recording(status=RecordingStatus.RECORDING) for _ in range(args.recordings)]
+        session.add_all(recordings)
+        session.commit()
+        recording_ids = [r.id for r in recordings]
+
+    unpooled = create_engine(db_url, poolclass=NullPool)
+    unpooled_counter = count_connects(unpooled)
+    UnpooledSession = sessionmaker(bind=unpooled)
+
+    def unpooled_work(i):
+        for n in range(args.updates):
+            with UnpooledSession() as session:
+                session.execute(update(Recording).where(Recording.id == recording_ids[i]).values(error_message=f"progress {n}"))
+                session.commit()
+    unpooled_secs = run_threads(args.recordings, unpooled_work)
+
+    db_conn = DatabaseConnection(logger, test_conn=False)
+    pooled_counter = count_connects(db_conn.engine)
+
+    def pooled_work(i):
+        for n in range(args.updates):
+            db_conn.bulk_update_recordings({recording_ids[i]: {'error_message': f"progress {n}"}})
+    pooled_secs = run_threads(args.recordings, pooled_work)
+
+    ops = args.recordings * args.updates
+    print(json.dumps({
+        'db': setup_engine.dialect.name,
+        'status_updates': ops,
+        'unpooled': {'secs': round(unpooled_secs, 3), 'connections_opened': unpooled_counter['connects'],
+                     'updates_per_sec': round(ops / unpooled_secs, 1)},
+        'pooled': {'secs': round(pooled_secs, 3), 'connections_opened': pooled_counter['connects'],
+                   'updates_per_sec': round(ops / pooled_secs, 1)},
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# Throughput of EpgFetcher.resolve against the old one-request-per-stream loop,
+# using a local stand-in guide server that adds a fixed delay per request.
+#   python benchmarks/bench_epg_resolution.py --countries 3 --providers 3 --streams 300
+import argparse
+import http.server
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import xml.etree.ElementTree as ET
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.epg_fetcher import EpgFetcher
+
+
+def guide_xml(channel_ids, programmes_per_channel):
+    parts = ['<?xml version="1.0" encoding="UTF-8"?><tv>']
+    parts += [f'<channel id="{channel_id}"><display-name>{channel_id}</display-name></channel>' for channel_id in channel_ids]
+    for channel_id in channel_ids:
+        for i in range(programmes_per_channel):
+            parts.append(
+                f'<programme start="20260101{i % 24:02d}0000 +0000" stop="20260101{(i + 1) % 24:02d}0000 +0000" '
+                f'channel="{channel_id}"><title>Show {i}</title><desc>About show {i}</desc>'
+                f'<category>news</category></programme>'
+            )
+    parts.append('</tv>')
+    return ''.join(parts).encode()
+
+
+def start_guide_server(guides, delay):
+    class GuideHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(delay)
+            body = guides.get(self.path)
+            if body is None:
+                self.send_response(404)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), GuideHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def per_stream_loop(base_url, stream_channels, channel_guides):
+    # the pre-EpgFetcher approach: download and parse the guide for every stream
+    found = 0
+    for channel_id in stream_channels:
+        for path in channel_guides[channel_id]:
+            response = requests.get(base_url + path, timeout=10)
+            if response.status_code != 200:
+                continue
+            root = ET.fromstring(response.content)
+            if any(ch.get('id') == channel_id for ch in root.findall('channel')):
+                programmes = [p for p in root.findall('programme') if p.get('channel') == channel_id]
+                if programmes:
+                    found += 1
+                    break
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--countries', type=int, default=3)
+    parser.add_argument('--providers', type=int, default=3)
+    parser.add_argument('--channels-per-guide', type=int, default=50)
+    parser.add_argument('--programmes-per-channel', type=int, default=48)
+    parser.add_argument('--streams', type=int, default=300)
+    parser.add_argument('--delay', type=float, default=0.05)
+    parser.add_argument('--workers', type=int, default=8)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    guides = {}
+    channel_guides = {}
+    for c in range(args.countries):
+        country_channels = [f"Channel{c}_{i}.c{c}" for i in range(args.channels_per_guide * 2)]
+        paths = [f"/guides/c{c}/provider{p}.xml" for p in range(args.providers)]
+        for p, path in enumerate(paths):
+            # providers overlap, and the first provider doesn't carry every channel
+            listed = country_channels[p * args.channels_per_guide // 2:][:args.channels_per_guide]
+            guides[path] = guide_xml(listed, args.programmes_per_channel)
+        for channel_id in country_channels:
+            channel_guides[channel_id] = paths
+    stream_channels = [rng.choice(list(channel_guides)) for _ in range(args.streams)]
+
+    server = start_guide_server(guides, args.delay)
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    logger = logging.getLogger(__name__)
+
+    start = time.perf_counter()
+    per_stream_found = per_stream_loop(base_url, stream_channels, channel_guides)
+    per_stream_secs = time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        fetcher = EpgFetcher(logger, cache_dir=cache_dir)
+        candidates = {channel_id: [base_url + path for path in channel_guides[channel_id]] for channel_id in set(stream_channels)}
+        start = time.perf_counter()
+        resolved = fetcher.resolve(candidates, max_workers=args.workers)
+        resolve_secs = time.perf_counter() - start
+    resolved_found = sum(1 for channel_id in stream_channels if channel_id in resolved)
+    server.shutdown()
+
+    print(json.dumps({
+        'streams': args.streams,
+        'guides': len(guides),
+        'per_stream_secs': round(per_stream_secs, 3),
+        'per_stream_streams_per_sec': round(args.streams / per_stream_secs, 1),
+        'resolve_secs': round(resolve_secs, 3),
+        'resolve_streams_per_sec': round(args.streams / resolve_secs, 1),
+        'same_results': per_stream_found == resolved_found,
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
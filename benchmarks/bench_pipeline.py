@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+# Per-stage time and memory of the whole catalog -> match -> probe -> EPG pipeline
+# on a synthetic catalog, with a stand-in VPN sidecar, tunnel proxy, stream origin,
+# guide server and ffprobe, so nothing leaves the machine.  Results are JSON, and
+# can be saved as a baseline and compared against on later runs.
+#   python benchmarks/bench_pipeline.py --streams 20000
+#   python benchmarks/bench_pipeline.py --streams 200000 --probe-limit 2000 --output results.json
+#   python benchmarks/bench_pipeline.py --streams 20000 --save-baseline benchmarks/baseline.json
+#   python benchmarks/bench_pipeline.py --streams 20000 --baseline benchmarks/baseline.json   # exit 1 on regression
+#   python benchmarks/bench_pipeline.py --streams 5000 --profile cprofile --profile-dir /tmp/prof
+import argparse
+import http.server
+import json
+import logging
+import os
+import random
+import resource
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+STAGES = ('load_channels_etc', 'narrow_channels', 'streams_for_channels', 'test_channels_with_streams', 'get_epg_for_channel')
+COUNTRY_CODES = ['UK', 'US', 'CA', 'FR', 'DE', 'IT', 'ES', 'NL', 'SE', 'PL']
+SUFFIXES = ['', ' HD', ' SD', ' +1', ' (720p)', ' [Geo-blocked]']
+MEDIA_PLAYLIST = b'#EXTM3U\n#EXT-X-TARGETDURATION:6\n#EXTINF:6.0,\nseg0.ts\n#EXTINF:6.0,\nseg1.ts\n'
+FAKE_FFPROBE = '#!/bin/sh\nsleep "${FAKE_FFPROBE_DELAY:-0}"\nexit 0\n'
+
+
+def write_catalogs(directory, num_channels, num_streams, forbidden_rate, dead_rate, seed=0):
+    # stream urls are plain http so the stand-in proxy can answer them directly,
+    # and say in the path whether the origin should 403 or 404 them
+    rng = random.Random(seed)
+    channels = [{
+        'id': f"Channel{i}.{COUNTRY_CODES[i % len(COUNTRY_CODES)].lower()}",
+        'name': f"Channel {i}",
+        'alt_names': [f"Chan {i}"],
+        'country': COUNTRY_CODES[i % len(COUNTRY_CODES)],
+        'categories': ['general'],
+        'is_nsfw': False,
+        'website': f"https://channel{i}.example.com",
+    } for i in range(num_channels)]
+    streams = []
+    for i in range(num_streams):
+        channel = rng.randrange(num_channels)
+        roll = rng.random()
+        outcome = 'forbidden' if roll < forbidden_rate else 'dead' if roll < forbidden_rate + dead_rate else 'ok'
+        streams.append({
+            'channel': channels[channel]['id'] if rng.random() < 0.3 else None,
+            'title': f"Channel {channel}{rng.choice(SUFFIXES)}",
+            'url': f"http://cdn{rng.randint(0, 50)}.bench.invalid/{outcome}/{i}/playlist.m3u8",
+            'referrer': None,
+            'user_agent': None,
+            'quality': rng.choice(['720p', '1080p', None]),
+        })
+    countries = [{'name': f"Country {code}", 'code': code} for code in COUNTRY_CODES]
+    lookup = [{'iptv_id': ch['id'], 'sd_id': str(i)} for i, ch in enumerate(channels[:num_channels // 4])]
+    for name, data in (('channels.json', channels), ('streams.json', streams),
+                       ('countries.json', countries), ('sd_iptv_channels_lookup.json', lookup)):
+        with open(os.path.join(directory, name), 'w') as outfile:
+            json.dump(data, outfile)
+    with open(os.path.join(directory, 'sites.md'), 'w') as outfile:
+        outfile.write(''.join(f"## Country {code}\n- `provider0`\n" for code in COUNTRY_CODES))
+
+
+def start_fake_services(origin_delay, guide_delay):
+    # One server for everything remote: the sidecar routes, the guides under
+    # /guides/ (server.guides, filled in later), and, for absolute-URI requests,
+    # the tunnel proxy and every stream origin behind it.
+    class FakeHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.startswith('http://'):
+                return self.origin()
+            if self.path.startswith('/guides/'):
+                return self.guide()
+            route = self.path.split('?')[0].strip('/')
+            if route in ('lease', 'failover'):
+                return self.send_json({'status': 'leased', 'lease_id': 'bench', 'tunnel': {
+                    'tunnel_id': 'tun0', 'state': 'up', 'proxy_port': self.server.server_port,
+                    'ovpn_file': '/configs/uk1.nordvpn.com.udp.ovpn',
+                }})
+            if route == 'release':
+                return self.send_json({'status': 'released'})
+            return self.send_json({})
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            self.send_json({'status': 'recorded'})
+
+        def guide(self):
+            time.sleep(guide_delay)
+            body = self.server.guides.get(self.path)
+            self.send_response(200 if body is not None else 404)
+            self.send_header('Content-Length', str(len(body or b'')))
+            self.end_headers()
+            self.wfile.write(body or b'')
+
+        def origin(self):
+            time.sleep(origin_delay)
+            status = 403 if '/forbidden/' in self.path else 404 if '/dead/' in self.path else 200
+            body = MEDIA_PLAYLIST if status == 200 else b''
+            self.send_response(status)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def send_json(self, data):
+            body = json.dumps(data).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FakeHandler)
+    server.guides = {}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def install_fake_ffprobe(directory, delay):
+    bin_dir = os.path.join(directory, 'bin')
+    os.makedirs(bin_dir, exist_ok=True)
+    path = os.path.join(bin_dir, 'ffprobe')
+    with open(path, 'w') as outfile:
+        outfile.write(FAKE_FFPROBE)
+    os.chmod(path, 0o755)
+    os.environ['PATH'] = f"{bin_dir}{os.pathsep}{os.environ['PATH']}"
+    os.environ['FAKE_FFPROBE_DELAY'] = str(delay)
+
+
+class StageTimer():
+    # wall time, process peak RSS after the stage and, with trace_memory, the
+    # stage's own Python allocation peak (tracemalloc slows everything down, so
+    # leave it off when the timings matter)
+    def __init__(self, profile=None, profile_dir=None, trace_memory=False):
+        self.profile = profile
+        self.profile_dir = profile_dir
+        self.trace_memory = trace_memory
+        self.stages = {}
+        if trace_memory:
+            tracemalloc.start()
+
+    @contextmanager
+    def stage(self, name):
+        profiler = self.start_profiler()
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            secs = time.perf_counter() - start
+            result = {'secs': round(secs, 4), 'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)}
+            if self.trace_memory:
+                result['peak_alloc_mb'] = round(tracemalloc.get_traced_memory()[1] / (1 << 20), 1)
+            self.stop_profiler(profiler, name)
+            self.stages[name] = result
+
+    def start_profiler(self):
+        if self.profile == 'cprofile':
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.enable()
+            return profiler
+        if self.profile == 'pyinstrument':
+            from pyinstrument import Profiler
+            profiler = Profiler()
+            profiler.start()
+            return profiler
+        return None
+
+    def stop_profiler(self, profiler, name):
+        if profiler is None:
+            return
+        os.makedirs(self.profile_dir, exist_ok=True)
+        if self.profile == 'cprofile':
+            profiler.disable()
+            profiler.dump_stats(os.path.join(self.profile_dir, f"{name}.prof"))
+        else:
+            profiler.stop()
+            with open(os.path.join(self.profile_dir, f"{name}.html"), 'w') as outfile:
+                outfile.write(profiler.output_html())
+
+
+def run_pipeline(args, timer, logger):
+    from utils.iptv_recorder import IptvRecorder
+    country = args.country
+    with timer.stage('load_channels_etc'):
+        recorder = IptvRecorder(logger)
+        recorder.load_channels_etc()
+    with timer.stage('narrow_channels'):
+        recorder.narrow_channels(country)
+    with timer.stage('streams_for_channels'):
+        recorder.streams_for_channels()
+    with timer.stage('test_channels_with_streams'):
+        recorder.test_channels_with_streams(country.lower(), limit=args.probe_limit)
+    channel_ids = [channel['id'] for channel in recorder.channels[:args.epg_channels]]
+    with timer.stage('get_epg_for_channel'):
+        found = sum(1 for channel_id in channel_ids
+                    if recorder.get_epg_for_channel(channel_id, country.lower(), [f"provider{p}" for p in range(args.providers)]))
+    return {
+        'channels': len(recorder.channels),
+        'streams': len(recorder.streams),
+        'matched_channels': len(recorder.channels_with_streams),
+        'probe_cache': recorder.probe_cache.report(),
+        'epg_channels_found': found,
+    }
+
+
+def compare(results, baseline, tolerance, min_secs):
+    # a stage regresses when it is tolerance slower than the baseline and by more than min_secs
+    regressions = {}
+    for name, stage in results['stages'].items():
+        base = baseline.get('stages', {}).get(name)
+        if not base:
+            continue
+        if stage['secs'] > base['secs'] * (1 + tolerance) and stage['secs'] - base['secs'] > min_secs:
+            regressions[name] = {'secs': stage['secs'], 'baseline_secs': base['secs'],
+                                 'ratio': round(stage['secs'] / base['secs'], 2) if base['secs'] else None}
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--streams', type=int, default=20000, help='synthetic streams, 1k to 200k')
+    parser.add_argument('--channels', type=int, help='synthetic channels, defaults to streams / 2')
+    parser.add_argument('--country', default='UK')
+    parser.add_argument('--forbidden-rate', type=float, default=0.2)
+    parser.add_argument('--dead-rate', type=float, default=0.3)
+    parser.add_argument('--probe-limit', type=int, default=500)
+    parser.add_argument('--origin-delay', type=float, default=0.01, help='seconds per request to the stand-in origin')
+    parser.add_argument('--ffprobe-delay', type=float, default=0.05, help='seconds per fake ffprobe run')
+    parser.add_argument('--epg-channels', type=int, default=200)
+    parser.add_argument('--providers', type=int, default=2)
+    parser.add_argument('--guide-delay', type=float, default=0.02)
+    parser.add_argument('--runs', type=int, default=1, help='repeat in the same cache dir, later runs are warm')
+    parser.add_argument('--trace-memory', action='store_true')
+    parser.add_argument('--profile', choices=['cprofile', 'pyinstrument'])
+    parser.add_argument('--profile-dir', default='bench_profiles')
+    parser.add_argument('--output')
+    parser.add_argument('--baseline', help='compare against this results file, exit 1 on regression')
+    parser.add_argument('--save-baseline', help='write the results here as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    parser.add_argument('--min-secs', type=float, default=0.05)
+    args = parser.parse_args()
+    num_channels = args.channels or max(args.streams // 2, 10)
+
+    logging.basicConfig(level=logging.WARNING)
+    logger = logging.getLogger(__name__)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        write_catalogs(tmpdir, num_channels, args.streams, args.forbidden_rate, args.dead_rate)
+        install_fake_ffprobe(tmpdir, args.ffprobe_delay)
+        services = start_fake_services(args.origin_delay, args.guide_delay)
+        base_url = f"http://127.0.0.1:{services.server_port}/"
+        # the recorder modules read these at import time, so they are set before any import
+        os.environ.update({
+            'CHANNEL_FILES_DIR': tmpdir,
+            'VPN_MANAGER_BASE_URL': base_url,
+            'EPG_BASE_URL': f"{base_url}guides/",
+        })
+        os.environ.setdefault('DB_URL', f"sqlite:///{os.path.join(tmpdir, 'bench.db')}")
+        from bench_epg_resolution import guide_xml
+        from sqlalchemy import create_engine
+        from tv_detection_common.models import Base
+        Base.metadata.create_all(create_engine(os.environ['DB_URL']))
+        country = args.country.lower()
+        guide_channels = [f"Channel{i}.{country}" for i in range(num_channels) if COUNTRY_CODES[i % len(COUNTRY_CODES)].lower() == country]
+        services.guides.update({
+            f"/guides/{country}/provider{p}.xml": guide_xml(guide_channels[p::args.providers], 24)
+            for p in range(args.providers)
+        })
+
+        runs = []
+        for run in range(args.runs):
+            timer = StageTimer(args.profile, os.path.join(args.profile_dir, f"run{run}"), args.trace_memory)
+            counts = run_pipeline(args, timer, logger)
+            runs.append({'stages': timer.stages, 'counts': counts})
+        services.shutdown()
+
+    results = {
+        'params': {k: v for k, v in vars(args).items() if k not in ('output', 'baseline', 'save_baseline')},
+        'python': sys.version.split()[0],
+        # per stage median over runs, what baselines are compared on
+        'stages': {name: {
+            'secs': round(statistics.median(run['stages'][name]['secs'] for run in runs), 4),
+            'peak_rss_mb': max(run['stages'][name]['peak_rss_mb'] for run in runs),
+        } for name in STAGES},
+        'runs': runs,
+    }
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        results['regressions'] = compare(results, baseline, args.tolerance, args.min_secs)
+        exit_code = 1 if results['regressions'] else 0
+    output = json.dumps(results, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as outfile:
+            outfile.write(output)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as outfile:
+            outfile.write(output)
+    sys.exit(exit_code)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# Process start to "ready" (the line app.py logs once the recorder is built) and
+# start to exit, for app.py subcommands on a synthetic catalog, with lazy
+# loading and with --eager (every catalog loaded up front, the old startup).
+# Each run is a fresh interpreter, so imports are part of the time.  The
+# catalog cache is warmed once first, as in a long running container.
+#   python benchmarks/bench_startup.py --streams 20000 --runs 5
+#   python benchmarks/bench_startup.py --streams 200000 --output startup.json
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench_pipeline import write_catalogs
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# (name, app.py arguments, runs to exit or is stopped once ready)
+SCENARIOS = (
+    ('import', None, True),
+    ('snooze', ['snooze'], False),
+    ('snooze_eager', ['--eager', 'snooze'], False),
+    ('match', ['match', '--country', 'UK'], True),
+    ('match_eager', ['--eager', 'match', '--country', 'UK'], True),
+)
+
+
+def run_once(app_args, to_exit, env):
+    # (secs to the ready line, secs to exit or None)
+    if app_args is None:
+        cmd = [sys.executable, '-c', 'import utils.iptv_recorder']
+    else:
+        cmd = [sys.executable, '-u', os.path.join(REPO_DIR, 'app.py')] + app_args
+    start = time.perf_counter()
+    process = subprocess.Popen(cmd, cwd=REPO_DIR, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    ready = None
+    output = []
+    for line in process.stdout:
+        output.append(line)
+        if ready is None and 'ready after' in line:
+            ready = time.perf_counter() - start
+            if not to_exit:
+                process.terminate()
+                break
+    return_code = process.wait()
+    finished = time.perf_counter() - start
+    if to_exit and return_code != 0:
+        raise RuntimeError(f"{' '.join(cmd)} exited with {return_code}:\n{''.join(output[-20:])}")
+    return (ready if app_args else finished), (finished if to_exit else None)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--channels', type=int, default=5000)
+    parser.add_argument('--streams', type=int, default=20000)
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--output', help='write the results JSON here too')
+    args = parser.parse_args()
+
+    channel_dir = tempfile.mkdtemp()
+    write_catalogs(channel_dir, args.channels, args.streams, forbidden_rate=0.1, dead_rate=0.1)
+    env = dict(os.environ, CHANNEL_FILES_DIR=channel_dir, METRICS_PORT='0', PYTHONPATH=REPO_DIR)
+    # fills the catalog cache and the match cache, later runs see a warm container
+    run_once(['--eager', 'match', '--country', 'UK'], True, env)
+
+    results = {}
+    for name, app_args, to_exit in SCENARIOS:
+        runs = [run_once(app_args, to_exit, env) for _ in range(args.runs)]
+        results[name] = {
+            'ready_secs': round(statistics.median(ready for ready, _ in runs), 3),
+            'exit_secs': round(statistics.median(finished for _, finished in runs), 3) if to_exit else None,
+        }
+        print(f"{name:14} ready {results[name]['ready_secs']:.3f}s"
+              + (f"  exit {results[name]['exit_secs']:.3f}s" if to_exit else ""), file=sys.stderr)
+    report = {'channels': args.channels, 'streams': args.streams, 'runs': args.runs, 'scenarios': results}
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as outfile:
+            json.dump(report, outfile, indent=2)
+
+
+if __name__ == '__main__':
+    main()
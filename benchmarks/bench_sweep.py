@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# A sharded sweep run by several local worker processes against one database,
+# with a stand-in probe that sleeps per stream.  One worker can be SIGKILLed
+# mid-shard to check that its lease expires and another worker finishes the
+# shard.  Exits 1 unless every stream ends up with exactly one result.
+#   python benchmarks/bench_sweep.py --workers 4 --channels 600 --kill-one   # temp SQLite file
+#   DB_URL=postgresql://... python benchmarks/bench_sweep.py --workers 8 --buckets 4
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from sqlalchemy import create_engine
+from utils.sweep_coordinator import SweepCoordinator, SweepWorker, shard_channels
+
+COUNTRY_CODES = ['GB', 'US', 'CA', 'FR', 'DE', 'IT']
+
+
+def make_channels_with_streams(num_channels, streams_per_channel):
+    return {
+        f"Channel{i}.{COUNTRY_CODES[i % len(COUNTRY_CODES)].lower()}": {
+            'channel': {'id': f"Channel{i}", 'country': COUNTRY_CODES[i % len(COUNTRY_CODES)]},
+            'streams': [{'url': f"http://cdn.bench.invalid/{i}/{s}.m3u8"} for s in range(streams_per_channel)],
+        }
+        for i in range(num_channels)
+    }
+
+
+def make_engine(db_url):
+    # a generous busy timeout, every worker process writes to the same SQLite file
+    return create_engine(db_url, connect_args={'timeout': 30} if db_url.startswith('sqlite') else {})
+
+
+def worker_main(db_url, sweep_id, worker_id, channels_with_streams, probe_ms, batch_channels, lease_ttl):
+    logging.basicConfig(level=logging.INFO, format=f'%(asctime)s [{worker_id}] %(message)s')
+    logger = logging.getLogger(worker_id)
+    coordinator = SweepCoordinator(logger, make_engine(db_url), lease_ttl=lease_ttl)
+
+    def sweep_fn(shard, report):
+        channel_ids = shard['channel_ids']
+        for start in range(0, len(channel_ids), batch_channels):
+            results = []
+            for channel_id in channel_ids[start:start + batch_channels]:
+                for stream in channels_with_streams[channel_id]['streams']:
+                    time.sleep(probe_ms / 1000)
+                    results.append({'channel_id': channel_id, 'url': stream['url'], 'status': 'OK',
+                                    'return_code': 0, 'latency_ms': probe_ms, 'vpn_endpoint': f"{shard['country']}1"})
+            report(results)
+
+    SweepWorker(logger, coordinator, sweep_fn, worker_id=worker_id, poll_interval=1).run(sweep_id)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--channels', type=int, default=600)
+    parser.add_argument('--streams-per-channel', type=int, default=2)
+    parser.add_argument('--buckets', type=int, default=2, help='hash buckets per country, 1 shards by country only')
+    parser.add_argument('--probe-ms', type=float, default=5)
+    parser.add_argument('--batch-channels', type=int, default=25)
+    parser.add_argument('--lease-ttl', type=int, default=3)
+    parser.add_argument('--kill-one', action='store_true', help='SIGKILL the first worker once it holds a lease')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [coordinator] %(message)s')
+    logger = logging.getLogger(__name__)
+    db_url = os.getenv("DB_URL") or f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'sweep.db')}"
+    sweep_id = f"bench-{int(time.time())}"
+    channels_with_streams = make_channels_with_streams(args.channels, args.streams_per_channel)
+
+    coordinator = SweepCoordinator(logger, make_engine(db_url), lease_ttl=args.lease_ttl)
+    shards = shard_channels(channels_with_streams, buckets=args.buckets, country_map={'gb': 'uk'})
+    coordinator.plan(sweep_id, shards)
+
+    start = time.perf_counter()
+    processes = [multiprocessing.Process(target=worker_main, args=(
+        db_url, sweep_id, f"worker{i}", channels_with_streams, args.probe_ms, args.batch_channels, args.lease_ttl
+    )) for i in range(args.workers)]
+    for process in processes:
+        process.start()
+    killed = None
+    if args.kill_one:
+        while killed is None and processes[0].is_alive():
+            if any(lease['owner'] == 'worker0' for lease in coordinator.progress(sweep_id)['leases']):
+                os.kill(processes[0].pid, signal.SIGKILL)
+                killed = 'worker0'
+            time.sleep(0.05)
+    progress = coordinator.wait(sweep_id, poll_interval=1)
+    for process in processes:
+        process.join()
+    elapsed = time.perf_counter() - start
+
+    results = coordinator.results(sweep_id)
+    expected = {(channel_id, stream['url']) for channel_id, entry in channels_with_streams.items() for stream in entry['streams']}
+    got = [(result['channel_id'], result['url']) for result in results]
+    report = {
+        'workers': args.workers,
+        'shards': len(shards),
+        'streams': len(expected),
+        'results': len(got),
+        'missing': len(expected - set(got)),
+        'duplicates': len(got) - len(set(got)),
+        'killed': killed,
+        'shard_status': progress['shards'],
+        'results_by_worker': {},
+        'elapsed_secs': round(elapsed, 2),
+        'streams_per_sec': round(len(got) / elapsed, 1),
+    }
+    for result in results:
+        report['results_by_worker'][result['worker']] = report['results_by_worker'].get(result['worker'], 0) + 1
+    print(json.dumps(report, indent=2))
+    sys.exit(0 if not report['missing'] and not report['duplicates'] else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,14 @@
+import os
+
+import pytest
+
+FAKE_FFMPEG = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_ffmpeg')
+
+
+@pytest.fixture
+def fake_ffmpeg(tmp_path, monkeypatch):
+    # fake_ffmpeg first on PATH under the name ffmpeg
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    os.symlink(FAKE_FFMPEG, bin_dir / 'ffmpeg')
+    monkeypatch.setenv('PATH', f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
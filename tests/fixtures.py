@@ -0,0 +1,72 @@
+import http.server
+import threading
+import time
+
+
+class FixtureServer():
+    # A local http server for the tests.  routes maps a path to a handler
+    # function(request) that writes the whole response; the server runs on a
+    # thread of its own and counts the requests each path received.
+    def __init__(self, routes):
+        self.routes = routes
+        self.hits = {}
+        fixture = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                path = self.path.split('?', 1)[0]
+                fixture.hits[path] = fixture.hits.get(path, 0) + 1
+                route = fixture.routes.get(path)
+                if route is None:
+                    self.send_error(404)
+                    return
+                try:
+                    route(self)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def respond(body, status=200, content_type='text/plain', headers=None):
+    if isinstance(body, str):
+        body = body.encode()
+
+    def route(request):
+        request.send_response(status)
+        request.send_header('Content-Type', content_type)
+        request.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            request.send_header(name, value)
+        request.end_headers()
+        request.wfile.write(body)
+    return route
+
+
+def endless(content_type='video/mp2t', chunk=b'\x47' * 188 * 7, interval=0.01, stop_after=30):
+    # a live progressive stream, no Content-Length, never ends on its own
+    def route(request):
+        request.send_response(200)
+        request.send_header('Content-Type', content_type)
+        request.end_headers()
+        stop = time.monotonic() + stop_after
+        while time.monotonic() < stop:
+            request.wfile.write(chunk)
+            request.wfile.flush()
+            time.sleep(interval)
+    return route
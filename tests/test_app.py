@@ -0,0 +1,100 @@
+import json
+import logging
+import socket
+
+import pytest
+
+import app
+from utils import catalog_cache, catalog_loader, epg_fetcher, results_store
+from utils.metrics import start_metrics_server
+
+from .fixtures import FixtureServer, respond
+
+GUIDE = """<?xml version="1.0" encoding="UTF-8"?>
+<tv>
+  <channel id="BBCOne.uk"><display-name>BBC One</display-name></channel>
+  <programme start="20260122180000 +0000" stop="20260122190000 +0000" channel="BBCOne.uk"><title>News</title></programme>
+  <programme start="20260122190000 +0000" stop="20260122200000 +0000" channel="BBCOne.uk"><title>Quiz</title></programme>
+</tv>
+"""
+SITES = """# Sites
+
+## United Kingdom
+
+- `sky.com`
+- `bbc.co.uk`
+
+## France
+
+- `tv.fr`
+"""
+
+
+@pytest.fixture
+def channel_files(tmp_path, monkeypatch):
+    files = {
+        'channels.json': [
+            {'id': 'BBCOne.uk', 'name': 'BBC One', 'country': 'UK'},
+            {'id': 'BBCTwo.uk', 'name': 'BBC Two', 'country': 'UK'},
+            {'id': 'TF1.fr', 'name': 'TF1', 'country': 'FR'},
+        ],
+        'streams.json': [
+            {'channel': 'BBCOne.uk', 'title': 'BBC One', 'url': 'http://streams/bbc1.m3u8'},
+            {'channel': None, 'title': 'BBC Two HD', 'url': 'http://streams/bbc2.m3u8'},
+            {'channel': 'TF1.fr', 'title': 'TF1', 'url': 'http://streams/tf1.m3u8'},
+        ],
+        'countries.json': [{'code': 'UK', 'name': 'United Kingdom'}, {'code': 'FR', 'name': 'France'}],
+    }
+    for name, records in files.items():
+        (tmp_path / name).write_text(json.dumps(records))
+    (tmp_path / 'sites.md').write_text(SITES)
+    monkeypatch.setattr(catalog_loader, 'CHANNEL_FILES_DIR', str(tmp_path))
+    monkeypatch.setattr(catalog_cache, 'CATALOG_CACHE_PATH', str(tmp_path / 'catalog_cache.sqlite'))
+    monkeypatch.setattr(results_store, 'RESULTS_STORE_PATH', str(tmp_path / 'results.sqlite'))
+    monkeypatch.setattr(epg_fetcher, 'EPG_CACHE_DIR', str(tmp_path / 'epg_cache'))
+    monkeypatch.setenv('METRICS_PORT', '0')
+    return tmp_path
+
+
+def test_epg_scan_finds_the_countrys_guides_from_sites_md(channel_files, monkeypatch, caplog):
+    # sky.com has nothing for the uk, so BBC One's listings come from the second provider
+    routes = {'/uk/bbc.co.uk.xml': respond(GUIDE, content_type='application/xml'), '/uk/sky.com.xml': respond('', status=404)}
+    with FixtureServer(routes) as server:
+        monkeypatch.setattr(epg_fetcher, 'EPG_BASE_URL', server.url + '/')
+        with caplog.at_level(logging.INFO):
+            app.main(['epg', '--country', 'uk'])
+        assert server.hits == {'/uk/sky.com.xml': 1, '/uk/bbc.co.uk.xml': 1}
+    assert 'Valid streams with EPG: 1 across 1 channels' in caplog.text
+    assert 'BBCOne.uk [2] programmes, probed ok False: http://streams/bbc1.m3u8' in caplog.text
+
+
+def test_epg_scan_country_is_case_insensitive(channel_files, monkeypatch, caplog):
+    with FixtureServer({'/uk/bbc.co.uk.xml': respond(GUIDE, content_type='application/xml')}) as server:
+        monkeypatch.setattr(epg_fetcher, 'EPG_BASE_URL', server.url + '/')
+        with caplog.at_level(logging.INFO):
+            app.main(['epg', '--country', 'UK'])
+        # the french channel's guide is never asked for
+        assert '/fr/tv.fr.xml' not in server.hits
+    assert 'Valid streams with EPG: 1 across 1 channels' in caplog.text
+
+
+def test_one_off_commands_leave_the_metrics_port_to_the_long_running_process(channel_files, monkeypatch, caplog):
+    with socket.socket() as busy:
+        busy.bind(('127.0.0.1', 0))
+        busy.listen()
+        monkeypatch.setenv('METRICS_PORT', str(busy.getsockname()[1]))
+        with FixtureServer({}) as server:
+            monkeypatch.setattr(epg_fetcher, 'EPG_BASE_URL', server.url + '/')
+            with caplog.at_level(logging.INFO):
+                app.main(['epg', '--country', 'uk'])
+    assert 'Valid streams with EPG: 0 across 0 channels' in caplog.text
+    assert '/metrics' not in caplog.text
+
+
+def test_metrics_server_listens_on_localhost_by_default():
+    server = start_metrics_server(0)
+    try:
+        assert server.server_address[0] == '127.0.0.1'
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,288 @@
+import logging
+import os
+import subprocess
+import time
+from collections import namedtuple
+
+import pytest
+
+pytest.importorskip("tv_detection_common")
+from tv_detection_common.models import RecordingStatus
+
+from utils.capture_engine import CaptureEngine, parse_country_caps
+from utils.capture_output import FfmpegProgress, PostProcessor
+
+logger = logging.getLogger(__name__)
+
+DiskUsage = namedtuple('DiskUsage', 'total used free')
+
+
+class FakeDb():
+    def __init__(self):
+        self.updates = {}
+
+    def bulk_update_recordings(self, updates):
+        for recording_id, fields in updates.items():
+            self.updates.setdefault(recording_id, {}).update(fields)
+
+
+class FakeVpnManager():
+    def __init__(self):
+        self.calls = []
+        self.next_endpoint = 2
+
+    def failover(self, lease_id, tunnel_id=None):
+        self.calls.append(('failover', lease_id, tunnel_id))
+        endpoint = self.next_endpoint
+        self.next_endpoint += 1
+        return {'lease_id': lease_id, 'proxy_url': f"http://127.0.0.1:81{endpoint:02d}",
+                'tunnel': {'tunnel_id': f"tun{endpoint}", 'ovpn_file': f"uk{endpoint}.ovpn"}}
+
+    def record_probe(self, ovpn_file, return_code):
+        self.calls.append(('probe', ovpn_file, return_code))
+
+    def record_bandwidth(self, ovpn_file, delivered, secs):
+        self.calls.append(('bandwidth', ovpn_file, delivered))
+
+    def release(self, lease_id):
+        self.calls.append(('release', lease_id))
+
+    def flush_reports(self):
+        pass
+
+
+class FakeProcess():
+    def __init__(self, return_code=None):
+        self.return_code = return_code
+        self.pid = 1234
+        self.terminated = False
+
+    def poll(self):
+        return self.return_code
+
+    def terminate(self):
+        self.terminated = True
+
+
+@pytest.fixture
+def make_engine(tmp_path):
+    engines = []
+
+    def make(**kwargs):
+        kwargs.setdefault('recordings_dir', str(tmp_path / 'recordings'))
+        kwargs.setdefault('post_processor', PostProcessor(logger, workers=1, keep_segments=False, timeout=10))
+        engine = CaptureEngine(logger, FakeDb(), FakeVpnManager(), max_recordings=4, country_caps={},
+                               flush_interval=0, segment_secs=1, **kwargs)
+        os.makedirs(engine.recordings_dir, exist_ok=True)
+        engines.append(engine)
+        return engine
+
+    yield make
+    for engine in engines:
+        for capture in engine.active.values():
+            if isinstance(capture.get('process'), subprocess.Popen):
+                capture['process'].kill()
+                capture['process'].wait()
+
+
+def make_capture(engine, name='rec', urls=('http://cdn.example/live/index.m3u8',), duration=60, lease=True):
+    started = time.monotonic()
+    segment_dir = os.path.join(engine.recordings_dir, f"{name}.segments")
+    os.makedirs(segment_dir, exist_ok=True)
+    return {
+        'schedule_id': 1, 'country': 'uk' if lease else None, 'urls': list(urls), 'url_index': 0, 'url': urls[0], 'part': 0,
+        'output_file': os.path.join(engine.recordings_dir, f"{name}.ts"), 'segment_dir': segment_dir,
+        'log_path': os.path.join(engine.recordings_dir, f"{name}.log"),
+        'lease_id': 'lease1' if lease else None, 'proxy_url': 'http://127.0.0.1:8101' if lease else None,
+        'ovpn_file': 'uk1.ovpn' if lease else None, 'tunnel_id': 'tun1' if lease else None,
+        'started': started, 'duration': duration, 'deadline': started + duration, 'bytes': 0,
+        'endpoint_bytes': 0, 'endpoint_since': started, 'failovers': [], 'failover': None,
+        'launched': started, 'last_growth': started,
+    }
+
+
+def test_country_caps():
+    assert parse_country_caps(" UK:2, ca:1,bogus") == {'uk': 2, 'ca': 1}
+    assert parse_country_caps(None) == {}
+
+
+def test_admission_against_free_space_and_what_is_already_committed(make_engine):
+    engine = make_engine(bytes_per_sec=1000, disk_reserve=10000)
+    engine.disk_usage = lambda: DiskUsage(total=200000, used=100000, free=100000)
+    # 60s at 1000B/s fits in 90000 usable bytes
+    assert engine.admit(1, 60) is True
+    # a running capture with 50s left at its measured 1500B/s commits 75000
+    capture = make_capture(engine, duration=120)
+    capture.update(started=time.monotonic() - 70, bytes=105000)
+    engine.active[1] = capture
+    assert engine.committed_bytes() == pytest.approx(75000, rel=0.01)
+    assert engine.admit(2, 60) is None and engine.disk_held == {2}
+    # the remux of a finished capture needs a second copy of its bytes
+    del engine.active[1]
+    engine.finished.append({'bytes': 85000})
+    assert engine.admit(2, 60) is None
+    engine.finished.clear()
+    assert engine.admit(2, 60) is True and engine.disk_held == set()
+    # bigger than the disk could ever hold
+    assert engine.admit(3, 200) is False
+    # an unreadable disk holds, it does not reject
+    engine.disk_usage = lambda: None
+    assert engine.admit(4, 1) is None and engine.free_bytes() is None
+
+
+def test_failover_is_not_measured_while_the_relaunch_is_pending(make_engine):
+    engine = make_engine(stall_secs=20)
+    capture = make_capture(engine)
+    now = time.monotonic()
+    capture.update(process=FakeProcess(), progress=FfmpegProgress(None), relaunch_at=now + 5)
+    capture['progress'].out_secs = 12.0
+    capture['progress'].last_progress = now - 30
+    failover = capture['failover'] = {'latency_secs': None, 'gap_secs': None, 'detected': now - 10, 'last_activity': now - 12}
+    engine.active[1] = capture
+    # out_secs is still the old ffmpeg's, measuring now would give a negative latency
+    engine.check_stalls()
+    assert capture['failover'] is failover and failover['latency_secs'] is None and not capture['process'].terminated
+
+    # relaunched, and the new ffmpeg reports progress: measured from the first failure
+    capture['relaunch_at'] = None
+    capture['progress'] = FfmpegProgress(None)
+    capture['progress'].out_secs = 1.0
+    engine.check_stalls()
+    assert capture['failover'] is None
+    assert 9.5 <= failover['latency_secs'] <= 11 and 11.5 <= failover['gap_secs'] <= 13
+
+
+def test_a_silent_capture_is_terminated_as_stalled(make_engine):
+    engine = make_engine(stall_secs=20)
+    capture = make_capture(engine)
+    capture.update(process=FakeProcess(), progress=FfmpegProgress(None), last_growth=time.monotonic() - 30)
+    capture['progress'].last_progress = time.monotonic() - 30
+    engine.active[1] = capture
+    engine.check_stalls()
+    assert capture['process'].terminated and capture['stalled_at']
+
+
+def test_each_endpoint_is_credited_with_its_own_bytes(make_engine):
+    engine = make_engine()
+    capture = make_capture(engine)
+    with open(os.path.join(capture['segment_dir'], '000_00000.ts'), 'wb') as outfile:
+        outfile.write(b'x' * 300)
+    engine.credit_endpoint(capture)
+    capture['ovpn_file'] = 'uk2.ovpn'
+    with open(os.path.join(capture['segment_dir'], '001_00000.ts'), 'wb') as outfile:
+        outfile.write(b'x' * 700)
+    engine.release_tunnel(capture)
+    assert engine.vpn_manager.calls == [('bandwidth', 'uk1.ovpn', 300), ('bandwidth', 'uk2.ovpn', 700), ('release', 'lease1')]
+
+
+def test_failover_order_new_endpoint_on_403_then_next_stream_then_wrap(make_engine):
+    engine = make_engine(stall_secs=20)
+    launched = []
+    engine.launch = lambda capture: launched.append((capture['url_index'], capture['proxy_url']))
+    capture = make_capture(engine, urls=('http://a/1.m3u8', 'http://b/2.m3u8'))
+    capture.update(launched=time.monotonic() - 60, progress=FfmpegProgress(None))
+    capture['progress'].lines.append('Server returned 403 Forbidden (access denied)')
+
+    engine.fail_over(1, capture, 1)
+    assert capture['failovers'][-1]['action'] == 'new_endpoint' and launched[-1] == (0, 'http://127.0.0.1:8102')
+    assert ('probe', 'uk1.ovpn', 1) in engine.vpn_manager.calls
+    assert ('failover', 'lease1', 'tun1') in engine.vpn_manager.calls and capture['tunnel_id'] == 'tun2'
+
+    # a second 403 on the fresh endpoint moves on to the next stream, same endpoint
+    engine.fail_over(1, capture, 1)
+    assert capture['failovers'][-1]['action'] == 'next_stream' and launched[-1] == (1, 'http://127.0.0.1:8102')
+
+    # wrapping back to the first stream takes another endpoint
+    capture['progress'].lines.clear()
+    engine.fail_over(1, capture, 1)
+    assert capture['failovers'][-1]['action'] == 'next_stream_new_endpoint' and launched[-1] == (0, 'http://127.0.0.1:8103')
+    assert [f['reason'] for f in capture['failovers']] == ['forbidden', 'forbidden', 'exited']
+    # latency is measured from the first failure of the run
+    assert capture['failover']['detected'] == capture['failovers'][0]['detected']
+
+
+def test_sidecar_calls_and_launches_happen_outside_the_lock(make_engine):
+    engine = make_engine(stall_secs=20)
+    locked = []
+    vpn_manager = engine.vpn_manager
+    for name in ('failover', 'release', 'record_bandwidth'):
+        def watched(*args, call=getattr(vpn_manager, name), name=name):
+            locked.append((name, engine.lock.locked()))
+            return call(*args)
+        setattr(vpn_manager, name, watched)
+    engine.launch = lambda capture: locked.append(('launch', engine.lock.locked()))
+    # a 403 part way through the programme fails over to a new endpoint
+    failing = make_capture(engine, name='failing', urls=('http://a/1.m3u8', 'http://b/2.m3u8'))
+    failing.update(process=FakeProcess(1), progress=FfmpegProgress(None), launched=time.monotonic() - 60)
+    failing['progress'].lines.append('Server returned 403 Forbidden (access denied)')
+    with open(os.path.join(failing['segment_dir'], '000_00000.ts'), 'wb') as outfile:
+        outfile.write(b'x' * 100)
+    # and one that ran to the end lets go of its lease
+    done = make_capture(engine, name='done', duration=0)
+    done.update(process=FakeProcess(0), progress=FfmpegProgress(None))
+    engine.active.update({1: failing, 2: done})
+
+    engine.poll()
+    assert sorted(locked) == [('failover', False), ('launch', False), ('record_bandwidth', False), ('release', False)]
+    assert failing['tunnel_id'] == 'tun2' and failing['proxy_url'] == 'http://127.0.0.1:8102'
+    assert list(engine.active) == [1] and [job['output_file'] for job in engine.finished] == [done['output_file']]
+
+
+def test_sources_that_die_right_away_back_off(make_engine):
+    engine = make_engine(stall_secs=20)
+    engine.launch = lambda capture: None
+    capture = make_capture(engine, urls=('http://a/1.m3u8', 'http://b/2.m3u8'), lease=False)
+    capture['progress'] = FfmpegProgress(None)
+    delays = []
+    for _ in range(4):
+        capture['relaunch_at'] = None
+        capture['launched'] = time.monotonic()
+        engine.fail_over(1, capture, 1)
+        delays.append(round(capture['relaunch_at'] - time.monotonic()) if capture.get('relaunch_at') else 0)
+    assert delays == [1, 2, 4, 8]
+    assert not engine.should_fail_over(dict(capture, deadline=time.monotonic() + 5), 0)
+
+
+def test_a_stalled_source_fails_over_and_the_recording_is_stitched(make_engine, fake_ffmpeg):
+    engine = make_engine(stall_secs=1, disk_reserve=0)
+    engine.post_processor.start()
+    capture = make_capture(engine, urls=('http://a.example/stall/index.m3u8', 'http://b.example/live/index.m3u8'),
+                           duration=9)
+    engine.launch(capture)
+    engine.active[7] = capture
+    deadline = time.monotonic() + 20
+    while (engine.active or engine.finished or engine.post_processor.in_progress) and time.monotonic() < deadline:
+        engine.poll()
+        time.sleep(0.2)
+    time.sleep(0.2)
+    engine.flush_status_updates()
+    engine.post_processor.stop()
+
+    update = engine.db_conn.updates[7]
+    assert update['status'] == RecordingStatus.COMPLETED and update['file_path'] == capture['output_file']
+    (failover,) = capture['failovers']
+    assert failover['reason'] == 'stalled' and failover['action'] == 'next_stream'
+    assert failover['latency_secs'] > 0 and failover['gap_secs'] >= failover['latency_secs']
+    recorded = open(capture['output_file']).read().splitlines()
+    assert recorded[:2] == ['http://a.example/stall/index.m3u8#0', 'http://a.example/stall/index.m3u8#1']
+    assert recorded[2].startswith('http://b.example/live/index.m3u8#') and len(recorded) > 3
+    assert ('release', 'lease1') in engine.vpn_manager.calls
+
+
+def test_stop_fails_running_and_unprocessed_captures_with_their_segments(make_engine, fake_ffmpeg):
+    engine = make_engine(disk_reserve=0)
+    running = make_capture(engine, name='running', duration=30)
+    engine.launch(running)
+    engine.active[1] = running
+    waiting = make_capture(engine, name='waiting', lease=False)
+    engine.finished.append({'segment_dir': waiting['segment_dir'], 'output_file': waiting['output_file'], 'bytes': 0,
+                            'on_done': lambda file_path, error: engine.post_processed(2, file_path, error)})
+    engine.stop(kill_after=5)
+
+    assert running['process'].poll() is not None and not engine.active and not engine.finished
+    assert engine.db_conn.updates[1]['status'] == RecordingStatus.FAILED
+    assert engine.db_conn.updates[1]['file_path'] == running['segment_dir']
+    assert engine.db_conn.updates[2] == dict(engine.db_conn.updates[2], status=RecordingStatus.FAILED,
+                                            file_path=waiting['segment_dir'],
+                                            error_message='recorder shut down before post-processing')
+    assert ('release', 'lease1') in engine.vpn_manager.calls
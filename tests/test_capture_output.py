@@ -0,0 +1,103 @@
+import io
+import logging
+import os
+import threading
+
+import pytest
+
+from utils.capture_output import FfmpegProgress, PostProcessor, parse_bitrate, parse_clock, parse_size, segment_files
+
+logger = logging.getLogger(__name__)
+
+
+def test_status_fields():
+    assert parse_clock('01:02:03.45') == pytest.approx(3723.45)
+    assert parse_clock('-00:00:01.00') == 1 and parse_clock('N/A') is None
+    assert parse_size('1024kB') == 1 << 20 and parse_size('12') == 12 and parse_size('N/A') is None
+    assert parse_bitrate('838.9kbits/s') == pytest.approx(838900) and parse_bitrate('N/A') is None
+
+
+def test_progress_parses_status_lines_and_keeps_the_rest_bounded(tmp_path):
+    stderr = (b"Input #0, hls, from 'http://a/index.m3u8':\n"
+              b"frame=  250 fps= 25 q=-1.0 size=    1024kB time=00:00:10.00 bitrate= 838.9kbits/s speed=1.01x\r"
+              b"frame=  500 fps= 25 q=-1.0 size=    2048kB time=00:00:20.00 bitrate= 838.9kbits/s speed=1.02x\r"
+              # an older timestamp after a discontinuity is not progress
+              b"frame=  510 fps= 25 q=-1.0 size=    2100kB time=00:00:05.00 bitrate=N/A speed=1x\r"
+              + b"".join(f"[hls @ 0x1] skipping segment {n}\n".encode() for n in range(100))
+              + b"x" * 10000 + b"\n"
+              + b"[https @ 0x2] HTTP error 403 Forbidden")
+    log_path = tmp_path / 'capture.log'
+    progress = FfmpegProgress(io.BufferedReader(io.BytesIO(stderr)), str(log_path), tail_lines=5, max_log_bytes=200,
+                              max_line=100).start()
+    progress.join(5)
+    assert progress.out_secs == 20 and progress.size_bytes == 2100 * 1024 and progress.bitrate_bps == pytest.approx(838900)
+    assert progress.speed == '1x'
+    assert progress.tail().splitlines() == [
+        '[hls @ 0x1] skipping segment 97', '[hls @ 0x1] skipping segment 98', '[hls @ 0x1] skipping segment 99',
+        'x' * 100, '[https @ 0x2] HTTP error 403 Forbidden',
+    ]
+    log = log_path.read_text()
+    assert log.startswith("Input #0") and 'frame=' not in log and len(log) < 250
+    assert progress.snapshot()['out_secs'] == 20
+
+
+def make_job(tmp_path, name, segments, done):
+    segment_dir = tmp_path / f"{name}.segments"
+    segment_dir.mkdir()
+    for n, data in enumerate(segments):
+        (segment_dir / f"000_{n:05d}.ts").write_bytes(data)
+    return {
+        'segment_dir': str(segment_dir),
+        'output_file': str(tmp_path / f"{name}.ts"),
+        'bytes': sum(len(data) for data in segments),
+        'on_done': lambda file_path, error: done.append((name, file_path, error)),
+    }
+
+
+def wait_for(done, count):
+    for _ in range(100):
+        if len(done) >= count:
+            return
+        threading.Event().wait(0.05)
+    raise AssertionError(f"only {done} finished")
+
+
+def test_remux_joins_segments_and_cleans_up(tmp_path, fake_ffmpeg):
+    done = []
+    post_processor = PostProcessor(logger, workers=1, max_queued=4, keep_segments=False, timeout=10)
+    post_processor.start()
+    good = make_job(tmp_path, 'good', [b'one|', b'two|', b'three'], done)
+    empty = make_job(tmp_path, 'empty', [], done)
+    assert post_processor.submit(good) and post_processor.submit(empty)
+    wait_for(done, 2)
+    post_processor.stop()
+    assert done == [('good', good['output_file'], None), ('empty', None, 'no output written')]
+    assert open(good['output_file'], 'rb').read() == b'one|two|three'
+    assert not os.path.exists(good['segment_dir']) and not os.path.exists(empty['segment_dir'])
+    assert post_processor.pending_bytes() == 0
+
+
+def test_a_failed_remux_keeps_the_segments(tmp_path, fake_ffmpeg, monkeypatch):
+    monkeypatch.setenv('FAKE_FFMPEG_FAIL_REMUX', '1')
+    done = []
+    post_processor = PostProcessor(logger, workers=1, max_queued=4, keep_segments=False, timeout=10)
+    post_processor.start()
+    job = make_job(tmp_path, 'bad', [b'one', b'two'], done)
+    post_processor.submit(job)
+    wait_for(done, 1)
+    post_processor.stop()
+    (name, file_path, error), = done
+    assert file_path == job['segment_dir'] and error.startswith('remux failed') and 'Invalid data' in error
+    assert len(segment_files(job['segment_dir'])) == 2
+
+
+def test_a_full_queue_refuses_and_stop_finishes_what_is_queued(tmp_path):
+    # no workers started, so nothing is taken off the queue
+    done = []
+    post_processor = PostProcessor(logger, workers=1, max_queued=2, keep_segments=False)
+    jobs = [make_job(tmp_path, f"job{n}", [b'x' * 10], done) for n in range(3)]
+    assert [post_processor.submit(job) for job in jobs] == [True, True, False]
+    assert post_processor.pending_bytes() == 20
+    post_processor.stop()
+    assert done == [(f"job{n}", jobs[n]['segment_dir'], 'recorder shut down before post-processing') for n in range(2)]
+    assert post_processor.pending_bytes() == 0 and len(segment_files(jobs[0]['segment_dir'])) == 1
@@ -0,0 +1,79 @@
+import json
+import logging
+
+import pytest
+
+from utils import catalog_cache, catalog_loader, results_store
+from utils.catalog_cache import CatalogCache
+from utils.channel_matcher import ChannelMatcher
+from utils.iptv_recorder import IptvRecorder
+
+logger = logging.getLogger(__name__)
+
+CHANNELS = [
+    {'id': 'BBCOne.uk', 'name': 'BBC One', 'country': 'UK'},
+    {'id': 'BBCTwo.uk', 'name': 'BBC Two', 'country': 'UK'},
+    {'id': 'ITV1.uk', 'name': 'ITV 1', 'country': 'UK'},
+]
+
+
+@pytest.fixture
+def channel_files(tmp_path, monkeypatch):
+    (tmp_path / 'channels.json').write_text(json.dumps(CHANNELS))
+    monkeypatch.setattr(catalog_loader, 'CHANNEL_FILES_DIR', str(tmp_path))
+    monkeypatch.setattr(catalog_cache, 'CATALOG_CACHE_PATH', str(tmp_path / 'catalog_cache.sqlite'))
+    monkeypatch.setattr(results_store, 'RESULTS_STORE_PATH', str(tmp_path / 'results.sqlite'))
+    return tmp_path
+
+
+@pytest.fixture
+def matched_titles(monkeypatch):
+    titles = []
+    best_match = ChannelMatcher.best_match
+
+    def counting_best_match(self, title, threshold):
+        titles.append(title)
+        return best_match(self, title, threshold)
+
+    monkeypatch.setattr(ChannelMatcher, 'best_match', counting_best_match)
+    return titles
+
+
+def write_streams(channel_files, titles):
+    streams = [{'channel': None, 'title': title, 'url': f"http://streams/{index}.m3u8"} for index, title in enumerate(titles)]
+    (channel_files / 'streams.json').write_text(json.dumps(streams))
+
+
+def test_catalog_key_is_the_cached_catalogs_key_without_loading(tmp_path):
+    path = tmp_path / 'streams.json'
+    path.write_text('[{"title": "BBC One"}]')
+    cache = CatalogCache(logger, path=str(tmp_path / 'cache.sqlite'))
+    loads = []
+    key, records = cache.cached_catalog('streams', str(path), lambda: loads.append(1) or [{'title': 'BBC One'}], ':x')
+    assert cache.catalog_key(str(path), ':x') == key
+    assert cache.cached_catalog('streams', str(path), lambda: loads.append(1), ':x') == (key, records)
+    assert loads == [1]
+
+
+def test_second_run_rematches_only_new_and_changed_titles(channel_files, matched_titles):
+    write_streams(channel_files, ['BBC One HD', 'BBC Two', 'ITV 1 HD'])
+    first = IptvRecorder(logger)
+    first.streams_for_channels()
+    assert sorted(matched_titles) == ['BBC One HD', 'BBC Two', 'ITV 1 HD']
+    assert sorted(first.channels_with_streams) == ['BBCOne.uk', 'BBCTwo.uk', 'ITV1.uk']
+
+    # nothing changed: the stored result is reused without parsing streams.json or matching anything
+    matched_titles.clear()
+    unchanged = IptvRecorder(logger)
+    unchanged.streams_for_channels()
+    assert matched_titles == []
+    assert 'streams' not in unchanged.__dict__ and 'channels' not in unchanged.__dict__
+    assert unchanged.channels_with_streams == first.channels_with_streams
+
+    # one title changed and one added: only those two are matched, the rest come from the cache
+    write_streams(channel_files, ['BBC One HD', 'BBC Two HD', 'ITV 1 HD', 'BBC One +1'])
+    changed = IptvRecorder(logger)
+    changed.streams_for_channels()
+    assert sorted(matched_titles) == ['BBC One +1', 'BBC Two HD']
+    assert len(changed.channels_with_streams['BBCOne.uk']['streams']) == 2
+    assert changed.channels_with_streams['BBCTwo.uk']['streams'][0]['title'] == 'BBC Two HD'
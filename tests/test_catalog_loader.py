@@ -0,0 +1,45 @@
+import json
+
+import pytest
+
+from utils.catalog_loader import STREAM_FIELDS, iter_json_array, load_catalog
+
+DOCUMENT = [
+    123456, 7, -0.25, 1e10, True, False, None, "a, string ] with [ brackets",
+    {"id": "bbc.uk", "name": "BBC One", "nested": [1, 22, 333]}, [], {}, 98765432109876543210,
+]
+
+
+@pytest.mark.parametrize('chunk_size', range(1, 24))
+def test_elements_survive_any_chunk_boundary(tmp_path, chunk_size):
+    path = tmp_path / 'catalog.json'
+    path.write_text(json.dumps(DOCUMENT, indent=1))
+    assert list(iter_json_array(str(path), chunk_size=chunk_size)) == DOCUMENT
+    path.write_text(json.dumps(DOCUMENT, separators=(',', ':')))
+    assert list(iter_json_array(str(path), chunk_size=chunk_size)) == DOCUMENT
+
+
+def test_a_number_cut_at_a_chunk_boundary_is_read_whole(tmp_path):
+    path = tmp_path / 'numbers.json'
+    path.write_text('[123456, 7]')
+    assert list(iter_json_array(str(path), chunk_size=4)) == [123456, 7]
+
+
+def test_not_an_array_or_truncated(tmp_path):
+    path = tmp_path / 'object.json'
+    path.write_text('{"id": 1}')
+    with pytest.raises(ValueError):
+        list(iter_json_array(str(path)))
+    path.write_text('[1, 2, 3')
+    with pytest.raises(json.JSONDecodeError):
+        list(iter_json_array(str(path), chunk_size=2))
+
+
+def test_load_catalog_keeps_only_the_wanted_fields(tmp_path):
+    path = tmp_path / 'streams.json'
+    path.write_text(json.dumps([
+        {'channel': 'bbc.uk', 'url': 'http://a/1.m3u8', 'quality': '720p', 'label': None, 'referrer': None},
+        {'channel': None, 'url': 'http://a/2.m3u8'},
+    ]))
+    streams = load_catalog(str(path), STREAM_FIELDS, keep=lambda record: record.get('channel'))
+    assert streams == [{'channel': 'bbc.uk', 'url': 'http://a/1.m3u8', 'quality': '720p'}]
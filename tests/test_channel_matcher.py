@@ -0,0 +1,58 @@
+import random
+import string
+
+from utils.channel_matcher import ChannelMatcher, clean_title
+
+
+def test_exact_names_are_found_through_the_index():
+    matcher = ChannelMatcher({'bbc one': 'BBCOne.uk', 'bbc two': 'BBCTwo.uk'})
+    assert clean_title('BBC One HD') == 'bbc one'
+    assert matcher.best_match('BBC One HD', 0.8) == ('BBCOne.uk', 1.0)
+    assert matcher.best_match('bbc two', 0.99) == ('BBCTwo.uk', 1.0)
+
+
+def test_thresholds_are_inclusive():
+    # 'abcx' against 'abcd' scores exactly 0.75
+    matcher = ChannelMatcher({'abcd': 'ABCD.uk'})
+    assert matcher.best_match('abcx', 0.75) == ('ABCD.uk', 0.75)
+    assert matcher.best_match('abcx', 0.8) == (None, 0)
+    assert matcher.best_match('abcx', 0.8) == matcher.full_scan_match('abcx', 0.8)
+
+
+def test_ties_go_to_the_first_name_like_the_full_scan():
+    for names in (['abcy', 'abcz'], ['abcz', 'abcy']):
+        matcher = ChannelMatcher({name: name.upper() for name in names})
+        assert matcher.best_match('abcx', 0.75) == (names[0].upper(), 0.75)
+        assert matcher.best_match('abcx', 0.75) == matcher.full_scan_match('abcx', 0.75)
+
+
+def test_a_tie_with_a_name_outside_the_closest_by_trigrams_still_goes_to_the_first():
+    # 'hze kids' and 'whb kids' both score 0.875 against 'whz kids', but twenty names
+    # share more trigrams with it than 'hze kids' does
+    names = ['hze kids', 'whb kids', 'wh kids 1', 'wh kids 4', 'whb kids 9', 'whb kids 7', 'whb kids 6',
+             'wqiqz kids', 'dz kids', 'wjm kids', 'wqiqz kids 3', 'wqiqz kids 8', 'wqiqz kids 7', 'wqiqz kids 1',
+             'wqiqz kids 4', 'wdrk kids', 'dz kids 1', 'dz kids 4', 'dz kids 6', 'dz kids 8', 'wqiqz kids 11']
+    matcher = ChannelMatcher({name: name.replace(' ', '') for name in names})
+    assert matcher.best_match('Whz Kids', 0.75) == matcher.full_scan_match('Whz Kids', 0.75) == ('hzekids', 0.875)
+
+
+def test_agrees_with_the_full_scan_on_near_duplicate_names():
+    # many names a character or a number apart
+    rng = random.Random(1)
+    brands = [''.join(rng.choice('abcde') for _ in range(rng.randint(2, 4))) for _ in range(20)]
+    kinds = ['sports', 'news', 'one', 'two', 'max']
+    name_to_id = {}
+    while len(name_to_id) < 200:
+        name = f"{rng.choice(brands)} {rng.choice(kinds)}" + (f" {rng.randint(1, 12)}" if rng.random() < 0.6 else '')
+        name_to_id.setdefault(name, f"channel{len(name_to_id)}")
+    names = list(name_to_id)
+    titles = []
+    for _ in range(100):
+        title = rng.choice(names)
+        pos = rng.randrange(len(title))
+        titles.append(title[:pos] + rng.choice(string.ascii_lowercase) + title[pos + 1:])
+        titles.append(f"{rng.choice(brands)} {rng.choice(kinds)}{rng.choice(['', ' 2', 's'])}")
+    matcher = ChannelMatcher(name_to_id)
+    for threshold in (0.75, 0.8):
+        for title in titles:
+            assert matcher.best_match(title, threshold) == matcher.full_scan_match(title, threshold), title
@@ -0,0 +1,46 @@
+import logging
+
+import pytest
+
+pytest.importorskip("tv_detection_common")
+from tv_detection_common.models import Base, Recording, RecordingStatus
+
+from utils.database_connection import DatabaseConnection
+
+logger = logging.getLogger(__name__)
+
+
+@pytest.fixture
+def db_conn(tmp_path, monkeypatch):
+    monkeypatch.setenv('DB_URL', f"sqlite:///{tmp_path / 'recorder.db'}")
+    db_conn = DatabaseConnection(logger, test_conn=False)
+    Base.metadata.create_all(db_conn.engine)
+    yield db_conn
+    db_conn.Session.remove()
+    db_conn.engine.dispose()
+
+
+def test_bulk_helpers_leave_the_threads_session_alone(db_conn):
+    session = db_conn.Session()
+    recording = Recording(status=RecordingStatus.RECORDING)
+    session.add(recording)
+    session.commit()
+
+    db_conn.bulk_insert_recordings([{'status': RecordingStatus.RECORDING}, {'status': RecordingStatus.RECORDING}])
+    db_conn.bulk_update_recordings({recording.id: {'status': RecordingStatus.COMPLETED, 'error_message': 'done'}})
+
+    # the caller's scoped session is still the one it was using, and still works
+    assert db_conn.Session() is session
+    session.refresh(recording)
+    assert (recording.status, recording.error_message) == (RecordingStatus.COMPLETED, 'done')
+    assert session.query(Recording).count() == 3
+
+
+def test_an_unreachable_database_is_not_fatal(tmp_path, monkeypatch, caplog):
+    # no schedules table: logged and carried on, not exited
+    monkeypatch.setenv('DB_URL', f"sqlite:///{tmp_path / 'empty.db'}")
+    monkeypatch.setenv('DB_CONNECT_ATTEMPTS', '1')
+    db_conn = DatabaseConnection(logger, test_conn=True)
+    assert db_conn.verify_database_connection() is False
+    assert 'carrying on without it' in caplog.text
+    db_conn.engine.dispose()
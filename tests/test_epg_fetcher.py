@@ -0,0 +1,115 @@
+import logging
+
+from utils.epg_fetcher import EpgFetcher
+
+from .fixtures import FixtureServer, respond
+
+logger = logging.getLogger(__name__)
+
+GUIDE = """<?xml version="1.0" encoding="UTF-8"?>
+<tv>
+  <channel id="BBCOne.uk"><display-name>BBC One</display-name></channel>
+  <channel id="BBCTwo.uk"><display-name>BBC Two</display-name></channel>
+  <programme start="20260122180000 +0000" stop="20260122190000 +0000" channel="BBCOne.uk">
+    <title>News</title><desc>The news.</desc><category>News</category><category>Current Affairs</category>
+  </programme>
+  <programme start="20260122190000 +0000" stop="20260122200000 +0000" channel="BBCOne.uk">
+    <title>Quiz</title>
+  </programme>
+</tv>
+"""
+
+
+def conditional(body, etag):
+    # 304 when the client already has etag, the guide otherwise
+    def route(request):
+        if request.headers.get('If-None-Match') == etag:
+            request.send_response(304)
+            request.send_header('ETag', etag)
+            request.send_header('Content-Length', '0')
+            request.end_headers()
+            return
+        respond(body, content_type='application/xml', headers={'ETag': etag})(request)
+    return route
+
+
+def test_parse_indexes_channels_and_programmes(tmp_path):
+    xml_path = tmp_path / 'guide.xml'
+    xml_path.write_text(GUIDE)
+    index = EpgFetcher(logger, cache_dir=str(tmp_path / 'cache')).parse(str(xml_path))
+    assert index['channels'] == {'BBCOne.uk', 'BBCTwo.uk'}
+    assert [p['title'] for p in index['programmes']['BBCOne.uk']] == ['News', 'Quiz']
+    news = index['programmes']['BBCOne.uk'][0]
+    assert news == {'start': '20260122180000 +0000', 'stop': '20260122190000 +0000', 'title': 'News',
+                    'desc': 'The news.', 'categories': ['News', 'Current Affairs']}
+
+
+def test_parse_does_not_keep_the_whole_document(tmp_path, monkeypatch):
+    # the root is cleared as entries are indexed, so <tv> only ever holds what the
+    # parser has read ahead of the loop, not everything seen so far
+    xml_path = tmp_path / 'big.xml'
+    xml_path.write_text('<tv>' + ''.join(
+        f'<programme start="{n}" channel="c{n % 3}"><title>t{n}</title></programme>' for n in range(20000)) + '</tv>')
+    import xml.etree.ElementTree as ET
+    iterparse = ET.iterparse
+    widths = []
+
+    def watching_iterparse(source, events):
+        root = None
+        for event, elem in iterparse(source, ('start', 'end')):
+            root = root if root is not None else elem
+            if event in events:
+                yield event, elem
+                widths.append(len(root))
+    monkeypatch.setattr(ET, 'iterparse', watching_iterparse)
+    index = EpgFetcher(logger, cache_dir=str(tmp_path / 'cache')).parse(str(xml_path))
+    assert sum(len(programmes) for programmes in index['programmes'].values()) == 20000
+    assert max(widths) < 2000 and widths[-1] == 0
+
+
+def test_guides_are_fetched_once_and_then_conditionally(tmp_path):
+    with FixtureServer({'/uk/a.xml': conditional(GUIDE, '"v1"'), '/uk/b.xml': respond('gone', status=404)}) as server:
+        fetcher = EpgFetcher(logger, cache_dir=str(tmp_path / 'cache'), max_age=3600)
+        a_url, b_url = server.url + '/uk/a.xml', server.url + '/uk/b.xml'
+        resolved = fetcher.resolve({'BBCOne.uk': [b_url, a_url], 'BBCTwo.uk': [a_url], 'Other.uk': [a_url]})
+        # BBCTwo is listed but has no programmes, Other is not listed at all
+        assert list(resolved) == ['BBCOne.uk'] and len(resolved['BBCOne.uk']) == 2
+        assert server.hits == {'/uk/a.xml': 1, '/uk/b.xml': 1}
+
+        # served from the in-memory index while it is fresh
+        assert fetcher.programmes_for_channel(a_url, 'BBCTwo.uk') == []
+        assert fetcher.programmes_for_channel(a_url, 'Other.uk') is None
+        assert fetcher.programmes_for_channel(b_url, 'BBCOne.uk') is None
+        assert server.hits['/uk/a.xml'] == 1
+
+        # a new fetcher on the same cache dir revalidates and gets a 304, the cached copy is parsed
+        again = EpgFetcher(logger, cache_dir=str(tmp_path / 'cache'))
+        assert again.fetch_once(a_url)[1] == 'not_modified'
+        assert len(again.programmes_for_channel(a_url, 'BBCOne.uk')) == 2
+        assert server.hits['/uk/a.xml'] == 3
+
+
+def test_cached_guide_is_used_when_the_server_errors_or_drops_the_connection(tmp_path):
+    outages = []
+
+    def flaky(request):
+        # the guide first, then whatever outage the test is on
+        if not outages:
+            respond(GUIDE, content_type='application/xml', headers={'ETag': '"v1"'})(request)
+        elif outages[-1] == 'error':
+            respond('oops', status=500)(request)
+        else:
+            request.close_connection = True
+    with FixtureServer({'/uk/a.xml': flaky, '/uk/new.xml': flaky}) as server:
+        fetcher = EpgFetcher(logger, cache_dir=str(tmp_path / 'cache'))
+        xml_url = server.url + '/uk/a.xml'
+        xml_path, result = fetcher.fetch_once(xml_url)
+        assert result == 'fetched'
+        for outage in ('error', 'dropped'):
+            outages.append(outage)
+            assert fetcher.fetch_once(xml_url) == (xml_path, 'stale')
+            assert len(EpgFetcher(logger, cache_dir=str(tmp_path / 'cache')).programmes_for_channel(xml_url, 'BBCOne.uk')) == 2
+        # with nothing cached there is nothing to fall back on
+        assert fetcher.fetch_once(server.url + '/uk/new.xml') == (None, 'error')
+        outages.append('error')
+        assert fetcher.fetch_once(server.url + '/uk/new.xml') == (None, 'failed')
@@ -0,0 +1,47 @@
+import logging
+
+from utils.probe_cache import ProbeCache
+from utils.stream_probe import PROBE_DEAD, PROBE_FAILED, PROBE_FORBIDDEN, PROBE_OK, PROBE_UNAVAILABLE
+
+logger = logging.getLogger(__name__)
+
+
+def make_cache(tmp_path, **kwargs):
+    return ProbeCache(logger, path=str(tmp_path / 'probe_cache.sqlite'), **kwargs)
+
+
+def test_results_are_fresh_until_their_ttl(tmp_path):
+    cache = make_cache(tmp_path, ttl=3600, negative_ttl=60)
+    cache.store([('http://a', PROBE_OK), ('http://b', PROBE_DEAD)], 'uk')
+    found = cache.lookup(['http://a', 'http://b', 'http://c'], 'uk')
+    assert found['http://a']['fresh'] and found['http://a']['return_code'] == PROBE_OK
+    assert found['http://b']['fresh'] and found['http://b']['failures'] == 1
+    assert 'http://c' not in found
+    assert cache.lookup(['http://a'], 'us') == {}
+    assert cache.report()['hits'] == 2
+
+
+def test_failures_back_off_and_reset_on_success(tmp_path):
+    cache = make_cache(tmp_path, negative_ttl=60, max_backoff=200)
+    assert [cache.expiry(PROBE_DEAD, failures, 0) for failures in (1, 2, 3, 4)] == [60, 120, 200, 200]
+    for _ in range(3):
+        cache.store([('http://a', PROBE_FAILED)], 'uk')
+    assert cache.lookup(['http://a'], 'uk')['http://a']['failures'] == 3
+    cache.store([('http://a', PROBE_OK)], 'uk')
+    assert cache.lookup(['http://a'], 'uk')['http://a']['failures'] == 0
+
+
+def test_endpoint_and_infrastructure_failures_are_not_cached(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.store([('http://a', PROBE_OK)], 'uk')
+    cache.store([('http://a', PROBE_UNAVAILABLE), ('http://b', PROBE_FORBIDDEN), ('http://c', PROBE_UNAVAILABLE)], 'uk')
+    found = cache.lookup(['http://a', 'http://b', 'http://c'], 'uk')
+    assert list(found) == ['http://a'] and found['http://a']['return_code'] == PROBE_OK
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = make_cache(tmp_path, max_entries=2)
+    cache.store([('http://a', PROBE_OK), ('http://b', PROBE_OK)], 'uk')
+    cache.lookup(['http://a'], 'uk')
+    cache.store([('http://c', PROBE_OK)], 'uk')
+    assert set(cache.lookup(['http://a', 'http://b', 'http://c'], 'uk')) == {'http://a', 'http://c'}
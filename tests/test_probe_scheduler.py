@@ -0,0 +1,90 @@
+import logging
+import threading
+import time
+from collections import defaultdict
+
+from utils.probe_scheduler import ProbeScheduler, url_host
+from utils.stream_probe import PROBE_FORBIDDEN, PROBE_OK, PROBE_UNAVAILABLE
+
+logger = logging.getLogger(__name__)
+
+
+class RecordingProbe():
+    # probe_fn that sleeps per host and keeps track of how many probes overlap
+    def __init__(self, delays, codes=None):
+        self.delays = delays
+        self.codes = codes or {}
+        self.lock = threading.Lock()
+        self.in_flight = defaultdict(int)
+        self.peak = defaultdict(int)
+        self.finished = {}
+        self.calls = defaultdict(int)
+        self.started = time.monotonic()
+
+    def __call__(self, url):
+        host = url_host(url)
+        with self.lock:
+            self.in_flight[host] += 1
+            self.in_flight['*'] += 1
+            for key in (host, '*'):
+                self.peak[key] = max(self.peak[key], self.in_flight[key])
+            self.calls[url] += 1
+            calls = self.calls[url]
+        time.sleep(self.delays.get(host, 0))
+        with self.lock:
+            self.in_flight[host] -= 1
+            self.in_flight['*'] -= 1
+            self.finished[url] = time.monotonic() - self.started
+        code = self.codes.get(url, PROBE_OK)
+        if isinstance(code, Exception):
+            raise code
+        return code(calls) if callable(code) else code
+
+
+def streams(host, count):
+    return [{'url': f"http://{host}/{n}.m3u8"} for n in range(count)]
+
+
+def test_a_busy_host_does_not_hold_up_the_others():
+    probe = RecordingProbe({'slow.example': 0.3, 'fast.example': 0.01})
+    channel_streams = {'slow': streams('slow.example', 4), 'fast': streams('fast.example', 6)}
+    batches = []
+    ProbeScheduler(logger, probe, max_workers=3, per_host_limit=1, batch_size=10).run(channel_streams, batches.append)
+
+    assert probe.peak['slow.example'] == 1 and probe.peak['fast.example'] == 1 and probe.peak['*'] <= 3
+    # the fast host is done while the slow one is still on its first stream
+    assert max(t for url, t in probe.finished.items() if 'fast' in url) < 0.3
+    assert len(batches) == 1
+    assert sorted(index for index, _, _ in batches[0]['slow']) == [0, 1, 2, 3]
+    assert all(code == PROBE_OK for results in batches[0].values() for _, code, _ in results)
+
+
+def test_batches_limit_and_skipped_streams():
+    probe = RecordingProbe({})
+    channel_streams = {f"ch{n}": streams(f"h{n}.example", 2) for n in range(5)}
+    batches = []
+    ProbeScheduler(logger, probe, max_workers=4, per_host_limit=2, batch_size=2).run(
+        channel_streams, batches.append, limit=7, should_probe=lambda stream: not stream['url'].endswith('/1.m3u8'))
+    assert [sorted(batch) for batch in batches] == [['ch0', 'ch1'], ['ch2', 'ch3'], ['ch4']]
+    assert len(probe.calls) == 5
+
+
+def test_streams_handed_back_are_probed_again_and_errors_are_unavailable():
+    codes = {
+        'http://a.example/0.m3u8': lambda calls: PROBE_FORBIDDEN if calls == 1 else PROBE_OK,
+        'http://a.example/1.m3u8': PROBE_FORBIDDEN,
+        'http://a.example/2.m3u8': RuntimeError('boom'),
+    }
+    probe = RecordingProbe({}, codes)
+    batches = []
+
+    def on_batch(batch_results):
+        batches.append(dict(batch_results))
+        return [('a', index) for index, code, _ in batch_results['a'] if code == PROBE_FORBIDDEN]
+
+    ProbeScheduler(logger, probe, max_workers=2, per_host_limit=2, max_retries=2).run({'a': streams('a.example', 3)}, on_batch)
+    first = {index: code for index, code, _ in batches[0]['a']}
+    assert first == {0: PROBE_FORBIDDEN, 1: PROBE_FORBIDDEN, 2: PROBE_UNAVAILABLE}
+    assert sorted((index, code) for index, code, _ in batches[1]['a']) == [(0, PROBE_OK), (1, PROBE_FORBIDDEN)]
+    # stream 1 stays forbidden, retried until max_retries runs out
+    assert len(batches) == 3 and probe.calls['http://a.example/1.m3u8'] == 3
@@ -0,0 +1,125 @@
+import logging
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+pytest.importorskip("tv_detection_common")
+from tv_detection_common.models import Base, Recording, RecordingStatus, Schedule
+
+from utils import recording_scheduler
+from utils.database_connection import DatabaseConnection
+from utils.recording_scheduler import RecordingScheduler
+
+logger = logging.getLogger(__name__)
+
+
+class FakeCaptureEngine():
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, schedule_id):
+        self.submitted.append(schedule_id)
+
+
+@pytest.fixture
+def db_conn(tmp_path, monkeypatch):
+    monkeypatch.setenv('DB_URL', f"sqlite:///{tmp_path / 'recorder.db'}")
+    db_conn = DatabaseConnection(logger, test_conn=False)
+    Base.metadata.create_all(db_conn.engine)
+    yield db_conn
+    db_conn.engine.dispose()
+
+
+def add_schedules(db_conn, *start_times):
+    with db_conn.Session() as session:
+        schedules = [Schedule(start_time=start, end_time=start + timedelta(hours=1)) for start in start_times]
+        session.add_all(schedules)
+        session.commit()
+        return [schedule.id for schedule in schedules]
+
+
+def edit_schedule(db_conn, schedule_id, **fields):
+    with db_conn.Session() as session:
+        schedule = session.get(Schedule, schedule_id)
+        for name, value in fields.items():
+            setattr(schedule, name, value)
+        if recording_scheduler.CHANGED_COLUMN:
+            setattr(schedule, recording_scheduler.CHANGED_COLUMN, datetime.now(timezone.utc) + timedelta(seconds=1))
+        session.commit()
+
+
+def test_edits_and_new_rows_are_picked_up_between_full_reloads(db_conn):
+    if not recording_scheduler.CHANGED_COLUMN:
+        pytest.skip("Schedule has no updated_at column")
+    now = datetime.now(timezone.utc)
+    early, late, recorded = add_schedules(db_conn, now + timedelta(minutes=10), now + timedelta(hours=2), now + timedelta(hours=3))
+    engine = FakeCaptureEngine()
+    scheduler = RecordingScheduler(logger, db_conn, engine, pre_roll=30, grace=1800)
+    scheduler.refresh(now)
+    assert set(scheduler.start_times) == {early, late, recorded}
+
+    # moved earlier, into the pre-roll window
+    edit_schedule(db_conn, late, start_time=now + timedelta(seconds=10))
+    # recorded out of band, no longer upcoming
+    with db_conn.Session() as session:
+        session.add(Recording(schedule_id=recorded, status=RecordingStatus.RECORDING))
+        session.commit()
+    edit_schedule(db_conn, recorded)
+    (new,) = add_schedules(db_conn, now + timedelta(minutes=20))
+
+    later = now + timedelta(seconds=scheduler.refresh_interval)
+    scheduler.refresh(later)
+    assert scheduler.start_times[late] == now + timedelta(seconds=10)
+    assert new in scheduler.start_times and recorded not in scheduler.start_times
+
+    scheduler.dispatch_due(later)
+    assert engine.submitted == [late]
+    # the stale entry for late's old start time is skipped, not dispatched again
+    scheduler.dispatch_due(now + timedelta(minutes=25))
+    assert engine.submitted == [late, early, new]
+
+
+def test_rows_written_without_updated_at_still_come_in(db_conn):
+    if not recording_scheduler.CHANGED_COLUMN:
+        pytest.skip("Schedule has no updated_at column")
+    now = datetime.now(timezone.utc)
+    (stamped,) = add_schedules(db_conn, now + timedelta(minutes=10))
+    scheduler = RecordingScheduler(logger, db_conn, FakeCaptureEngine(), grace=300)
+    scheduler.refresh(now)
+    # a writer that leaves updated_at empty, as rows from before the column existed have it
+    with db_conn.Session() as session:
+        unstamped = Schedule(start_time=now + timedelta(minutes=20), end_time=now + timedelta(minutes=80))
+        session.add(unstamped)
+        session.flush()
+        session.query(Schedule).filter(Schedule.id == unstamped.id).update(
+            {recording_scheduler.CHANGED_COLUMN: None}, synchronize_session=False)
+        session.commit()
+        unstamped = unstamped.id
+    scheduler.refresh(now + timedelta(seconds=scheduler.refresh_interval))
+    assert set(scheduler.start_times) == {stamped, unstamped} and scheduler.watermark == unstamped
+
+    # picked up once, not on every refresh after
+    scheduler.start_times.pop(unstamped)
+    scheduler.refresh(now + timedelta(seconds=2 * scheduler.refresh_interval))
+    assert unstamped not in scheduler.start_times
+
+
+def test_without_an_updated_at_column_new_rows_still_come_in(db_conn, monkeypatch):
+    monkeypatch.setattr(recording_scheduler, 'CHANGED_COLUMN', None)
+    now = datetime.now(timezone.utc)
+    (first,) = add_schedules(db_conn, now + timedelta(minutes=10))
+    scheduler = RecordingScheduler(logger, db_conn, FakeCaptureEngine(), grace=300)
+    scheduler.refresh(now)
+    (second,) = add_schedules(db_conn, now + timedelta(minutes=20))
+    scheduler.refresh(now + timedelta(seconds=scheduler.refresh_interval))
+    assert set(scheduler.start_times) == {first, second} and scheduler.watermark == second
+
+
+def test_schedules_past_their_grace_are_dropped(db_conn):
+    now = datetime.now(timezone.utc)
+    stale, joinable = add_schedules(db_conn, now - timedelta(minutes=10), now - timedelta(minutes=2))
+    engine = FakeCaptureEngine()
+    scheduler = RecordingScheduler(logger, db_conn, engine, pre_roll=30, grace=300)
+    scheduler.refresh(now)
+    scheduler.dispatch_due(now)
+    assert engine.submitted == [joinable] and scheduler.seconds_until_next(now) == scheduler.refresh_interval
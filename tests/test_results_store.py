@@ -0,0 +1,66 @@
+import json
+import logging
+import time
+
+from utils import iptv_recorder
+from utils.iptv_recorder import IptvRecorder
+from utils.results_store import ResultsStore
+
+logger = logging.getLogger(__name__)
+
+
+def result(channel_id, url, status, tested_at, latency_ms=None):
+    return {'channel_id': channel_id, 'url': url, 'status': status, 'return_code': 0 if status == 'OK' else 3,
+            'latency_ms': latency_ms, 'vpn_endpoint': 'uk1.ovpn', 'tested_at': tested_at}
+
+
+def test_latest_results_good_streams_and_alternates(tmp_path):
+    store = ResultsStore(logger, path=str(tmp_path / 'results.sqlite'))
+    store.record_batch([
+        result('bbc', 'http://a/1', 'OK', 100, 900), result('bbc', 'http://a/1', 'FAIL', 200),
+        result('bbc', 'http://a/2', 'OK', 150, 300), result('bbc', 'http://a/3', 'OK', 160, 100),
+        result('itv', 'http://b/1', 'FAIL', 100),
+    ])
+    latest = {(r['channel_id'], r['url']): r['status'] for r in store.latest_results()}
+    assert latest == {('bbc', 'http://a/1'): 'FAIL', ('bbc', 'http://a/2'): 'OK', ('bbc', 'http://a/3'): 'OK',
+                      ('itv', 'http://b/1'): 'FAIL'}
+    assert {channel_id: r['url'] for channel_id, r in store.latest_good_streams().items()} == {'bbc': 'http://a/3'}
+    assert store.alternate_urls('http://a/1') == ['http://a/3', 'http://a/2']
+
+
+def test_compact_keeps_the_newest_and_only_vacuums_after_big_deletes(tmp_path):
+    store = ResultsStore(logger, path=str(tmp_path / 'results.sqlite'))
+    vacuums = []
+    store.conn.set_trace_callback(lambda statement: vacuums.append(statement) if statement == 'VACUUM' else None)
+    store.record_batch([result('bbc', 'http://a/1', 'OK', n) for n in range(10)])
+    store.record_batch([result('bbc', f"http://a/{n}", 'OK', 1) for n in range(2, 30)])
+
+    # 5 of 38 rows go, not worth rewriting the file
+    assert store.compact(keep_per_url=5) == 5 and vacuums == []
+    assert [r['tested_at'] for r in store.latest_results('bbc') if r['url'] == 'http://a/1'] == [9]
+    # everything tested before now goes
+    assert store.compact(older_than_days=time.time() / 86400 - 1) == 33 and vacuums == ['VACUUM']
+    assert store.compact() == 0 and vacuums == ['VACUUM']
+
+
+def test_a_reused_channels_file_gets_the_latest_results(tmp_path, monkeypatch):
+    monkeypatch.setattr(iptv_recorder, 'channel_file_path', lambda name: str(tmp_path / name))
+    (tmp_path / 'channels_with_streams.json').write_text(json.dumps({
+        'bbc': {'channel': {'id': 'bbc'}, 'streams': [{'url': 'http://a/1'}, {'url': 'http://a/2'}]},
+    }))
+
+    class CatalogCache():
+        def get(self, table, key):
+            return 'channels|streams'
+
+    recorder = IptvRecorder(logger)
+    recorder.channels_key, recorder.streams_key = 'channels', 'streams'
+    recorder.streams, recorder.id_to_name = [], {}
+    recorder.catalog_cache = CatalogCache()
+    recorder.results_store = ResultsStore(logger, path=str(tmp_path / 'results.sqlite'))
+    recorder.results_store.record_batch([result('bbc', 'http://a/2', 'OK', 1700000000)])
+
+    recorder.streams_for_channels()
+    streams = recorder.channels_with_streams['bbc']['streams']
+    assert streams[0] == {'url': 'http://a/1'}
+    assert streams[1] == {'url': 'http://a/2', 'connect_status': 'OK', 'connect_test_time': '20231114_2213'}
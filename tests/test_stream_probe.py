@@ -0,0 +1,102 @@
+import logging
+import socket
+import time
+
+from utils.stream_probe import (
+    PROBE_DEAD, PROBE_FAILED, PROBE_FORBIDDEN, PROBE_OK, PROBE_OUTCOMES, PROBE_UNAVAILABLE, StreamProbe, parse_playlist, probe_outcome
+)
+
+from .fixtures import FixtureServer, endless, respond
+
+logger = logging.getLogger(__name__)
+
+MASTER = """#EXTM3U
+#EXT-X-STREAM-INF:BANDWIDTH=2500000,CODECS="avc1.64001f,mp4a.40.2",RESOLUTION=1280x720
+hi/index.m3u8
+#EXT-X-STREAM-INF:CODECS="avc1.4d401e,mp4a.40.2",BANDWIDTH=800000,RESOLUTION=640x360
+lo/index.m3u8
+"""
+MEDIA = """#EXTM3U
+#EXT-X-TARGETDURATION:6
+#EXTINF:6.0,
+seg1.ts
+#EXTINF:6.0,
+seg2.ts
+"""
+
+
+def test_parse_playlist_keeps_quoted_commas_out_of_bandwidth():
+    kind, variants = parse_playlist(MASTER, 'http://host/live/master.m3u8')
+    assert kind == 'master'
+    assert sorted(variants) == [(800000, 'http://host/live/lo/index.m3u8'), (2500000, 'http://host/live/hi/index.m3u8')]
+
+
+def test_parse_playlist_media_and_not_a_playlist():
+    assert parse_playlist(MEDIA, 'http://host/a/index.m3u8') == ('media', ['http://host/a/seg1.ts', 'http://host/a/seg2.ts'])
+    assert parse_playlist('\ufeff' + MEDIA, 'http://host/a/index.m3u8')[0] == 'media'
+    assert parse_playlist('\x47\x00garbage', 'http://host/a') == (None, [])
+
+
+def test_master_is_followed_to_the_smallest_variant():
+    routes = {
+        '/live/master.m3u8': respond(MASTER, content_type='application/vnd.apple.mpegurl'),
+        '/live/lo/index.m3u8': respond(MEDIA),
+        '/live/lo/seg2.ts': respond(b'\x47' * 1880, content_type='video/mp2t'),
+    }
+    with FixtureServer(routes) as server:
+        probe = StreamProbe(logger, timeout=5, fetch_segment=True)
+        assert probe.check(server.url + '/live/master.m3u8') == PROBE_OK
+        assert server.hits == {'/live/master.m3u8': 1, '/live/lo/index.m3u8': 1, '/live/lo/seg2.ts': 1}
+
+
+def test_live_progressive_stream_is_answered_by_its_first_chunk():
+    with FixtureServer({'/stream': endless()}) as server:
+        probe = StreamProbe(logger, timeout=5, max_bytes=64 << 10)
+        start = time.monotonic()
+        assert probe.check(server.url + '/stream') == PROBE_OK
+        assert time.monotonic() - start < 3
+
+
+def test_trickling_stream_is_cut_off_at_the_deadline():
+    with FixtureServer({'/stream': endless(chunk=b'\x47' * 188, interval=0.05)}) as server:
+        probe = StreamProbe(logger, timeout=1, max_bytes=1 << 20, chunk_size=188)
+        start = time.monotonic()
+        return_code, body, _ = probe.get(server.url + '/stream')
+        assert return_code == PROBE_OK and 0 < len(body) < 1 << 20
+        assert time.monotonic() - start < 2.5
+
+
+def test_oversized_playlist_is_truncated_to_whole_lines():
+    media = '#EXTM3U\n' + ''.join(f'#EXTINF:6.0,\nsegment_{n:06d}.ts\n' for n in range(5000))
+    with FixtureServer({'/big.m3u8': respond(media)}) as server:
+        probe = StreamProbe(logger, timeout=5, max_bytes=4096)
+        return_code, kind, entries = probe.get_playlist(server.url + '/big.m3u8')
+        assert (return_code, kind) == (PROBE_OK, 'media')
+        assert entries and all(entry.endswith('.ts') for entry in entries)
+
+
+def test_status_codes_and_empty_bodies():
+    routes = {'/forbidden': respond('no', status=403), '/empty': respond(b'')}
+    with FixtureServer(routes) as server:
+        probe = StreamProbe(logger, timeout=5)
+        assert probe.check(server.url + '/forbidden') == PROBE_FORBIDDEN
+        assert probe.check(server.url + '/missing') == PROBE_DEAD
+        assert probe.check(server.url + '/empty') == PROBE_FAILED
+
+
+def test_unreachable_proxy_is_unavailable_not_a_failed_stream():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        closed_port = sock.getsockname()[1]
+    with FixtureServer({'/live.m3u8': respond(MEDIA)}) as server:
+        probe = StreamProbe(logger, timeout=5)
+        proxy_url = f'http://127.0.0.1:{closed_port}'
+        assert probe.check(server.url + '/live.m3u8', proxy_url) == PROBE_UNAVAILABLE
+        assert probe.check(server.url.replace('http://', 'https://') + '/live.m3u8', proxy_url) == PROBE_UNAVAILABLE
+        assert server.hits == {}
+
+
+def test_unknown_return_codes_are_labelled_other():
+    assert [probe_outcome(code) for code in (PROBE_OK, PROBE_FORBIDDEN, PROBE_DEAD)] == ['ok', 'forbidden', 'dead']
+    assert probe_outcome(None) == probe_outcome(-9) == 'other'
+    assert 'other' not in PROBE_OUTCOMES.values()
@@ -0,0 +1,200 @@
+import logging
+import multiprocessing
+import os
+import time
+from contextlib import contextmanager
+
+import pytest
+from sqlalchemy import create_engine
+
+from utils.iptv_recorder import IptvRecorder
+from utils.probe_cache import ProbeCache
+from utils.results_store import ResultsStore
+from utils.sweep_coordinator import DONE, FAILED, PENDING, SweepCoordinator, SweepLeaseLost, SweepWorker, shard_channels
+
+logger = logging.getLogger(__name__)
+
+COUNTRIES = ('GB', 'US', 'CA')
+
+
+def make_channels_with_streams(num_channels, streams_per_channel=2):
+    return {
+        f"Channel{i}.{COUNTRIES[i % len(COUNTRIES)].lower()}": {
+            'channel': {'id': f"Channel{i}", 'country': COUNTRIES[i % len(COUNTRIES)]},
+            'streams': [{'url': f"http://cdn{s}.test.invalid/{i}/index.m3u8"} for s in range(streams_per_channel)],
+        }
+        for i in range(num_channels)
+    }
+
+
+def make_engine(db_path):
+    # every worker process writes to the same SQLite file
+    return create_engine(f"sqlite:///{db_path}", connect_args={'timeout': 30})
+
+
+def expected_results(channels_with_streams):
+    return {(channel_id, stream['url']) for channel_id, entry in channels_with_streams.items() for stream in entry['streams']}
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / 'sweep.db')
+
+
+def test_shard_channels_is_stable_and_maps_countries():
+    channels_with_streams = make_channels_with_streams(30)
+    shards = shard_channels(channels_with_streams, buckets=2, country_map={'gb': 'uk'})
+    assert shards == shard_channels(channels_with_streams, buckets=2, country_map={'gb': 'uk'})
+    assert {country for country, _ in shards.values()} == {'uk', 'us', 'ca'}
+    assert sorted(channel_id for _, channel_ids in shards.values() for channel_id in channel_ids) == sorted(channels_with_streams)
+
+
+def test_claims_are_exclusive_and_fenced(db_path):
+    coordinator = SweepCoordinator(logger, make_engine(db_path), lease_ttl=1, max_attempts=3)
+    coordinator.plan('s1', {'a': ('uk', ['A']), 'b': ('us', ['B'])})
+    first = coordinator.claim('s1', 'w1')
+    second = coordinator.claim('s1', 'w2')
+    assert {first['shard_key'], second['shard_key']} == {'a', 'b'}
+    assert coordinator.claim('s1', 'w3') is None
+
+    time.sleep(1.1)
+    taken_over = coordinator.claim('s1', 'w3')
+    assert taken_over['attempts'] == 2
+    stale = first if taken_over['shard_key'] == first['shard_key'] else second
+    with pytest.raises(SweepLeaseLost):
+        coordinator.report(stale, [{'channel_id': 'A', 'url': 'http://x', 'status': 'OK'}])
+    with pytest.raises(SweepLeaseLost):
+        coordinator.complete(stale)
+    coordinator.complete(taken_over)
+
+
+def test_a_url_listed_twice_in_a_channel_is_reported_once(db_path):
+    coordinator = SweepCoordinator(logger, make_engine(db_path), lease_ttl=30, max_attempts=3)
+    coordinator.plan('s1', {'a': ('uk', ['A', 'B'])})
+    shard = coordinator.claim('s1', 'w1')
+    reported = coordinator.report(shard, [
+        {'channel_id': 'A', 'url': 'http://x', 'status': 'FAILED', 'tested_at': 1.0},
+        {'channel_id': 'A', 'url': 'http://x', 'status': 'OK', 'tested_at': 2.0},
+        {'channel_id': 'B', 'url': 'http://x', 'status': 'OK', 'tested_at': 1.0},
+    ])
+    assert reported == 2
+    # a later report of the same url replaces it rather than adding a row
+    coordinator.report(shard, [{'channel_id': 'A', 'url': 'http://x', 'status': 'DEAD', 'tested_at': 3.0}])
+    coordinator.complete(shard)
+    results = sorted((result['channel_id'], result['status']) for result in coordinator.results('s1'))
+    assert results == [('A', 'DEAD'), ('B', 'OK')]
+
+
+def test_failed_shard_is_retried_then_failed_for_good(db_path):
+    coordinator = SweepCoordinator(logger, make_engine(db_path), lease_ttl=30, max_attempts=2)
+    coordinator.plan('s1', {'a': ('uk', ['A'])})
+    coordinator.fail(coordinator.claim('s1', 'w1'), 'boom')
+    assert coordinator.progress('s1')['shards'] == {PENDING: 1}
+    coordinator.fail(coordinator.claim('s1', 'w2'), 'boom again')
+    assert coordinator.progress('s1')['shards'] == {FAILED: 1}
+    assert coordinator.claim('s1', 'w3') is None and coordinator.unfinished('s1') == 0
+
+
+def worker_main(db_path, sweep_id, worker_id, channels_with_streams, die_after_claim):
+    coordinator = SweepCoordinator(logging.getLogger(worker_id), make_engine(db_path), lease_ttl=2)
+
+    def sweep_fn(shard, report):
+        if die_after_claim:
+            # gone without a word, the lease has to expire
+            os._exit(1)
+        for channel_id in shard['channel_ids']:
+            time.sleep(0.01)
+            report([{'channel_id': channel_id, 'url': stream['url'], 'status': 'OK', 'return_code': 0}
+                    for stream in channels_with_streams[channel_id]['streams']])
+
+    SweepWorker(logging.getLogger(worker_id), coordinator, sweep_fn, worker_id=worker_id, poll_interval=1).run(sweep_id)
+
+
+def test_local_workers_cover_every_stream_once(db_path):
+    channels_with_streams = make_channels_with_streams(60)
+    coordinator = SweepCoordinator(logger, make_engine(db_path), lease_ttl=2)
+    coordinator.plan('s1', shard_channels(channels_with_streams, buckets=3))
+    # one of the workers dies holding its first shard
+    processes = [multiprocessing.Process(target=worker_main, args=(db_path, 's1', f"worker{i}", channels_with_streams, i == 0))
+                 for i in range(3)]
+    for process in processes:
+        process.start()
+    progress = coordinator.wait('s1', poll_interval=1)
+    for process in processes:
+        process.join(30)
+
+    assert progress['shards'] == {DONE: 9}
+    results = [(result['channel_id'], result['url']) for result in coordinator.results('s1')]
+    assert len(results) == len(set(results))
+    assert set(results) == expected_results(channels_with_streams)
+    assert 'worker0' not in {result['worker'] for result in coordinator.results('s1')}
+
+
+class FakeVpnSession():
+    def __init__(self, probed):
+        self.probed = probed
+        self.ovpn_file = 'uk1.ovpn'
+
+    def probe(self, url):
+        self.probed.append(url)
+        return 0
+
+    def rotate_if_needed(self):
+        return False
+
+
+class FakeVpnManager():
+    def __init__(self):
+        self.probed = []
+
+    @contextmanager
+    def session(self, country):
+        yield FakeVpnSession(self.probed)
+
+
+def make_recorder(tmp_path, name, channels_with_streams):
+    recorder = IptvRecorder(logging.getLogger(name))
+    recorder.channels_with_streams = channels_with_streams
+    recorder.vpn_manager = FakeVpnManager()
+    recorder.probe_cache = ProbeCache(recorder.logger, path=str(tmp_path / f"{name}_probe_cache.sqlite"))
+    recorder.results_store = ResultsStore(recorder.logger, path=str(tmp_path / f"{name}_results.sqlite"))
+    return recorder
+
+
+def test_sweep_reports_cached_streams_and_hands_back_unknown_channels(tmp_path, db_path):
+    channels_with_streams = make_channels_with_streams(12)
+    coordinator = SweepCoordinator(logger, make_engine(db_path), lease_ttl=30, max_attempts=3)
+    coordinator.plan('s1', shard_channels(channels_with_streams))
+
+    # a worker with an older catalog gives the shard with the channel it lacks back
+    partial = {channel_id: entry for channel_id, entry in channels_with_streams.items() if channel_id != 'Channel0.gb'}
+    stale_worker = SweepWorker(logger, coordinator, make_recorder(tmp_path, 'stale', partial).sweep_shard, worker_id='stale')
+    shard = coordinator.claim('s1', 'stale', countries=['gb'])
+    assert not stale_worker.run_shard(shard)
+    assert coordinator.progress('s1')['shards'][PENDING] == 3
+
+    # streams this worker probed recently are reported from its cache, not probed again
+    recorder = make_recorder(tmp_path, 'full', channels_with_streams)
+    cached_urls = set()
+    for entry in channels_with_streams.values():
+        url = entry['streams'][0]['url']
+        recorder.probe_cache.store([(url, 0)], entry['channel']['country'].lower())
+        cached_urls.add(url)
+    assert SweepWorker(logger, coordinator, recorder.sweep_shard, worker_id='full', poll_interval=1).run('s1') == 3
+
+    assert coordinator.progress('s1')['shards'] == {DONE: 3}
+    results = coordinator.results('s1')
+    assert {(result['channel_id'], result['url']) for result in results} == expected_results(channels_with_streams)
+    assert not set(recorder.vpn_manager.probed) & cached_urls
+    assert len(recorder.vpn_manager.probed) == len(results) - len(cached_urls)
+    assert {result['worker'] for result in results} == {'full'}
+
+
+def test_worker_alone_with_unknown_channels_fails_the_shard(tmp_path, db_path):
+    channels_with_streams = make_channels_with_streams(6)
+    coordinator = SweepCoordinator(logger, make_engine(db_path), lease_ttl=30, max_attempts=2)
+    coordinator.plan('s1', shard_channels(channels_with_streams))
+    partial = {channel_id: entry for channel_id, entry in channels_with_streams.items() if channel_id != 'Channel1.us'}
+    recorder = make_recorder(tmp_path, 'stale', partial)
+    SweepWorker(logger, coordinator, recorder.sweep_shard, worker_id='stale', poll_interval=1).run('s1')
+    assert coordinator.progress('s1')['shards'] == {DONE: 2, FAILED: 1}
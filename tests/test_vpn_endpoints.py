@@ -0,0 +1,30 @@
+import logging
+
+from vpn_endpoints import EndpointRegistry
+
+from .test_vpn_tunnels import write_endpoints
+
+logger = logging.getLogger(__name__)
+
+
+def make_registry(tmp_path, names):
+    configs_dir = tmp_path / 'configs'
+    configs_dir.mkdir()
+    write_endpoints(str(configs_dir), {name: [] for name in names})
+    registry = EndpointRegistry(logger, configs_dir=str(configs_dir), path=str(tmp_path / 'endpoints.sqlite'))
+    return registry, {name: next(f for f in registry.files('uk') if f.endswith(f"/{name}.nordvpn.com.udp.ovpn")) for name in names}
+
+
+def test_an_excluded_endpoint_is_not_drawn_even_without_stats(tmp_path):
+    # with no stats every endpoint scores the same prior, the draw is random but never the excluded one
+    registry, files = make_registry(tmp_path, ['uk1', 'uk2', 'uk3'])
+    assert {registry.choose('uk', exclude=files['uk1']) for _ in range(200)} == {files['uk2'], files['uk3']}
+    assert {registry.choose('uk', exclude=files['uk1'], avoid=[files['uk2']]) for _ in range(50)} == {files['uk3']}
+    # avoid is only a preference, exclude is not given up for it
+    assert {registry.choose('uk', exclude=files['uk1'], avoid=[files['uk2'], files['uk3']]) for _ in range(50)} <= {files['uk2'], files['uk3']}
+
+
+def test_the_only_endpoint_is_handed_back_even_when_excluded(tmp_path):
+    registry, files = make_registry(tmp_path, ['uk1'])
+    assert registry.choose('uk', exclude=files['uk1']) == files['uk1']
+    assert registry.choose('fr') is None
@@ -0,0 +1,81 @@
+import logging
+
+from utils.stream_probe import PROBE_FORBIDDEN, PROBE_OK, PROBE_UNAVAILABLE
+from utils.vpn_manager_util import VpnSession
+
+logger = logging.getLogger(__name__)
+
+
+def make_lease(lease_id, endpoint):
+    return {'lease_id': lease_id, 'proxy_url': f"http://127.0.0.1:81{endpoint:02d}",
+            'tunnel': {'tunnel_id': f"tun{endpoint}", 'ovpn_file': f"uk{endpoint}.ovpn"}}
+
+
+class FakeVpnManager():
+    # proxies in dead_proxies refuse connections, the way a tunnel's port does once the sidecar tore it down
+    def __init__(self, failover_endpoint=None):
+        self.logger = logger
+        self.calls = []
+        self.dead_proxies = set()
+        self.next_lease = 1
+        self.failover_endpoint = failover_endpoint
+
+    def lease(self, country, exclude=None, client=None):
+        self.calls.append(('lease', country, exclude))
+        lease = make_lease(f"lease{self.next_lease}", self.next_lease)
+        self.next_lease += 1
+        return lease
+
+    def failover(self, lease_id, tunnel_id=None):
+        self.calls.append(('failover', lease_id, tunnel_id))
+        return make_lease(lease_id, self.failover_endpoint) if self.failover_endpoint else None
+
+    def release(self, lease_id):
+        if lease_id:
+            self.calls.append(('release', lease_id))
+
+    def probe_stream_url(self, stream_url, proxy_url):
+        return PROBE_UNAVAILABLE if proxy_url in self.dead_proxies else PROBE_OK
+
+    def record_probe(self, ovpn_file, return_code):
+        pass
+
+    def flush_reports(self):
+        pass
+
+    def endpoint_report(self, country):
+        return {}
+
+
+def test_probes_through_a_dead_proxy_fail_the_lease_over_and_are_retried():
+    vpn_manager = FakeVpnManager(failover_endpoint=7)
+    with VpnSession(vpn_manager, 'UK') as session:
+        assert (session.lease_id, session.tunnel_id, session.ovpn_file) == ('lease1', 'tun1', 'uk1.ovpn')
+        vpn_manager.dead_proxies.add(session.proxy_url)
+        assert session.probe_batch(['http://a/1.m3u8', 'http://b/2.m3u8']) == [PROBE_OK, PROBE_OK]
+        # same lease, now on the tunnel the sidecar moved it to
+        assert ('failover', 'lease1', 'tun1') in vpn_manager.calls
+        assert (session.lease_id, session.tunnel_id, session.ovpn_file) == ('lease1', 'tun7', 'uk7.ovpn')
+        assert session.proxy_url == 'http://127.0.0.1:8107'
+    assert vpn_manager.calls[-1] == ('release', 'lease1')
+
+
+def test_rotate_if_needed_takes_a_new_lease_when_failover_has_none():
+    vpn_manager = FakeVpnManager()
+    with VpnSession(vpn_manager, 'UK') as session:
+        vpn_manager.dead_proxies.add(session.proxy_url)
+        assert session.probe('http://a/1.m3u8') == PROBE_UNAVAILABLE
+        assert session.rotate_if_needed()
+        assert vpn_manager.calls[1:] == [('failover', 'lease1', 'tun1'), ('lease', 'UK', None), ('release', 'lease1')]
+        assert (session.lease_id, session.tunnel_id) == ('lease2', 'tun2')
+        assert session.probe('http://a/1.m3u8') == PROBE_OK
+        assert not session.rotate_if_needed()
+
+
+def test_forbidden_rate_still_rotates_away_from_the_endpoint():
+    vpn_manager = FakeVpnManager()
+    vpn_manager.probe_stream_url = lambda stream_url, proxy_url: PROBE_FORBIDDEN if proxy_url.endswith('01') else PROBE_OK
+    with VpnSession(vpn_manager, 'UK', min_samples=2) as session:
+        assert session.probe_batch(['http://a/1.m3u8', 'http://b/2.m3u8']) == [PROBE_OK, PROBE_OK]
+        assert ('lease', 'UK', 'uk1.ovpn') in vpn_manager.calls
+        assert not any(call[0] == 'failover' for call in vpn_manager.calls)
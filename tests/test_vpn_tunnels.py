@@ -0,0 +1,176 @@
+import logging
+import os
+import socket
+import struct
+import threading
+
+import pytest
+import requests
+
+import vpn_tunnels
+from vpn_endpoints import EndpointRegistry
+from vpn_tunnels import DOWN, UP, TunnelPool, dns_query, parse_dns_response, resolve_through
+
+from .fixtures import FixtureServer, respond
+
+logger = logging.getLogger(__name__)
+
+FAKE_OPENVPN = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_openvpn')
+
+
+def free_port_range(count):
+    # a base port with count free ports above it, as far as we can tell
+    for _ in range(50):
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            base = sock.getsockname()[1]
+        if base + count < 65536 and all(port_is_free(base + offset) for offset in range(count)):
+            return base
+    raise RuntimeError('no free port range')
+
+
+def port_is_free(port):
+    with socket.socket() as sock:
+        try:
+            sock.bind(('127.0.0.1', port))
+            return True
+        except OSError:
+            return False
+
+
+def write_endpoints(configs_dir, endpoints):
+    # endpoints: {'uk1': ['up_after 0.1'], ...}
+    for name, directives in endpoints.items():
+        with open(os.path.join(configs_dir, f"{name}.nordvpn.com.udp.ovpn"), 'w') as outfile:
+            outfile.write(''.join(f"# fake {directive}\n" for directive in directives) + 'client\n')
+
+
+@pytest.fixture
+def make_pool(tmp_path, monkeypatch):
+    monkeypatch.setattr(vpn_tunnels, 'OPENVPN_BIN', FAKE_OPENVPN)
+    monkeypatch.setattr(vpn_tunnels, 'PROXY_BASE_PORT', free_port_range(4))
+    pools = []
+
+    def make(endpoints, **kwargs):
+        configs_dir = tmp_path / 'configs'
+        configs_dir.mkdir(exist_ok=True)
+        write_endpoints(str(configs_dir), endpoints)
+        registry = EndpointRegistry(logger, configs_dir=str(configs_dir), path=str(tmp_path / 'stats' / 'endpoints.sqlite'))
+        kwargs.setdefault('max_tunnels', 4)
+        kwargs.setdefault('standby_counts', {})
+        pool = TunnelPool(logger, str(tmp_path / 'auth.txt'), registry, bind_device=False, **kwargs)
+        pools.append(pool)
+        return pool
+
+    yield make
+    for pool in pools:
+        pool.stop_all()
+
+
+def test_dns_query_and_response_round_trip():
+    query = dns_query('cdn.example.com', 1, 0x1234)
+    # header, name with a compression pointer back to the question, A record
+    answer = (struct.pack('>HHHHHH', 0x1234, 0x8180, 1, 2, 0, 0) + query[12:]
+              + b'\xc0\x0c' + struct.pack('>HHIH', 5, 1, 60, 6) + b'\x03cdn\xc0\x0c'
+              + b'\xc0\x0c' + struct.pack('>HHIH', 1, 1, 60, 4) + socket.inet_aton('203.0.113.7'))
+    assert parse_dns_response(answer, 0x1234) == [(socket.AF_INET, '203.0.113.7')]
+    with pytest.raises(ValueError):
+        parse_dns_response(answer, 0x4321)
+    nxdomain = struct.pack('>HHHHHH', 0x1234, 0x8183, 1, 0, 0, 0) + query[12:]
+    assert parse_dns_response(nxdomain, 0x1234) == []
+
+
+def test_resolve_through_asks_the_given_server():
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.bind(('127.0.0.1', 0))
+    asked = []
+
+    def serve():
+        data, client = server.recvfrom(512)
+        asked.append(data)
+        query_id = struct.unpack('>H', data[:2])[0]
+        server.sendto(struct.pack('>HHHHHH', query_id, 0x8180, 1, 1, 0, 0) + data[12:]
+                      + b'\xc0\x0c' + struct.pack('>HHIH', 1, 1, 60, 4) + socket.inet_aton('198.51.100.9'), client)
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    with server:
+        assert resolve_through('geo.example.net', [('127.0.0.1', server.getsockname()[1])], timeout=2) == \
+            [(socket.AF_INET, '198.51.100.9')]
+    assert b'\x03geo\x07example\x03net\x00' in asked[0]
+
+
+def test_lease_brings_a_tunnel_up_and_proxies_through_it(make_pool):
+    pool = make_pool({'uk1': ['up_after 0.2', 'dns 10.8.0.1']})
+    lease_id, info = pool.lease('uk', client='test', wait=5)
+    assert info['state'] == UP and info['dns_servers'] == ['10.8.0.1', '10.8.0.2']
+    assert info['connect_secs'] is not None and info['leases'] == 1
+
+    # bound to loopback only
+    with socket.socket() as sock:
+        assert sock.connect_ex(('127.0.0.1', info['proxy_port'])) == 0
+    tunnel = pool.tunnels[info['tunnel_id']]
+    assert tunnel.proxy.server_address[0] == '127.0.0.1'
+
+    with FixtureServer({'/index.m3u8': respond('#EXTM3U\n')}) as server:
+        proxies = {'http': f"http://127.0.0.1:{info['proxy_port']}"}
+        response = requests.get(server.url + '/index.m3u8', proxies=proxies, timeout=5)
+        assert response.status_code == 200 and response.text == '#EXTM3U\n'
+    assert pool.release(lease_id) and not pool.release(lease_id)
+
+
+def test_a_bound_proxy_never_resolves_outside_the_tunnel(make_pool, monkeypatch):
+    pool = make_pool({'uk1': ['up_after 0.1']})
+    _, info = pool.lease('uk', wait=5)
+    proxy = pool.tunnels[info['tunnel_id']].proxy
+    proxy.bind_device = True
+    monkeypatch.setattr(vpn_tunnels, 'TUNNEL_DNS_SERVERS', [])
+    monkeypatch.setattr(socket, 'getaddrinfo', lambda *args, **kwargs: pytest.fail('resolved outside the tunnel'))
+    with pytest.raises(OSError, match='no DNS server'):
+        proxy.resolve('cdn.example.com')
+    assert proxy.resolve('192.0.2.1') == [(socket.AF_INET, '192.0.2.1')]
+
+
+def test_auth_failure_goes_down_and_counts_against_the_endpoint(make_pool):
+    pool = make_pool({'uk1': ['auth_failed']})
+    _, info = pool.lease('uk', wait=5)
+    assert info['state'] == DOWN
+    assert pool.registry.report('uk')['uk1.nordvpn.com.udp.ovpn']['connect_failures'] > 0
+
+
+def test_failover_moves_the_lease_to_another_endpoint(make_pool):
+    pool = make_pool({'uk1': ['up_after 0.1'], 'uk2': ['up_after 0.1']})
+    lease_id, first = pool.lease('uk', wait=5)
+    _, second = pool.failover(lease_id, wait=5)
+    assert second['ovpn_file'] != first['ovpn_file'] and second['state'] == UP
+    assert pool.leases[lease_id] == second['tunnel_id']
+    assert pool.tunnels[first['tunnel_id']].leases == {}
+
+
+def test_leases_on_a_tunnel_that_goes_down_move_to_another_endpoint(make_pool, monkeypatch):
+    pool = make_pool({'uk1': ['up_after 0.1', 'down_after 0.3'], 'uk2': ['up_after 0.1']})
+    uk1 = [path for path in pool.registry.files('uk') if path.endswith('uk1.nordvpn.com.udp.ovpn')][0]
+    lease_id, first = pool.lease('uk', ovpn_file=uk1, wait=5)
+    dead = pool.tunnels[first['tunnel_id']]
+    assert first['state'] == UP
+    dead.process.wait(5)
+
+    # the dead tunnel is stopped after the pool lock is let go
+    stopped_unlocked = []
+    stop = dead.stop
+
+    def watch_stop():
+        checker = threading.Thread(target=lambda: stopped_unlocked.append(pool.lock.acquire(timeout=1) and not pool.lock.release()))
+        checker.start()
+        checker.join()
+        stop()
+    monkeypatch.setattr(dead, 'stop', watch_stop)
+
+    pool.check_tunnels()
+    moved = pool.tunnels[pool.leases[lease_id]]
+    assert moved.ovpn_file.endswith('uk2.nordvpn.com.udp.ovpn') and lease_id in moved.leases
+    assert first['tunnel_id'] not in pool.tunnels and stopped_unlocked == [True]
+
+    # the holder failing over from the dead tunnel is told where its lease went
+    _, info = pool.failover(lease_id, wait=5, tunnel_id=first['tunnel_id'])
+    assert info['tunnel_id'] == moved.id and info['state'] == UP
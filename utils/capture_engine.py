@@ -0,0 +1,562 @@
+from tv_detection_common.models import Schedule, Recording, RecordingStatus
+from collections import deque
+from datetime import datetime, timezone
+import os
+import re
+import shutil
+import subprocess
+import threading
+import time
+from .capture_output import FfmpegProgress, PostProcessor, dir_bytes
+from .metrics import REGISTRY
+from .stream_probe import PROBE_FORBIDDEN
+
+RECORDINGS_DIR = os.getenv("RECORDINGS_DIR", "/mnt/recordings")
+
+RECORDINGS = REGISTRY.counter('iptv_recordings_total', 'Finished recordings by status', ('status',))
+BYTES_WRITTEN = REGISTRY.counter('iptv_recording_bytes_total', 'Bytes written by ffmpeg captures')
+FAILOVERS = REGISTRY.counter('iptv_recording_failovers_total', 'Mid-recording source switches by reason and action', ('reason', 'action'))
+FAILOVER_SECONDS = REGISTRY.histogram('iptv_recording_failover_seconds', 'Stall detected to data flowing from the new source')
+GAP_SECONDS = REGISTRY.histogram('iptv_recording_gap_seconds', 'Last data from the old source to first data from the new one')
+
+# written to the Recording row when the model has them, otherwise summarised in error_message
+FAILOVER_COLUMNS = tuple(name for name in ('failover_count', 'failover_latency_secs', 'gap_secs') if hasattr(Recording, name))
+
+
+def parse_country_caps(caps_str):
+    # "uk:2,ca:1" -> {'uk': 2, 'ca': 1}
+    caps = {}
+    for part in (caps_str or '').split(','):
+        if ':' in part:
+            country, cap = part.split(':', 1)
+            caps[country.strip().lower()] = int(cap)
+    return caps
+
+
+def as_utc(dt):
+    # naive datetimes from the DB are UTC
+    return dt.replace(tzinfo=timezone.utc) if dt.tzinfo is None else dt
+
+
+def safe_filename(text):
+    return re.sub(r'[^\w.+-]+', '_', text or '').strip('_')
+
+
+class CaptureEngine():
+    # Runs scheduled recordings as ffmpeg -c copy processes.  submit() only queues a
+    # schedule, a supervisor thread starts captures while there is room under
+    # max_recordings and the per-VPN-country caps, polls the running processes
+    # without blocking on any of them, and writes Recording status changes to the
+    # DB in one batch per flush_interval.  Geo-blocked channels are recorded
+    # through a tunnel leased from the VPN sidecar for the length of the capture.
+    # ffmpeg writes segment_secs long segments into a directory per recording,
+    # so whatever was captured before a failure is kept, and the post-processor
+    # joins them into one file once the capture ends.  A capture only starts if
+    # its projected size fits in the free space left after the running
+    # captures and remuxes, otherwise it waits its turn like a capped one.
+    # A capture whose ffmpeg makes no progress and writes nothing for
+    # stall_secs, or exits before the programme ends, fails over: to a fresh
+    # VPN endpoint on a first 403, otherwise to the channel's next best stream
+    # from alternate_urls(url), with a fresh endpoint again once the list
+    # wraps.  Sources that die right away are retried with a growing delay.
+    # Each source writes its own run of segments, so the remux stitches them
+    # into one recording.
+    def __init__(self, logger, db_conn, vpn_manager=None, max_recordings=None, country_caps=None, recordings_dir=None, flush_interval=5,
+                 segment_secs=None, bytes_per_sec=None, disk_reserve=None, post_processor=None, alternate_urls=None,
+                 stall_secs=None, max_failovers=None):
+        self.logger = logger
+        self.db_conn = db_conn
+        self.vpn_manager = vpn_manager
+        self.max_recordings = max_recordings or int(os.getenv("MAX_RECORDINGS", "4"))
+        self.country_caps = country_caps if country_caps is not None else parse_country_caps(os.getenv("VPN_COUNTRY_CAPS"))
+        self.recordings_dir = recordings_dir or RECORDINGS_DIR
+        self.flush_interval = flush_interval
+        self.segment_secs = segment_secs or int(os.getenv("SEGMENT_SECS", "60"))
+        # 1MB/s is an 8Mbit/s HD stream, running captures are projected at their own rate
+        self.bytes_per_sec = bytes_per_sec or int(os.getenv("RECORDING_BYTES_PER_SEC", "1000000"))
+        self.disk_reserve = disk_reserve if disk_reserve is not None else int(os.getenv("DISK_RESERVE_BYTES", str(5 << 30)))
+        self.post_processor = post_processor or PostProcessor(self.logger)
+        self.alternate_urls = alternate_urls
+        self.stall_secs = stall_secs or int(os.getenv("STALL_SECS", "20"))
+        self.max_failovers = max_failovers if max_failovers is not None else int(os.getenv("MAX_FAILOVERS", "10"))
+        self.pending = deque()  # schedule ids waiting for a slot
+        self.pending_ids = set()
+        self.active = {}  # recording id -> capture info
+        self.finished = deque()  # post-processing jobs the post-processor had no room for yet
+        self.disk_held = set()  # schedule ids waiting for disk space, to log it once
+        self.status_updates = {}  # recording id -> fields to set
+        self.last_flush = time.monotonic()
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.supervisor = None
+        REGISTRY.gauge('iptv_recordings_active', 'Recordings in progress', callback=lambda: len(self.active))
+        REGISTRY.gauge('iptv_recordings_pending', 'Recordings waiting for a slot', callback=lambda: len(self.pending))
+        REGISTRY.gauge('iptv_recordings_disk_free_bytes', 'Free space under the recordings dir', callback=self.free_bytes)
+
+    def start(self):
+        self.reconcile_interrupted()
+        self.post_processor.start()
+        self.supervisor = threading.Thread(target=self.supervise, daemon=True)
+        self.supervisor.start()
+
+    def reconcile_interrupted(self):
+        # a RECORDING row at startup belongs to a recorder that died mid capture, and
+        # the schedule is never picked up again while it has a recording
+        with self.db_conn.Session() as session:
+            stale = session.query(Recording).filter(Recording.status == RecordingStatus.RECORDING).all()
+            for recording in stale:
+                recording.status = RecordingStatus.FAILED
+                recording.error_message = 'recorder restarted during the recording'
+                recording.completed_at = datetime.now(timezone.utc)
+            session.commit()
+        if stale:
+            RECORDINGS.inc(len(stale), status='failed')
+            self.logger.info(f"marked [{len(stale)}] interrupted recordings as failed")
+
+    def stop(self, kill_after=10):
+        # segments of interrupted captures stay on disk under their recording's
+        # directory, and every capture still running or waiting for its remux gets
+        # a FAILED status pointing at them
+        self.stopping.set()
+        if self.supervisor:
+            self.supervisor.join()
+        with self.lock:
+            interrupted = self.active
+            self.active = {}
+            finished = list(self.finished)
+            self.finished.clear()
+        for capture in interrupted.values():
+            if capture.get('process'):
+                capture['process'].terminate()
+        for recording_id, capture in interrupted.items():
+            if capture.get('process'):
+                try:
+                    capture['process'].wait(kill_after)
+                except subprocess.TimeoutExpired:
+                    capture['process'].kill()
+                    capture['process'].wait()
+            self.release_tunnel(capture)
+            RECORDINGS.inc(status='failed')
+            with self.lock:
+                self.queue_status(recording_id, status=RecordingStatus.FAILED, error_message='recorder shut down',
+                                  file_path=capture['segment_dir'], completed_at=datetime.now(timezone.utc))
+        for job in finished:
+            self.post_processor.finish(job, job['segment_dir'], 'recorder shut down before post-processing')
+        self.post_processor.stop()
+        self.flush_status_updates()
+
+    def submit(self, schedule_id):
+        with self.lock:
+            if schedule_id in self.pending_ids or any(c['schedule_id'] == schedule_id for c in self.active.values()):
+                return False
+            self.pending.append(schedule_id)
+            self.pending_ids.add(schedule_id)
+            return True
+
+    def is_tracked(self, schedule_id):
+        with self.lock:
+            return schedule_id in self.pending_ids or any(c['schedule_id'] == schedule_id for c in self.active.values())
+
+    def active_count(self, country=None):
+        if country is None:
+            return len(self.active)
+        return sum(1 for capture in self.active.values() if capture['country'] == country)
+
+    def supervise(self):
+        while not self.stopping.is_set():
+            try:
+                self.poll()
+            except Exception as e:
+                self.logger.error(f"capture supervisor error: {e}")
+            self.stopping.wait(1)
+
+    def poll(self):
+        with self.lock:
+            self.count_bytes()
+            self.check_stalls()
+            relaunches, exited = self.collect_ended()
+            self.hand_off_finished()
+        # ffmpeg launches, sidecar calls, DB reads and lease requests, without holding
+        # up submit() and progress().  Only this thread changes self.active.
+        self.reap_finished(relaunches, exited)
+        self.start_pending()
+        if time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush_status_updates()
+
+    def count_bytes(self):
+        # output growth since the last poll, a stat per recording
+        now = time.monotonic()
+        for capture in self.active.values():
+            size = dir_bytes(capture['segment_dir'])
+            if size > capture['bytes']:
+                BYTES_WRITTEN.inc(size - capture['bytes'])
+                capture['bytes'] = size
+                capture['last_growth'] = now
+
+    def last_activity(self, capture):
+        return max(capture['progress'].last_progress, capture['last_growth'])
+
+    def check_stalls(self):
+        now = time.monotonic()
+        for recording_id, capture in self.active.items():
+            failover = capture.get('failover')
+            if failover and not capture.get('relaunch_at') and capture['progress'].out_secs is not None:
+                # the new source is flowing, progress is still the old ffmpeg's until the relaunch
+                flowing = capture['progress'].last_progress
+                failover['latency_secs'] = round(flowing - failover['detected'], 1)
+                failover['gap_secs'] = round(flowing - failover['last_activity'], 1)
+                FAILOVER_SECONDS.observe(failover['latency_secs'])
+                GAP_SECONDS.observe(failover['gap_secs'])
+                self.logger.info(f"recording {recording_id} flowing again after {failover['latency_secs']}s, "
+                                 f"{failover['gap_secs']}s gap")
+                capture['failover'] = None
+            if capture.get('relaunch_at') or capture['process'].poll() is not None:
+                continue
+            if capture.get('stalled_at'):
+                # still there after a terminate
+                if now - capture['stalled_at'] > 5:
+                    capture['process'].kill()
+            elif now - self.last_activity(capture) > self.stall_secs:
+                self.logger.info(f"recording {recording_id} stalled for {now - self.last_activity(capture):.0f}s on {capture['url']}")
+                capture['stalled_at'] = now
+                capture['process'].terminate()
+
+    def collect_ended(self):
+        # captures whose delayed relaunch is due, and (recording id, capture, return code) for those whose ffmpeg exited
+        relaunches, exited = [], []
+        now = time.monotonic()
+        for recording_id, capture in self.active.items():
+            if capture.get('relaunch_at'):
+                if now >= capture['relaunch_at']:
+                    capture['relaunch_at'] = None
+                    relaunches.append(capture)
+                continue
+            return_code = capture['process'].poll()
+            if return_code is not None:
+                exited.append((recording_id, capture, return_code))
+        return relaunches, exited
+
+    def reap_finished(self, relaunches, exited):
+        # the recording's status is set once its segments are remuxed, a failed
+        # capture is remuxed too so the part that was recorded is kept
+        for capture in relaunches:
+            self.launch(capture)
+        for recording_id, capture, return_code in exited:
+            capture['progress'].join(5)
+            if self.should_fail_over(capture, return_code):
+                self.fail_over(recording_id, capture, return_code)
+                continue
+            capture['bytes'] = dir_bytes(capture['segment_dir'])
+            self.release_tunnel(capture)
+            if return_code == 0 and not capture.get('stalled_at'):
+                self.logger.info(f"recording {recording_id} captured, [{capture['bytes']}] bytes")
+                error = None
+            else:
+                self.logger.error(f"recording {recording_id} failed with ffmpeg return code {return_code}")
+                error = capture['progress'].tail() or f"ffmpeg exited with {return_code}"
+            with self.lock:
+                del self.active[recording_id]
+                self.finished.append({
+                    'segment_dir': capture['segment_dir'],
+                    'output_file': capture['output_file'],
+                    'bytes': capture['bytes'],
+                    'on_done': lambda file_path, remux_error, recording_id=recording_id, error=error, failovers=capture['failovers']:
+                        self.post_processed(recording_id, file_path, error or remux_error, failovers),
+                })
+
+    def should_fail_over(self, capture, return_code):
+        # ffmpeg exits 0 at -t, earlier than that the source stopped
+        remaining = capture['deadline'] - time.monotonic()
+        return (remaining > max(self.stall_secs, 5) and not self.stopping.is_set()
+                and len(capture['failovers']) < self.max_failovers)
+
+    def fail_over(self, recording_id, capture, return_code):
+        # called without the lock, the sidecar's failover can wait for a tunnel to come up;
+        # the capture's new source and lease are swapped in under it
+        stalled_at = capture.get('stalled_at')
+        detected = stalled_at or time.monotonic()
+        forbidden = '403' in (capture['progress'].tail() or '')
+        reason = 'forbidden' if forbidden else 'stalled' if stalled_at else 'exited'
+        if forbidden:
+            if self.vpn_manager and capture['ovpn_file']:
+                self.vpn_manager.record_probe(capture['ovpn_file'], PROBE_FORBIDDEN)
+        urls = capture['urls']
+        new_endpoint_first = forbidden and capture['lease_id'] and not capture.get('endpoint_changed')
+        next_index = capture['url_index'] if new_endpoint_first else (capture['url_index'] + 1) % len(urls)
+        action = 'next_stream' if next_index != capture['url_index'] else 'same_stream'
+        endpoint_changed = next_index == capture['url_index'] and capture.get('endpoint_changed')
+        lease = None
+        if capture['lease_id'] and (new_endpoint_first or next_index == 0):
+            self.credit_endpoint(capture)
+            lease = self.vpn_manager.failover(capture['lease_id'], capture['tunnel_id'])
+            if lease:
+                action = 'new_endpoint' if action == 'same_stream' else 'next_stream_new_endpoint'
+        FAILOVERS.inc(reason=reason, action=action)
+        # a source that ran for less than stall_secs waits 1, 2, 4.. up to 30s before the next one starts
+        quick_failures = capture.get('quick_failures', 0) + 1 if time.monotonic() - capture['launched'] < self.stall_secs else 0
+        delay = min(2 ** (quick_failures - 1), 30) if quick_failures else 0
+        with self.lock:
+            capture.pop('stalled_at', None)
+            capture['endpoint_changed'] = endpoint_changed
+            if lease:
+                capture.update(lease_id=lease['lease_id'], proxy_url=lease['proxy_url'], tunnel_id=lease['tunnel'].get('tunnel_id'),
+                               ovpn_file=lease['tunnel'].get('ovpn_file'), endpoint_changed=True)
+            capture['failovers'].append({'reason': reason, 'action': action, 'url': urls[next_index],
+                                         'latency_secs': None, 'gap_secs': None})
+            # latency and gap land in the failovers entry once the new source flows, measured
+            # from the first failure when several sources fail in a row
+            pending = capture['failover']
+            capture['failover'] = capture['failovers'][-1]
+            capture['failover'].update(detected=pending['detected'] if pending else detected,
+                                       last_activity=pending['last_activity'] if pending else self.last_activity(capture))
+            capture['url_index'] = next_index
+            capture['part'] += 1
+            capture['quick_failures'] = quick_failures
+            if delay:
+                capture['relaunch_at'] = time.monotonic() + delay
+        self.logger.info(f"recording {recording_id} failing over ({reason}, {action}) to {urls[next_index]}"
+                         + (f" in {delay}s" if delay else ""))
+        if not delay:
+            self.launch(capture)
+
+    def launch(self, capture):
+        # ffmpeg for the capture's current source and the rest of the programme, into the next run of segments.
+        # Called without the lock, the new process is swapped in under it.
+        url = capture['urls'][capture['url_index']]
+        remaining = max(capture['deadline'] - time.monotonic(), 1)
+        cmd = ["ffmpeg", "-nostdin", "-y"]
+        if capture['proxy_url']:
+            cmd += ["-http_proxy", capture['proxy_url']]
+        cmd += [
+            "-i", url,
+            "-t", str(int(remaining)),
+            "-c", "copy",
+            "-f", "segment",
+            "-segment_time", str(self.segment_secs),
+            "-segment_format", "mpegts",
+            "-reset_timestamps", "0",
+            os.path.join(capture['segment_dir'], f"{capture['part']:03d}_%05d.ts")
+        ]
+        process = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        progress = FfmpegProgress(process.stderr, capture['log_path']).start()
+        with self.lock:
+            capture.update(url=url, process=process, progress=progress)
+            capture['launched'] = capture['last_growth'] = time.monotonic()
+
+    def hand_off_finished(self):
+        # the post-processing queue is bounded, whatever does not fit waits for the next poll
+        while self.finished and self.post_processor.submit(self.finished[0]):
+            self.finished.popleft()
+
+    def post_processed(self, recording_id, file_path, error, failovers=()):
+        RECORDINGS.inc(status='failed' if error else 'completed')
+        if error:
+            self.logger.error(f"recording {recording_id} failed, kept {file_path}: {error[-200:]}")
+            fields = {'status': RecordingStatus.FAILED, 'error_message': error}
+        else:
+            self.logger.info(f"recording {recording_id} completed: {file_path}")
+            fields = {'status': RecordingStatus.COMPLETED}
+        if failovers:
+            summary = {
+                'failover_count': len(failovers),
+                'failover_latency_secs': round(sum(f['latency_secs'] or 0 for f in failovers), 1),
+                'gap_secs': round(sum(f['gap_secs'] or 0 for f in failovers), 1),
+            }
+            fields.update({name: summary[name] for name in FAILOVER_COLUMNS})
+            if len(FAILOVER_COLUMNS) < len(summary):
+                note = (f"{summary['failover_count']} failovers, {summary['failover_latency_secs']}s failover latency, "
+                        f"{summary['gap_secs']}s gap")
+                fields['error_message'] = f"{note}\n{error}" if error else note
+        with self.lock:
+            self.queue_status(recording_id, file_path=file_path, completed_at=datetime.now(timezone.utc), **fields)
+
+    def disk_usage(self):
+        try:
+            return shutil.disk_usage(self.recordings_dir)
+        except OSError:
+            return None
+
+    def free_bytes(self):
+        usage = self.disk_usage()
+        return usage.free if usage else None
+
+    def committed_bytes(self):
+        # what running captures are still expected to write, plus the second copy each queued remux makes
+        committed = self.post_processor.pending_bytes() + sum(job['bytes'] for job in self.finished)
+        now = time.monotonic()
+        for capture in self.active.values():
+            elapsed = now - capture['started']
+            rate = capture['bytes'] / elapsed if elapsed > 60 and capture['bytes'] else self.bytes_per_sec
+            committed += max(capture['duration'] - elapsed, 0) * rate
+        return committed
+
+    def admit(self, schedule_id, duration):
+        # True if the capture fits now, None to hold it until space frees up, False if it never will
+        projected = duration * self.bytes_per_sec
+        usage = self.disk_usage()
+        if usage is None:
+            # a missing or unreadable mount says nothing about the size of the disk
+            if schedule_id not in self.disk_held:
+                self.disk_held.add(schedule_id)
+                self.logger.error(f"holding schedule {schedule_id}: cannot read disk usage of {self.recordings_dir}")
+            return None
+        available = usage.free - self.disk_reserve
+        if projected <= available - self.committed_bytes():
+            self.disk_held.discard(schedule_id)
+            return True
+        if projected > usage.total - self.disk_reserve:
+            return False
+        if schedule_id not in self.disk_held:
+            self.disk_held.add(schedule_id)
+            self.logger.info(f"holding schedule {schedule_id}: needs ~{projected / 1e9:.1f}GB, "
+                             f"{available / 1e9:.1f}GB free with {self.committed_bytes() / 1e9:.1f}GB committed")
+        return None
+
+    def start_pending(self):
+        # walk the queue once, anything held back by a cap keeps its place.  Only
+        # the supervisor thread changes self.active, so it reads it without the lock
+        for _ in range(len(self.pending)):
+            if len(self.active) >= self.max_recordings:
+                return
+            schedule_id = self.pending.popleft()
+            try:
+                started = self.start_capture(schedule_id)
+            except Exception as e:
+                self.logger.error(f"could not start schedule {schedule_id}: {e}")
+                started = False
+            if started is None:
+                self.pending.append(schedule_id)
+            else:
+                with self.lock:
+                    self.pending_ids.discard(schedule_id)
+
+    def start_capture(self, schedule_id):
+        # True if started, False if the schedule is gone or already recorded, None if capped
+        with self.db_conn.Session() as session:
+            schedule = session.get(Schedule, schedule_id)
+            if not schedule or schedule.recording:
+                return False
+            channel = schedule.channel
+            program = schedule.program
+            country = channel.vpn_country.lower() if channel.geo_blocked and channel.vpn_country else None
+            cap = self.country_caps.get(country)
+            if country and cap is not None and self.active_count(country) >= cap:
+                return None
+
+            now = datetime.now(timezone.utc)
+            duration = (as_utc(schedule.end_time) - max(as_utc(schedule.start_time), now)).total_seconds()
+            if duration < 1:
+                self.logger.info(f"schedule {schedule_id} already over, skipping")
+                self.disk_held.discard(schedule_id)
+                return False
+
+            admitted = self.admit(schedule_id, duration)
+            if admitted is None:
+                return None
+
+            lease = None
+            if country and admitted:
+                lease = self.vpn_manager.lease(country, client=f"recording-{schedule_id}") if self.vpn_manager else None
+                if not lease:
+                    self.logger.info(f"no {country} tunnel available for schedule {schedule_id}, holding it")
+                    return None
+
+            recording = Recording(
+                schedule_id=schedule.id,
+                channel_id=channel.id,
+                program_id=program.id,
+                start_time=schedule.start_time,
+                end_time=schedule.end_time,
+                status=RecordingStatus.RECORDING if admitted else RecordingStatus.FAILED
+            )
+            if not admitted:
+                self.logger.error(f"schedule {schedule_id} can never fit in {self.recordings_dir}, not recording it")
+                recording.error_message = f"not enough disk space for ~{duration * self.bytes_per_sec / 1e9:.1f}GB"
+                recording.completed_at = now
+            session.add(recording)
+            session.commit()
+            if not admitted:
+                return False
+
+            url = channel.tuning_json.get("url")
+            base_name = safe_filename(f"{channel.name}_{program.title}_{schedule.start_time.strftime('%Y%m%d_%H%M')}_{schedule.id}")
+            segment_dir = os.path.join(self.recordings_dir, f"{base_name}.segments")
+            started = time.monotonic()
+            capture = {
+                'schedule_id': schedule_id,
+                'country': country,
+                'urls': [url],
+                'url_index': 0,
+                'part': 0,
+                'output_file': os.path.join(self.recordings_dir, f"{base_name}.ts"),
+                'segment_dir': segment_dir,
+                'log_path': os.path.join(self.recordings_dir, f"{base_name}.log"),
+                'lease_id': lease['lease_id'] if lease else None,
+                'proxy_url': lease['proxy_url'] if lease else None,
+                'ovpn_file': lease['tunnel'].get('ovpn_file') if lease else None,
+                'tunnel_id': lease['tunnel'].get('tunnel_id') if lease else None,
+                'started': started,
+                'duration': duration,
+                'deadline': started + duration,
+                'bytes': 0,
+                'endpoint_bytes': 0,
+                'endpoint_since': started,
+                'failovers': [],
+                'failover': None,
+            }
+            try:
+                capture['urls'] += [alternate for alternate in (self.alternate_urls(url) if self.alternate_urls else []) if alternate != url]
+                os.makedirs(segment_dir, exist_ok=True)
+                self.launch(capture)
+            except Exception as e:
+                # the row is committed, it must not be left RECORDING with nothing behind it
+                self.logger.error(f"recording {recording.id} for schedule {schedule_id} could not start: {e}")
+                self.release_tunnel(capture)
+                recording.status = RecordingStatus.FAILED
+                recording.error_message = f"capture could not start: {e}"
+                recording.completed_at = datetime.now(timezone.utc)
+                session.commit()
+                RECORDINGS.inc(status='failed')
+                return False
+            self.logger.info(f"recording {recording.id} started for schedule {schedule_id} ({int(duration)}s, "
+                             f"[{len(capture['urls']) - 1}] alternate streams), pid {capture['process'].pid}")
+            with self.lock:
+                self.active[recording.id] = capture
+            return True
+
+    def credit_endpoint(self, capture):
+        # what the current endpoint delivered since the capture moved to it, for the sidecar's endpoint stats
+        now = time.monotonic()
+        size = dir_bytes(capture['segment_dir'])
+        delivered = size - capture['endpoint_bytes']
+        if delivered > 0:
+            self.vpn_manager.record_bandwidth(capture['ovpn_file'], delivered, now - capture['endpoint_since'])
+        capture.update(endpoint_bytes=size, endpoint_since=now)
+
+    def release_tunnel(self, capture):
+        if not capture.get('lease_id'):
+            return
+        self.credit_endpoint(capture)
+        self.vpn_manager.release(capture['lease_id'])
+
+    def progress(self):
+        # {recording id: ffmpeg progress} for the running captures
+        with self.lock:
+            return {recording_id: dict(capture['progress'].snapshot(), bytes=capture['bytes'], url=capture['url'],
+                                       failovers=len(capture['failovers']))
+                    for recording_id, capture in self.active.items()}
+
+    def queue_status(self, recording_id, **fields):
+        self.status_updates.setdefault(recording_id, {}).update(fields)
+
+    def flush_status_updates(self):
+        with self.lock:
+            updates = self.status_updates
+            self.status_updates = {}
+        self.last_flush = time.monotonic()
+        if self.vpn_manager:
+            self.vpn_manager.flush_reports()
+        if not updates:
+            return
+        self.db_conn.bulk_update_recordings(updates)
+        self.logger.info(f"flushed status for [{len(updates)}] recordings")
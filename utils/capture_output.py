@@ -0,0 +1,244 @@
+import glob
+import os
+import queue
+import re
+import shutil
+import subprocess
+import threading
+import time
+from collections import deque
+from .metrics import REGISTRY
+
+# frame=  250 fps= 25 q=-1.0 size=    1024kB time=00:00:10.00 bitrate= 838.9kbits/s speed=1.01x
+PROGRESS_FIELD = re.compile(r'(\w+)=\s*(\S+)')
+SIZE_UNITS = {'b': 1, 'kb': 1024, 'kib': 1024, 'mb': 1 << 20, 'mib': 1 << 20, 'gb': 1 << 30, 'gib': 1 << 30}
+
+POSTPROCESS_SECONDS = REGISTRY.histogram('iptv_postprocess_seconds', 'Remux and cleanup time by result', ('result',))
+
+
+def parse_clock(value):
+    # "01:02:03.45" -> 3723.45, None for N/A
+    try:
+        hours, minutes, seconds = value.lstrip('-').split(':')
+        return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+    except ValueError:
+        return None
+
+
+def parse_size(value):
+    # "1024kB" -> 1048576
+    match = re.match(r'([\d.]+)\s*([a-zA-Z]*)', value)
+    if not match:
+        return None
+    return int(float(match.group(1)) * SIZE_UNITS.get(match.group(2).lower() or 'b', 1))
+
+
+def parse_bitrate(value):
+    # "838.9kbits/s" -> 838900.0 bits per second
+    match = re.match(r'([\d.]+)\s*([kmg]?)bits/s', value)
+    if not match:
+        return None
+    return float(match.group(1)) * {'': 1, 'k': 1e3, 'm': 1e6, 'g': 1e9}[match.group(2)]
+
+
+def segment_files(segment_dir):
+    return sorted(glob.glob(os.path.join(segment_dir, '*.ts')))
+
+
+def dir_bytes(path):
+    total = 0
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    total += entry.stat().st_size
+    except OSError:
+        pass
+    return total
+
+
+class FfmpegProgress():
+    # Reads an ffmpeg's stderr on a thread of its own while it is written.
+    # Status lines update out_secs, size_bytes, bitrate_bps and speed, anything
+    # else goes to a bounded tail for error messages and to the log file up to
+    # max_log_bytes, so a recording never holds its stderr in memory however
+    # long it runs.  last_progress is when out_secs last moved forward.
+    def __init__(self, stream, log_path=None, tail_lines=50, max_log_bytes=1 << 20, max_line=4096):
+        self.stream = stream
+        self.log_path = log_path
+        self.lines = deque(maxlen=tail_lines)
+        self.max_log_bytes = max_log_bytes
+        self.max_line = max_line
+        self.out_secs = None
+        self.size_bytes = None
+        self.bitrate_bps = None
+        self.speed = None
+        self.last_progress = time.monotonic()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def run(self):
+        # appended to, a recording that fails over has one log for all its ffmpeg runs
+        log = open(self.log_path, 'a') if self.log_path else None
+        logged = 0
+        pending = b''
+        try:
+            while True:
+                chunk = self.stream.read1(1 << 16)
+                if not chunk:
+                    break
+                # status lines end in \r, everything else in \n
+                *lines, pending = re.split(rb'[\r\n]', pending + chunk)
+                pending = pending[-self.max_line:]
+                for raw in lines:
+                    line = raw[:self.max_line].decode('utf-8', 'replace').strip()
+                    if line and not self.handle(line) and log and logged < self.max_log_bytes:
+                        log.write(line + '\n')
+                        logged += len(line) + 1
+            if pending.strip():
+                self.handle(pending.decode('utf-8', 'replace').strip())
+        except (OSError, ValueError):
+            pass
+        finally:
+            if log:
+                log.close()
+            self.stream.close()
+
+    def handle(self, line):
+        # True for a status line, which is parsed rather than kept
+        if 'time=' not in line or not (line.startswith('frame=') or line.startswith('size=')):
+            self.lines.append(line)
+            return False
+        fields = dict(PROGRESS_FIELD.findall(line))
+        out_secs = parse_clock(fields.get('time', ''))
+        if out_secs is not None and (self.out_secs is None or out_secs > self.out_secs):
+            self.out_secs = out_secs
+            self.last_progress = time.monotonic()
+        self.size_bytes = parse_size(fields.get('size', '')) or self.size_bytes
+        self.bitrate_bps = parse_bitrate(fields.get('bitrate', '')) or self.bitrate_bps
+        self.speed = fields.get('speed', self.speed)
+        return True
+
+    def join(self, timeout=None):
+        if self.thread:
+            self.thread.join(timeout)
+
+    def tail(self, max_chars=4000):
+        return '\n'.join(self.lines)[-max_chars:] or None
+
+    def snapshot(self):
+        return {
+            'out_secs': self.out_secs,
+            'size_bytes': self.size_bytes,
+            'bitrate_bps': self.bitrate_bps,
+            'speed': self.speed,
+            'stalled_secs': round(time.monotonic() - self.last_progress, 1),
+        }
+
+
+class PostProcessor():
+    # Finished captures waiting to have their segments remuxed into one file
+    # and cleaned up, worked by threads of their own so a long remux never
+    # holds up the capture supervisor.  The queue is bounded and submit() never
+    # blocks: it returns False when full and the caller offers the job again
+    # later.  A job is a dict with segment_dir, output_file, bytes and
+    # on_done(file_path, error), called from the worker thread, or from stop()
+    # for a job that never got a worker.
+    def __init__(self, logger, workers=None, max_queued=None, keep_segments=None, timeout=None):
+        self.logger = logger
+        self.workers = workers or int(os.getenv("POSTPROCESS_WORKERS", "1"))
+        self.jobs = queue.Queue(maxsize=max_queued or int(os.getenv("POSTPROCESS_QUEUE_SIZE", "16")))
+        if keep_segments is None:
+            keep_segments = os.getenv("KEEP_SEGMENTS", "false").lower() == "true"
+        self.keep_segments = keep_segments
+        self.timeout = timeout or int(os.getenv("POSTPROCESS_TIMEOUT", "1800"))
+        self.in_progress = {}  # segment_dir -> job
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.threads = []
+        REGISTRY.gauge('iptv_postprocess_queued', 'Captures waiting for remux', callback=lambda: self.jobs.qsize())
+
+    def start(self):
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self.run, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        # workers exit after the job in hand, queued jobs keep their segments on
+        # disk and are finished with an error so their owner still hears back
+        self.stopping.set()
+        for thread in self.threads:
+            thread.join()
+        while True:
+            try:
+                job = self.jobs.get_nowait()
+            except queue.Empty:
+                break
+            with self.lock:
+                self.in_progress.pop(job['segment_dir'], None)
+            self.finish(job, job['segment_dir'], 'recorder shut down before post-processing')
+
+    def submit(self, job):
+        try:
+            self.jobs.put_nowait(job)
+        except queue.Full:
+            return False
+        with self.lock:
+            self.in_progress[job['segment_dir']] = job
+        return True
+
+    def pending_bytes(self):
+        # the remux writes a second copy before the segments go
+        with self.lock:
+            return sum(job.get('bytes', 0) for job in self.in_progress.values())
+
+    def run(self):
+        while not self.stopping.is_set():
+            try:
+                job = self.jobs.get(timeout=1)
+            except queue.Empty:
+                continue
+            start = time.monotonic()
+            try:
+                file_path, error = self.process(job)
+            except Exception as e:
+                file_path, error = job['segment_dir'], f"post-processing failed: {e}"
+            POSTPROCESS_SECONDS.observe(time.monotonic() - start, result='failed' if error else 'ok')
+            with self.lock:
+                self.in_progress.pop(job['segment_dir'], None)
+            self.finish(job, file_path, error)
+
+    def finish(self, job, file_path, error):
+        try:
+            job['on_done'](file_path, error)
+        except Exception as e:
+            self.logger.error(f"post-processing callback for {job['output_file']} failed: {e}")
+
+    def process(self, job):
+        # (file_path, error), the segments stay where they are if the remux fails
+        segment_dir = job['segment_dir']
+        segments = segment_files(segment_dir)
+        if not segments:
+            shutil.rmtree(segment_dir, ignore_errors=True)
+            return None, 'no output written'
+        concat_path = os.path.join(segment_dir, 'concat.txt')
+        with open(concat_path, 'w') as outfile:
+            outfile.writelines(f"file '{segment}'\n" for segment in segments)
+        cmd = ["ffmpeg", "-nostdin", "-y", "-v", "error", "-f", "concat", "-safe", "0", "-i", concat_path,
+               "-c", "copy", "-f", "mpegts", job['output_file']]
+        try:
+            result = subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                    timeout=self.timeout)
+        except subprocess.TimeoutExpired:
+            return segment_dir, f"remux timed out after {self.timeout}s"
+        if result.returncode != 0:
+            return segment_dir, f"remux failed: {result.stderr.decode('utf-8', 'replace')[-2000:]}"
+        if not self.keep_segments:
+            shutil.rmtree(segment_dir, ignore_errors=True)
+        self.logger.info(f"remuxed [{len(segments)}] segments into {job['output_file']}")
+        return job['output_file'], None
@@ -0,0 +1,100 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from .catalog_loader import channel_file_path
+
+CATALOG_CACHE_PATH = os.getenv("CATALOG_CACHE_PATH", channel_file_path('catalog_cache.sqlite'))
+
+
+class CatalogCache():
+    # SQLite cache next to the channel files.  Parsed catalogs are stored under
+    # the content hash of their source file (hashes are only recomputed when the
+    # file's mtime or size changes), and fuzzy match results are stored per stream
+    # title, so a changed streams.json only re-matches titles we have not seen.
+    def __init__(self, logger, path=None):
+        self.logger = logger
+        self.path = path or CATALOG_CACHE_PATH
+        self.conn = sqlite3.connect(self.path)
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS file_digests (
+                path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, digest TEXT
+            );
+            CREATE TABLE IF NOT EXISTS snapshots (
+                kind TEXT, key TEXT, value TEXT, created REAL, PRIMARY KEY (kind, key)
+            );
+            CREATE TABLE IF NOT EXISTS stream_matches (
+                channels_key TEXT, threshold REAL, title TEXT, channel_id TEXT,
+                PRIMARY KEY (channels_key, threshold, title)
+            );
+        ''')
+
+    def file_digest(self, path):
+        stat = os.stat(path)
+        row = self.conn.execute(
+            'SELECT digest FROM file_digests WHERE path = ? AND mtime_ns = ? AND size = ?',
+            (path, stat.st_mtime_ns, stat.st_size)
+        ).fetchone()
+        if row:
+            return row[0]
+        sha = hashlib.sha256()
+        with open(path, 'rb') as file:
+            for chunk in iter(lambda: file.read(1 << 20), b''):
+                sha.update(chunk)
+        digest = sha.hexdigest()
+        with self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO file_digests VALUES (?, ?, ?, ?)',
+                (path, stat.st_mtime_ns, stat.st_size, digest)
+            )
+        return digest
+
+    def get(self, kind, key):
+        row = self.conn.execute('SELECT value FROM snapshots WHERE kind = ? AND key = ?', (kind, key)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, kind, key, value):
+        with self.conn:
+            # one snapshot per kind, older inputs are not worth keeping around
+            self.conn.execute('DELETE FROM snapshots WHERE kind = ?', (kind,))
+            self.conn.execute(
+                'INSERT INTO snapshots VALUES (?, ?, ?, ?)',
+                (kind, key, json.dumps(value, separators=(',', ':')), time.time())
+            )
+
+    def catalog_key(self, path, suffix=''):
+        return self.file_digest(path) + suffix
+
+    def cached_catalog(self, kind, path, loader, suffix=''):
+        # returns (key, records), loading and storing the records on a miss
+        key = self.catalog_key(path, suffix)
+        records = self.get(kind, key)
+        if records is None:
+            self.logger.info(f"catalog cache miss for {kind}")
+            records = loader()
+            self.put(kind, key, records)
+        else:
+            self.logger.info(f"catalog cache hit for {kind}")
+        return key, records
+
+    def get_matches(self, channels_key, threshold, titles):
+        # {title: channel_id or None} for the titles already matched against this channel set
+        matches = {}
+        rows = self.conn.execute(
+            'SELECT title, channel_id FROM stream_matches WHERE channels_key = ? AND threshold = ?',
+            (channels_key, threshold)
+        )
+        wanted = set(titles)
+        for title, channel_id in rows:
+            if title in wanted:
+                matches[title] = channel_id
+        return matches
+
+    def put_matches(self, channels_key, threshold, matches):
+        with self.conn:
+            self.conn.execute('DELETE FROM stream_matches WHERE channels_key != ?', (channels_key,))
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO stream_matches VALUES (?, ?, ?, ?)',
+                [(channels_key, threshold, title, channel_id) for title, channel_id in matches.items()]
+            )
@@ -0,0 +1,97 @@
+import json
+import os
+import re
+import sys
+
+CHANNEL_FILES_DIR = os.getenv("CHANNEL_FILES_DIR", "/channel_files")
+
+# only the fields the recorder reads, everything else is dropped while parsing
+CHANNEL_FIELDS = ('id', 'name', 'country')
+STREAM_FIELDS = ('channel', 'title', 'url', 'quality', 'referrer', 'user_agent')
+COUNTRY_FIELDS = ('code', 'name')
+SD_LOOKUP_FIELDS = ('iptv_id', 'sd_id')
+# values repeated across many records, interned so each is stored once
+INTERNED_FIELDS = ('country', 'channel', 'quality')
+
+SEPARATORS = re.compile(r'[\s,]*')
+# what could still follow the part of a number already read, e.g. "1" then "e5"
+NUMBER_TAIL = re.compile(r'[0-9eE.+-]*')
+
+
+def channel_file_path(name):
+    return os.path.join(CHANNEL_FILES_DIR, name)
+
+
+def iter_json_array(path, chunk_size=1 << 16):
+    # Yields the elements of a top level JSON array one at a time, holding only
+    # a chunk or so of the file in memory instead of the whole parsed document.
+    decoder = json.JSONDecoder()
+    with open(path, encoding='utf-8') as file:
+        buffer = file.read(chunk_size).lstrip()
+        if not buffer.startswith('['):
+            raise ValueError(f"{path} does not contain a JSON array")
+        pos = 1
+        eof = False
+        while True:
+            pos = SEPARATORS.match(buffer, pos).end()
+            if pos < len(buffer) and buffer[pos] == ']':
+                return
+            try:
+                if pos >= len(buffer):
+                    raise json.JSONDecodeError("need more data", buffer, pos)
+                element, end = decoder.raw_decode(buffer, pos)
+                # a number that runs up to the end of the buffer may continue in the next chunk,
+                # everything else ends on a delimiter of its own
+                if (not eof and isinstance(element, (int, float)) and not isinstance(element, bool)
+                        and NUMBER_TAIL.match(buffer, end).end() == len(buffer)):
+                    raise json.JSONDecodeError("number may be cut off", buffer, end)
+                pos = end
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                more = file.read(chunk_size)
+                eof = not more
+                buffer = buffer[pos:] + more
+                pos = 0
+                continue
+            yield element
+            if pos > chunk_size:
+                buffer = buffer[pos:]
+                pos = 0
+
+
+def project(record, fields):
+    projected = {}
+    for field in fields:
+        value = record.get(field)
+        if value is None:
+            continue
+        if field in INTERNED_FIELDS and isinstance(value, str):
+            value = sys.intern(value)
+        projected[field] = value
+    return projected
+
+
+def load_catalog(path, fields, keep=None):
+    # keep is an optional filter applied to the raw record before projection
+    return [project(record, fields) for record in iter_json_array(path) if keep is None or keep(record)]
+
+
+def load_channels(country=None):
+    keep = None
+    if country:
+        country = country.upper()
+        keep = lambda ch: (ch.get('country') or '').upper() == country
+    return load_catalog(channel_file_path('channels.json'), CHANNEL_FIELDS, keep)
+
+
+def load_streams():
+    return load_catalog(channel_file_path('streams.json'), STREAM_FIELDS)
+
+
+def load_countries():
+    return load_catalog(channel_file_path('countries.json'), COUNTRY_FIELDS)
+
+
+def load_sd_iptv_channels_lookup():
+    return load_catalog(channel_file_path('sd_iptv_channels_lookup.json'), SD_LOOKUP_FIELDS)
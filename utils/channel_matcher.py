@@ -0,0 +1,76 @@
+from collections import defaultdict
+from difflib import SequenceMatcher
+
+
+def clean_title(title):
+    return title.lower().replace(' hd', '').replace(' sd', '').replace(' tv', '').replace(' channel', '').strip()
+
+
+def trigrams(text):
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class ChannelMatcher():
+    # Built once from name_to_id (lowercased channel name -> channel id).  Lookups go
+    # exact name -> trigram candidates -> SequenceMatcher, so a stream title is scored
+    # against the names it shares text with instead of all of them.  A candidate is
+    # only dropped when its length alone rules out reaching the threshold, so the
+    # result matches full_scan_match except for a name that shares no trigram at all
+    # with the title and still scores over the threshold (short names of a few
+    # letters at most, see benchmarks/bench_channel_matcher.py).
+    def __init__(self, name_to_id):
+        self.name_to_id = name_to_id
+        self.names = list(name_to_id.keys())
+        self.name_lengths = [len(name) for name in self.names]
+        self.trigram_index = defaultdict(list)
+        for position, name in enumerate(self.names):
+            for gram in trigrams(name):
+                self.trigram_index[gram].append(position)
+
+    def candidates(self, title_clean, threshold):
+        # positions, in name_to_id order, of the names sharing a trigram with title_clean
+        # whose length still allows threshold: the ratio is at most 2 * min(a, b) / (a + b),
+        # computed the way SequenceMatcher.real_quick_ratio does so ties at the threshold stay in
+        length = len(title_clean)
+        found = set()
+        for gram in trigrams(title_clean):
+            found.update(self.trigram_index.get(gram, ()))
+        return sorted(
+            position for position in found
+            if 2.0 * min(length, self.name_lengths[position]) / (length + self.name_lengths[position]) >= threshold
+        )
+
+    def best_match(self, title, threshold):
+        # Returns (channel_id, score), or (None, 0) if nothing reaches threshold.
+        # Same scoring and tie-breaking as the full scan: highest ratio wins, and on
+        # a tie the name that comes first in name_to_id wins.
+        title_clean = clean_title(title)
+        if title_clean in self.name_to_id:
+            return self.name_to_id[title_clean], 1.0
+        best_score = 0
+        best_id = None
+        for position in self.candidates(title_clean, threshold):
+            name_lower = self.names[position]
+            matcher = SequenceMatcher(None, title_clean, name_lower)
+            # quick_ratio bounds ratio from above, and a later name has to beat the best so far outright
+            upper_bound = matcher.quick_ratio()
+            if upper_bound < threshold or (best_id and upper_bound <= best_score):
+                continue
+            score = matcher.ratio()
+            if score > best_score and score >= threshold:
+                best_score = score
+                best_id = self.name_to_id[name_lower]
+        return best_id, best_score
+
+    def full_scan_match(self, title, threshold):
+        # The original O(channels) loop, kept as a reference for benchmarks
+        title_clean = clean_title(title)
+        best_score = 0
+        best_id = None
+        for name_lower, possible_id in self.name_to_id.items():
+            score = SequenceMatcher(None, title_clean, name_lower).ratio()
+            if score > best_score and score >= threshold:
+                best_score = score
+                best_id = possible_id
+        return best_id, best_score
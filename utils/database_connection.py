@@ -1,7 +1,10 @@
-from sqlalchemy import create_engine, text
-from sqlalchemy.orm import sessionmaker
+from tv_detection_common.models import Recording
+from sqlalchemy import create_engine, insert, text, update
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy.exc import OperationalError, DatabaseError
 import os
+import time
 
 class DatabaseConnection():
     def __init__(self, logger=None, test_conn=True):
@@ -10,21 +13,62 @@ class DatabaseConnection():
         if not DB_URL:
             logger.error("DB_URL environment variable not set. Exiting.")
             exit(1)
-        if test_conn:
-            self.verify_database_connection()
-        engine = create_engine(DB_URL, echo=False)
-        self.Session = sessionmaker(bind=engine)
+        self.engine = create_engine(DB_URL, echo=False, **self.engine_options(DB_URL))
+        # one session per thread, so recorder and scheduler threads never share one
+        self.session_factory = sessionmaker(bind=self.engine)
+        self.Session = scoped_session(self.session_factory)
+        if test_conn and not self.verify_database_connection():
+            # not fatal, as before: the pool reconnects on first use, so a database that
+            # comes up after the recorder only costs the calls made while it was down
+            logger.error("Database not reachable yet, carrying on without it")
 
-    def verify_database_connection(self):
+    def engine_options(self, db_url):
+        if make_url(db_url).get_backend_name() == 'sqlite':
+            return {}
+        return {
+            'pool_size': int(os.getenv("DB_POOL_SIZE", "10")),
+            'max_overflow': int(os.getenv("DB_MAX_OVERFLOW", "10")),
+            'pool_pre_ping': os.getenv("DB_POOL_PRE_PING", "true").lower() == "true",
+            'pool_recycle': int(os.getenv("DB_POOL_RECYCLE", "1800")),
+        }
+
+    def verify_database_connection(self, attempts=None, delay=1):
+        attempts = attempts or int(os.getenv("DB_CONNECT_ATTEMPTS", "5"))
         self.logger.info(f"testing Database connection")
-        try:
-            with self.Session() as session:
-                result = session.execute(text("SELECT COUNT(*) FROM schedules"))
-                count = result.scalar()
-                self.logger.info(f"Database connection OK. Found {count} entries in schedules table.")
-        except OperationalError as e:
-            self.logger.error(f"Connection failed (will retry later): {e}")
-        except DatabaseError as e:
-            self.logger.error(f"Database error (table missing or permission issue?): {e}")
-        except Exception as e:
-            self.logger.error(f"Unexpected error during DB test: {e}")
+        for attempt in range(1, attempts + 1):
+            try:
+                with self.engine.connect() as conn:
+                    result = conn.execute(text("SELECT COUNT(*) FROM schedules"))
+                    count = result.scalar()
+                    self.logger.info(f"Database connection OK. Found {count} entries in schedules table.")
+                    return True
+            except OperationalError as e:
+                self.logger.error(f"Connection failed (attempt {attempt} of {attempts}): {e}")
+            except DatabaseError as e:
+                self.logger.error(f"Database error (table missing or permission issue?): {e}")
+                return False
+            except Exception as e:
+                self.logger.error(f"Unexpected error during DB test: {e}")
+                return False
+            if attempt < attempts:
+                time.sleep(delay)
+                delay *= 2
+        return False
+
+    def bulk_insert_recordings(self, rows):
+        # rows: list of dicts of Recording column values, one INSERT round trip
+        if not rows:
+            return
+        # a session of its own, the thread's scoped session may be in use by the caller
+        with self.session_factory() as session:
+            session.execute(insert(Recording), rows)
+            session.commit()
+
+    def bulk_update_recordings(self, updates):
+        # updates: {recording_id: {column: value}}, one executemany UPDATE by primary key
+        if not updates:
+            return
+        # a session of its own, the thread's scoped session may be in use by the caller
+        with self.session_factory() as session:
+            session.execute(update(Recording), [dict(fields, id=recording_id) for recording_id, fields in updates.items()])
+            session.commit()
@@ -0,0 +1,162 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import xml.etree.ElementTree as ET
+import requests
+from requests.adapters import HTTPAdapter
+from .catalog_loader import channel_file_path
+from .metrics import REGISTRY
+
+EPG_CACHE_DIR = os.getenv("EPG_CACHE_DIR", channel_file_path('epg_cache'))
+EPG_BASE_URL = os.getenv("EPG_BASE_URL", "https://iptv-org.github.io/epg/guides/")
+
+GUIDE_FETCH_SECONDS = REGISTRY.histogram('iptv_epg_fetch_seconds', 'Guide fetch time by result', ('result',))
+
+
+class EpgFetcher():
+    # Fetches each guide once, keeps it on disk with its ETag/Last-Modified so later
+    # fetches are conditional GETs, and parses it in a single iterparse pass into a
+    # per-channel programme index.  Every channel lookup for a guide is then served
+    # from that index until it is older than max_age seconds.
+    def __init__(self, logger, cache_dir=None, max_age=3600, timeout=10, pool_size=10):
+        self.logger = logger
+        self.cache_dir = cache_dir or EPG_CACHE_DIR
+        self.max_age = max_age
+        self.timeout = timeout
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.guides = {}  # xml_url -> (loaded_at, index or None)
+        self.guide_locks = {}
+        self.lock = threading.Lock()
+
+    def guide_url(self, country, provider):
+        return f"{EPG_BASE_URL}{country}/{provider}.xml"
+
+    def cache_paths(self, xml_url):
+        name = hashlib.sha1(xml_url.encode()).hexdigest()
+        return os.path.join(self.cache_dir, f"{name}.xml"), os.path.join(self.cache_dir, f"{name}.json")
+
+    def fetch(self, xml_url):
+        # returns the path of an up to date local copy, or None if the guide is unavailable
+        start = time.monotonic()
+        xml_path, result = self.fetch_once(xml_url)
+        GUIDE_FETCH_SECONDS.observe(time.monotonic() - start, result=result)
+        return xml_path
+
+    def fetch_once(self, xml_url):
+        # a copy already on disk is used, stale, when the server errors or cannot be reached
+        xml_path, meta_path = self.cache_paths(xml_url)
+        cached_path = xml_path if os.path.isfile(xml_path) else None
+        headers = {}
+        if cached_path and os.path.isfile(meta_path):
+            with open(meta_path) as file:
+                meta = json.load(file)
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+        try:
+            with self.session.get(xml_url, headers=headers, timeout=self.timeout, stream=True) as response:
+                if response.status_code == 304:
+                    self.logger.debug(f"guide not modified: {xml_url}")
+                    return xml_path, 'not_modified'
+                if response.status_code >= 500 and cached_path:
+                    self.logger.warning(f"guide fetch failed ({response.status_code}), using the cached copy: {xml_url}")
+                    return cached_path, 'stale'
+                if response.status_code != 200:
+                    self.logger.debug(f"guide fetch failed ({response.status_code}): {xml_url}")
+                    return None, 'failed'
+                tmp_path = f"{xml_path}.tmp"
+                with open(tmp_path, 'wb') as outfile:
+                    for chunk in response.iter_content(chunk_size=1 << 16):
+                        outfile.write(chunk)
+                os.replace(tmp_path, xml_path)
+                with open(meta_path, 'w') as outfile:
+                    json.dump({
+                        'url': xml_url,
+                        'etag': response.headers.get('ETag'),
+                        'last_modified': response.headers.get('Last-Modified'),
+                    }, outfile)
+                return xml_path, 'fetched'
+        except requests.RequestException as e:
+            if cached_path:
+                self.logger.warning(f"guide fetch error for {xml_url}, using the cached copy: {e}")
+                return cached_path, 'stale'
+            self.logger.debug(f"guide fetch error for {xml_url}: {e}")
+            return None, 'error'
+
+    def parse(self, xml_path):
+        # {'channels': set of channel ids, 'programmes': {channel_id: [programme, ...]}}
+        channels = set()
+        programmes = {}
+        root = None
+        for event, elem in ET.iterparse(xml_path, events=('start', 'end')):
+            if root is None:
+                root = elem
+            if event == 'start':
+                continue
+            if elem.tag == 'channel':
+                channels.add(elem.get('id'))
+                # clearing elem alone leaves an empty element behind in <tv> for every entry
+                root.clear()
+            elif elem.tag == 'programme':
+                title = elem.find('title')
+                desc = elem.find('desc')
+                programmes.setdefault(elem.get('channel'), []).append({
+                    'start': elem.get('start'),  # e.g., "20260122180000 +0000"
+                    'stop': elem.get('stop'),
+                    'title': title.text if title is not None else None,
+                    'desc': desc.text if desc is not None else None,
+                    'categories': [cat.text for cat in elem.findall('category')]
+                })
+                root.clear()
+        return {'channels': channels, 'programmes': programmes}
+
+    def guide_index(self, xml_url):
+        with self.lock:
+            guide_lock = self.guide_locks.setdefault(xml_url, threading.Lock())
+        # one fetch and parse per guide, concurrent callers wait for it
+        with guide_lock:
+            cached = self.guides.get(xml_url)
+            if cached and time.monotonic() - cached[0] < self.max_age:
+                return cached[1]
+            index = None
+            xml_path = self.fetch(xml_url)
+            if xml_path:
+                try:
+                    index = self.parse(xml_path)
+                except ET.ParseError as e:
+                    self.logger.error(f"could not parse guide {xml_url}: {e}")
+            self.guides[xml_url] = (time.monotonic(), index)
+            return index
+
+    def programmes_for_channel(self, xml_url, channel_id):
+        # None if the guide is unavailable or doesn't list the channel
+        index = self.guide_index(xml_url)
+        if not index or channel_id not in index['channels']:
+            return None
+        return index['programmes'].get(channel_id, [])
+
+    def resolve(self, channel_guides, max_workers=None):
+        # channel_guides: {channel_id: [xml_url, ...]} in provider preference order.
+        # Every distinct guide is fetched and indexed concurrently first, then each
+        # channel takes the programmes from the first of its guides that lists any.
+        max_workers = max_workers or int(os.getenv("EPG_CONCURRENCY", "8"))
+        xml_urls = {xml_url for xml_urls in channel_guides.values() for xml_url in xml_urls}
+        self.logger.info(f"fetching [{len(xml_urls)}] guides for [{len(channel_guides)}] channels")
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(self.guide_index, xml_urls))
+        resolved = {}
+        for channel_id, xml_urls in channel_guides.items():
+            for xml_url in xml_urls:
+                programmes = self.programmes_for_channel(xml_url, channel_id)
+                if programmes:
+                    resolved[channel_id] = programmes
+                    break
+        return resolved
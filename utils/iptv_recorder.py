@@ -1,66 +1,162 @@
-from tv_detection_common.models import Channel, Schedule, Recording, RecordingStatus
-from datetime import datetime, timedelta, timezone
-import logging
-import sys
+from datetime import datetime, timezone
+from functools import cached_property
 import os
-import subprocess
 import json
 import time
-import requests
-import threading
 from collections import defaultdict
-from difflib import SequenceMatcher
-from .database_connection import DatabaseConnection
-from .vpn_manager_util import VpnManager
+from .catalog_loader import (
+    channel_file_path, load_channels, load_countries, load_sd_iptv_channels_lookup, load_streams
+)
+from .metrics import traced
+
+# Everything heavier than the catalog loader (requests, sqlalchemy and the
+# models, difflib, the VPN and capture machinery) is imported where it is
+# first used, so each entry point only pays for what it touches.
 
 
 class IptvRecorder():
-    def __init__(self, logger):
+    # Catalogs, lookups and services are memoized properties, built the first
+    # time something reads them: snooze_loop touches none of them, a probe
+    # sweep never opens the database, and recording never parses sites.md.
+    def __init__(self, logger, country=None):
         self.logger = logger
-        self.db_conn = DatabaseConnection(self.logger)
-        self.vpn_manager = VpnManager(self.logger)
-        self.channels = []
-        self.streams = []
+        self.country = country
         self.channels_with_streams = {}
-        self.countries = []
-        self.md_text = ''
-        self.sd_iptv_channels_lookup = []
-        self.load_channels_etc()
-        self.build_channel_lookups()
-        self.id_to_country = {ch['id']: ch.get('country') for ch in self.channels}
-        self.id_to_name = {ch['id']: ch['name'] for ch in self.channels}
-        self.name_to_id = {ch['name'].lower(): ch['id'] for ch in self.channels}
-        self.code_to_name = {ch['code'].lower(): ch['name'].lower() for ch in self.countries}
-        self.name_to_code = {v: k for k, v in self.code_to_name.items()}  # Reverse for parsing
-        self.iptv_id_to_sd_id = {ch['iptv_id']: ch['sd_id'] for ch in self.self.sd_iptv_channels_lookup}
-        self.country_to_providers = {}
-#        self.country_to_providers = self.parse_sites()
         self.xml_dir_map = {'gb': 'uk'}
 
-    def build_channel_lookups(self):
-        self.id_to_country = {ch['id']: ch.get('country') for ch in self.channels}
-        self.id_to_name = {ch['id']: ch['name'] for ch in self.channels}
-        self.name_to_id = {ch['name'].lower(): ch['id'] for ch in self.channels}
+    @cached_property
+    def db_conn(self):
+        from .database_connection import DatabaseConnection
+        return DatabaseConnection(self.logger)
 
-    def main_loop(self):
-        self.logger.info("entering scheduler loop")
-        while True:
-            session = self.db_conn.Session()
-            now = datetime.now(timezone.utc)
-            pending = session.query(Schedule).filter(Schedule.start_time <= now + timedelta(minutes=5), Schedule.start_time > now - timedelta(minutes=5)).all()
+    @cached_property
+    def vpn_manager(self):
+        from .vpn_manager_util import VpnManager
+        return VpnManager(self.logger)
+
+    @cached_property
+    def results_store(self):
+        from .results_store import ResultsStore
+        return ResultsStore(self.logger)
+
+    @cached_property
+    def probe_cache(self):
+        from .probe_cache import ProbeCache
+        return ProbeCache(self.logger)
+
+    @cached_property
+    def epg_fetcher(self):
+        from .epg_fetcher import EpgFetcher
+        return EpgFetcher(self.logger)
+
+    @cached_property
+    def catalog_cache(self):
+        from .catalog_cache import CatalogCache
+        return CatalogCache(self.logger)
+
+    # streamed and projected down to the fields we use, channels are filtered to
+    # self.country (if set) while reading.  Parsed catalogs come from the catalog
+    # cache when the source files have not changed.  The *_key properties are
+    # set alongside the catalog they belong to, or read on their own from the
+    # file digests when only the key is needed.
+    @cached_property
+    def channels(self):
+        self.logger.info("loading channels")
+        self.channels_key, channels = self.catalog_cache.cached_catalog(
+            'channels', channel_file_path('channels.json'), lambda: load_channels(self.country), f":{self.country or ''}"
+        )
+        self.logger.info(f"num chans is [{len(channels)}]")
+        return channels
+
+    @cached_property
+    def channels_key(self):
+        # the key the channels are cached under, from the file's digest without parsing it
+        return self.catalog_cache.catalog_key(channel_file_path('channels.json'), f":{self.country or ''}")
+
+    @cached_property
+    def streams(self):
+        self.streams_key, streams = self.catalog_cache.cached_catalog(
+            'streams', channel_file_path('streams.json'), load_streams
+        )
+        self.logger.info(f"num streams is [{len(streams)}]")
+        return streams
+
+    @cached_property
+    def streams_key(self):
+        return self.catalog_cache.catalog_key(channel_file_path('streams.json'))
+
+    @cached_property
+    def countries(self):
+        countries = self.catalog_cache.cached_catalog(
+            'countries', channel_file_path('countries.json'), load_countries
+        )[1]
+        self.logger.info(f"num countries is [{len(countries)}]")
+        return countries
+
+    @cached_property
+    def md_text(self):
+        with open(channel_file_path('sites.md')) as file:
+            return file.read()
 
-            threads = []
-            for sch in pending:
-                if not sch.recording:  # no recording yet
-                    t = threading.Thread(target=record_stream, args=(sch.id,))
-                    t.start()
-                    threads.append(t)
+    @cached_property
+    def sd_iptv_channels_lookup(self):
+        lookup = self.catalog_cache.cached_catalog(
+            'sd_iptv_channels_lookup', channel_file_path('sd_iptv_channels_lookup.json'), load_sd_iptv_channels_lookup
+        )[1]
+        self.logger.info(f"num sd lookups is [{len(lookup)}]")
+        return lookup
 
-            for t in threads:
-                t.join()
+    @cached_property
+    def country_to_providers(self):
+        # {country code: [provider, ...]}, codes lower case like code_to_name; reparsed when sites.md or countries.json change
+        countries_digest = self.catalog_cache.file_digest(channel_file_path('countries.json'))
+        return self.catalog_cache.cached_catalog(
+            'country_to_providers', channel_file_path('sites.md'), self.parse_sites, f":{countries_digest}"
+        )[1]
 
-            session.close()
-            time.sleep(60)  # check every minute
+    @cached_property
+    def code_to_name(self):
+        return {ch['code'].lower(): ch['name'].lower() for ch in self.countries}
+
+    @cached_property
+    def name_to_code(self):
+        return {v: k for k, v in self.code_to_name.items()}  # Reverse for parsing
+
+    @cached_property
+    def iptv_id_to_sd_id(self):
+        return {ch['iptv_id']: ch['sd_id'] for ch in self.sd_iptv_channels_lookup}
+
+    # lookups over self.channels, dropped by reset_channel_lookups() when the channels change
+    CHANNEL_LOOKUPS = ('id_to_country', 'id_to_name', 'name_to_id', 'channel_matcher')
+
+    @cached_property
+    def id_to_country(self):
+        return {ch['id']: ch.get('country') for ch in self.channels}
+
+    @cached_property
+    def id_to_name(self):
+        return {ch['id']: ch['name'] for ch in self.channels}
+
+    @cached_property
+    def name_to_id(self):
+        return {ch['name'].lower(): ch['id'] for ch in self.channels}
+
+    @cached_property
+    def channel_matcher(self):
+        from .channel_matcher import ChannelMatcher
+        return ChannelMatcher(self.name_to_id)
+
+    def reset_channel_lookups(self):
+        for name in self.CHANNEL_LOOKUPS:
+            self.__dict__.pop(name, None)
+
+    def main_loop(self):
+        from .capture_engine import CaptureEngine
+        from .recording_scheduler import RecordingScheduler
+        capture_engine = CaptureEngine(self.logger, self.db_conn, self.vpn_manager,
+                                       alternate_urls=self.results_store.alternate_urls)
+        capture_engine.start()
+        RecordingScheduler(self.logger, self.db_conn, capture_engine).run()
 
     def snooze_loop(self):
         self.logger.info("entering snooze loop")
@@ -68,36 +164,127 @@ class IptvRecorder():
             self.logger.info("zzz for an hour")
             time.sleep(3600)  # check every hour
 
-    def test_channels_with_streams(self, country_code):
-        # TODO we have to manage this in blocks
-        vpn_results = {}
-        total_limit = 20
-        total_count = 0
+    @traced('test_channels_with_streams')
+    def test_channels_with_streams(self, country_code, limit=None, channel_ids=None, report=None):
+        # channel_ids narrows the sweep to those channels (a sweep shard), and
+        # report(results), if given, gets each batch's results as well
         time_str = datetime.now(timezone.utc).strftime('%Y%m%d_%H%M')
         self.logger.info(f"testing channels with streams for country {country_code} at {time_str}")
-        for channel_id in self.channels_with_streams:
-            if total_count >= total_limit: break
-            vpn_results[channel_id] = []
-            channel = self.channels_with_streams[channel_id]['channel']
-            self.logger.info(f"-- testing  channel {channel_id}")
-            counter = 0
-            for stream in self.channels_with_streams[channel_id]['streams']:
-                print(f"--- testing stream {counter}")
-                resp = self.vpn_manager.test_stream_url_with_vpn(country_code, stream.get('url'))
-                if not resp:
-                    self.logger.info('---- OK')
-                    vpn_results[channel_id].append('OK')
-                else:
-                    self.logger.info('---- FAIL')
-                    vpn_results[channel_id].append('FAIL')
-                counter += 1
-                total_count += 1
-        for channel_id in vpn_results:
-            time_str = datetime.now(timezone.utc).strftime('%Y%m%d_%H%M')
-            for result_code, index in enumerate(vpn_results[channel_id]):
-                self.channels_with_streams[channel_id]['streams'][index]['connect_status'] = result_code
-                self.channels_with_streams[channel_id]['streams'][index]['connect_test_time'] = time_str
-        self.write_channels_with_streams()
+        if channel_ids is None:
+            channel_ids = self.channels_with_streams.keys()
+        channel_streams = {
+            channel_id: self.channels_with_streams[channel_id]['streams']
+            for channel_id in channel_ids if channel_id in self.channels_with_streams
+        }
+        # streams with a result that is still fresh keep it and are not probed again
+        cached = self.probe_cache.lookup(
+            [stream.get('url') for streams in channel_streams.values() for stream in streams], country_code
+        )
+        fresh = {url for url, entry in cached.items() if entry['fresh']}
+        cached_results = []
+        for channel_id, streams in channel_streams.items():
+            for stream in streams:
+                entry = cached.get(stream.get('url'))
+                if entry and entry['fresh']:
+                    stream['connect_status'] = 'OK' if entry['return_code'] == 0 else 'FAIL'
+                    stream['connect_test_time'] = datetime.fromtimestamp(entry['tested_at'], timezone.utc).strftime('%Y%m%d_%H%M')
+                    cached_results.append({
+                        'channel_id': channel_id,
+                        'url': stream.get('url'),
+                        'status': stream['connect_status'],
+                        'return_code': entry['return_code'],
+                        'latency_ms': None,
+                        'vpn_endpoint': None,
+                        'tested_at': entry['tested_at'],
+                    })
+        self.logger.info(f"probe cache for {country_code}: {self.probe_cache.report()}")
+        if report and cached_results:
+            # a sweep's results cover every stream, not only the ones probed this time
+            report(cached_results)
+        # one tunnel for the whole sweep, rotated between batches if it starts getting 403s
+        from .probe_scheduler import ProbeScheduler
+        from .stream_probe import PROBE_FORBIDDEN, PROBE_UNAVAILABLE
+        with self.vpn_manager.session(country_code) as vpn_session:
+            def on_batch(batch_results):
+                results = self.record_probe_results(batch_results, vpn_session.ovpn_file)
+                self.probe_cache.store([
+                    (self.channels_with_streams[channel_id]['streams'][index].get('url'), return_code)
+                    for channel_id, channel_results in batch_results.items()
+                    for index, return_code, latency_ms in channel_results
+                ], country_code)
+                if report:
+                    report(results)
+                if vpn_session.rotate_if_needed():
+                    # the 403s may be the endpoint's, not the stream's, and the probes the dead proxy never
+                    # sent say nothing at all, so both get another go on the new one
+                    return [
+                        (channel_id, index)
+                        for channel_id, channel_results in batch_results.items()
+                        for index, return_code, latency_ms in channel_results
+                        if return_code in (PROBE_FORBIDDEN, PROBE_UNAVAILABLE)
+                    ]
+            scheduler = ProbeScheduler(self.logger, vpn_session.probe)
+            scheduler.run(channel_streams, on_batch, limit=limit, should_probe=lambda stream: stream.get('url') not in fresh)
+        if report is None:
+            self.results_store.compact()
+
+    def sweep_id(self):
+        # one sweep a day unless SWEEP_ID says otherwise, so coordinator and workers agree without talking
+        return os.getenv("SWEEP_ID") or datetime.now(timezone.utc).strftime('%Y%m%d')
+
+    @traced('plan_sweep')
+    def plan_sweep(self, sweep_id=None):
+        # shards channels_with_streams by VPN country, and by hash within a country
+        # when SWEEP_BUCKETS_PER_COUNTRY is over 1
+        from .sweep_coordinator import SweepCoordinator, shard_channels
+        coordinator = SweepCoordinator(self.logger, self.db_conn.engine)
+        buckets = int(os.getenv("SWEEP_BUCKETS_PER_COUNTRY", "1"))
+        coordinator.plan(sweep_id or self.sweep_id(), shard_channels(self.channels_with_streams, buckets, self.xml_dir_map))
+        return coordinator
+
+    def coordinate_sweep(self, sweep_id=None):
+        sweep_id = sweep_id or self.sweep_id()
+        return self.plan_sweep(sweep_id).wait(sweep_id)
+
+    def run_sweep_worker(self, sweep_id=None):
+        # SWEEP_COUNTRIES limits the worker to the countries its sidecar has configs for
+        countries = [code.strip() for code in os.getenv("SWEEP_COUNTRIES", "").split(',') if code.strip()] or None
+        from .sweep_coordinator import SweepCoordinator, SweepWorker
+        coordinator = SweepCoordinator(self.logger, self.db_conn.engine)
+        finished = SweepWorker(self.logger, coordinator, self.sweep_shard, countries=countries).run(sweep_id or self.sweep_id())
+        self.results_store.compact()
+        return finished
+
+    def sweep_shard(self, shard, report):
+        # a worker whose catalog lacks some of the shard's channels fails it, so it goes
+        # back to another worker (or fails for good) rather than finishing with gaps
+        missing = sorted(set(shard['channel_ids']) - self.channels_with_streams.keys())
+        if missing:
+            from .sweep_coordinator import SweepCatalogMismatch
+            raise SweepCatalogMismatch(f"shard {shard['shard_key']}: [{len(missing)}] channels not in this worker's "
+                                       f"catalog, e.g. {', '.join(missing[:5])}")
+        self.test_channels_with_streams(shard['country'], channel_ids=shard['channel_ids'], report=report)
+
+    def record_probe_results(self, batch_results, vpn_endpoint=None):
+        time_str = datetime.now(timezone.utc).strftime('%Y%m%d_%H%M')
+        results = []
+        for channel_id, channel_results in batch_results.items():
+            for index, return_code, latency_ms in channel_results:
+                result = 'OK' if return_code == 0 else 'FAIL'
+                self.logger.info(f"---- channel {channel_id} stream {index}: {result}")
+                stream = self.channels_with_streams[channel_id]['streams'][index]
+                stream['connect_status'] = result
+                stream['connect_test_time'] = time_str
+                results.append({
+                    'channel_id': channel_id,
+                    'url': stream.get('url'),
+                    'status': result,
+                    'return_code': return_code,
+                    'latency_ms': latency_ms,
+                    'vpn_endpoint': vpn_endpoint,
+                })
+        self.results_store.record_batch(results)
+        return results
 
     def test_two_streams(self):
         self.logger.info("testing two streams")
@@ -112,32 +299,49 @@ class IptvRecorder():
         else:
             self.logger.info('Non-VPN stream FAILED')
 
+    @traced('narrow_channels')
     def narrow_channels(self, country_id):
         self.logger.info(f"narrowing channels to {country_id}")
         self.logger.info(f"channel count before: [{len(self.channels)}]")
         self.channels = [x for x in self.channels if x.get('country').upper() == country_id.upper()]
+        self.channels_key = f"{self.channels_key.split(':')[0]}:{country_id}"
         self.logger.info(f"channel count after: [{len(self.channels)}]")
-        self.build_channel_lookups()
+        self.reset_channel_lookups()
 
+    @traced('streams_for_channels')
     def streams_for_channels(self):
+        # the keys come from the file digests, so an unchanged catalog is never parsed here
+        match_key = f"{self.channels_key}|{self.streams_key}"
+        channels_with_streams_path = channel_file_path('channels_with_streams.json')
+        if self.catalog_cache.get('channels_with_streams', 'key') == match_key and os.path.isfile(channels_with_streams_path):
+            # nothing upstream changed, keep the existing file.  It is not rewritten after
+            # probing, so the streams get their latest results from the results store.
+            self.logger.info("channels and streams unchanged, reusing channels_with_streams.json")
+            with open(channels_with_streams_path) as file:
+                self.channels_with_streams = json.load(file)
+            self.apply_latest_results()
+            return
+
         sfc = [x for x in self.streams if x.get('channel') in self.id_to_name.keys()]
         self.logger.info(f"[{len(sfc)}] streams exactly matching channel ids")
+        titles = {stream['title'] for stream in self.streams}
+        matches = self.catalog_cache.get_matches(self.channels_key, .8, titles)
+        new_titles = titles - matches.keys()
+        self.logger.info(f"[{len(matches)}] stream titles matched from cache, [{len(new_titles)}] to match")
+        new_matches = {}
+        counter = 0
+        for title in new_titles:
+            counter += 1
+            if counter % 100 == 0: self.logger.info(f'considering stream title {counter} of [{len(new_titles)}]')
+            new_matches[title] = self.channel_matcher.best_match(title, .8)[0]
+        self.catalog_cache.put_matches(self.channels_key, .8, new_matches)
+        matches.update(new_matches)
+
         channel_ids_to_streams = {}
         sfc2 = []
-        counter = 0
         for stream in self.streams:
-            counter += 1
-            if counter % 100 == 0: self.logger.info(f'considering stream {counter} of [{len(self.streams)}]')
-            best_score = 0
-            best_id = None
-            best_channel = None
-            title_clean = stream['title'].lower().replace(' hd', '').replace(' sd', '').replace(' tv', '').replace(' channel', '').strip()
-            for name_lower in self.name_to_id.keys():
-                score = SequenceMatcher(None, title_clean, name_lower).ratio()
-                if score > best_score and score >= .8:
-                    best_score = score
-                    best_id = self.name_to_id[name_lower]
-            if best_score:
+            best_id = matches.get(stream['title'])
+            if best_id:
                 if best_id in channel_ids_to_streams:
                     channel_ids_to_streams[best_id]['streams'].append(stream)
                 else:
@@ -151,60 +355,48 @@ class IptvRecorder():
         self.channels_with_streams = channel_ids_to_streams
         self.logger.info(f"[{len(sfc2)}] additional streams roughly matching channel ids")
         self.write_channels_with_streams()
+        self.catalog_cache.put('channels_with_streams', 'key', match_key)
 
     def write_channels_with_streams(self):
-        channels_with_streams_path = '/channel_files/channels_with_streams.json'
-        with open(channels_with_streams_path, 'w') as outfile:
-            print_str = json.dumps(self.channels_with_streams, indent=2)
-            outfile.write(print_str)
-
-    def load_channels_etc(self):
-      self.logger.info("loading channels")
-      with open('/channel_files/channels.json') as file:
-        self.channels = json.load(file)
-        self.logger.info(f"num chans is [{len(self.channels)}]")
-
-      with open('/channel_files/streams.json') as file:
-        self.streams = json.load(file)
-        self.logger.info(f"num streams is [{len(self.streams)}]")
+        # written to a temp file and swapped in, so a crash never leaves a half written file
+        channels_with_streams_path = channel_file_path('channels_with_streams.json')
+        tmp_path = f"{channels_with_streams_path}.tmp"
+        with open(tmp_path, 'w') as outfile:
+            json.dump(self.channels_with_streams, outfile, separators=(',', ':'))
+        os.replace(tmp_path, channels_with_streams_path)
 
-      with open('/channel_files/countries.json') as file:
-        self.countries = json.load(file)
-        self.logger.info(f"num countries is [{len(self.countries)}]")
+    def apply_latest_results(self):
+        # connect_status and connect_test_time of every stream from its newest probe result
+        latest = {(result['channel_id'], result['url']): result for result in self.results_store.latest_results()}
+        for channel_id, entry in self.channels_with_streams.items():
+            for stream in entry['streams']:
+                result = latest.get((channel_id, stream.get('url')))
+                if result:
+                    stream['connect_status'] = result['status']
+                    stream['connect_test_time'] = datetime.fromtimestamp(result['tested_at'], timezone.utc).strftime('%Y%m%d_%H%M')
 
-      with open('/channel_files/sites.md') as file:
-        self.md_text = ''.join(file.readlines())
+    def latest_good_streams(self):
+        return self.results_store.latest_good_streams()
 
-      with open('/channel_files/sd_iptv_channels_lookup.json') as file:
-        self.sd_iptv_channels_lookup = json.load(file)
-        self.logger.info(f"num sd lookups is [{len(self.sd_iptv_channels_lookup)}]")
+    @traced('load_channels_etc')
+    def load_channels_etc(self):
+        # everything up front, for callers that want the old eager startup
+        for name in ('channels', 'streams', 'countries', 'md_text', 'sd_iptv_channels_lookup'):
+            getattr(self, name)
 
     def parse_sites(self):
+        # sites.md lists guide providers under '## <country name>' headings
         self.logger.info("parsing sites")
-        country_to_providers_path = '/channel_files/country_to_providers.json'
-        if os.path.isfile(country_to_providers_path):
-            self.logger.info("prebuilt file found")
-            country_to_providers = json.load(country_to_providers_path)
-        else:
-            country_to_providers = defaultdict(list)
-            current_country = None
-            for line in self.md_text.splitlines():
-                if line.startswith('## '):
-                    current_country = line.strip('# ').lower()
-                    code = name_to_code.get(current_country)  # e.g., 'united kingdom' → 'gb'
-                    if code:
-                        current_code = code
-                elif line.startswith('- '):
-                    provider = line.strip('- `').rstrip('`')
-                    if current_code:
-                        country_to_providers[current_code].append(provider)
-            with open(country_to_providers_path, 'w') as outfile:
-                print_str = json.dumps(country_to_providers)
-                outfile.write(print_str)
-        titles = [x.get('title') for x in country_to_providers]
-        titles = sorted(set(titles))
-        self.logger.info(f"parsed sites for these titles: {titles}")
-        return country_to_providers
+        country_to_providers = defaultdict(list)
+        current_code = None
+        for line in self.md_text.splitlines():
+            if line.startswith('## '):
+                # e.g. 'united kingdom' → 'uk', providers under a country we do not know are dropped
+                current_code = self.name_to_code.get(line.strip('# ').lower())
+            elif line.startswith('- ') and current_code:
+                country_to_providers[current_code].append(line.strip('- `').rstrip('`'))
+        self.logger.info(f"parsed sites for these countries: {sorted(country_to_providers)}")
+        return dict(country_to_providers)
 
     def get_info_for_stream(self, stream):
         self.logger.info(f"getting info for stream {stream}")
@@ -216,14 +408,7 @@ class IptvRecorder():
                 'name': self.id_to_name.get(cid)
             }
         else:  # Fuzzy match title to channels.json name
-            title_clean = stream['title'].lower().replace(' hd', '').replace(' sd', '').replace(' tv', '').replace(' channel', '').strip()
-            best_id = None
-            best_score = 0
-            for name_lower, possible_id in self.name_to_id.items():
-                score = SequenceMatcher(None, title_clean, name_lower).ratio()
-                if score > best_score and score >= 0.75:
-                    best_score = score
-                    best_id = possible_id
+            best_id, best_score = self.channel_matcher.best_match(stream['title'], 0.75)
             if best_id:
                 return {
                     'id': best_id,
@@ -237,120 +422,63 @@ class IptvRecorder():
                     'name': stream['title']
                 }
 
+    @traced('scan_for_valid_streams')
     def scan_for_valid_streams(self, country_in=None):
         self.logger.info(f"scanning for valid streams for country {country_in}")
+        # country codes are upper case in channels.json and lower case in the lookups and on the command line
+        country_in = country_in.lower() if country_in else None
+        # group streams by channel so each channel's guide is resolved once
+        candidates = {}
         for stream in self.streams:
             info = self.get_info_for_stream(stream)
-            if country_in and info and info.get('country') != country_in:
+            if country_in and (info.get('country') or '').lower() != country_in:
                 continue
             if info['id']:  # Has universal ID
-                country = info['country'].lower() if info['country'] else ''
-                providers = self.country_to_providers.get(country, [])  # ← use the dict here!
-                epg = self.get_epg_for_channel(info['id'], country, providers)
-                if epg:
-                    valid_count += 1
-                    valid_streams.append({
-                        'stream_url': stream['url'],
-                        'id': info['id'],
-                        'country': info['country'],
-                        'name': info['name'],
-                        'epg_count': len(epg)
-                    })
+                if info['id'] not in candidates:
+                    candidates[info['id']] = {'info': info, 'streams': []}
+                candidates[info['id']]['streams'].append(stream)
             # Else: skip as useless
 
-        self.logger.info(f"Valid streams with EPG: {len(valid_streams)}")
+        channel_guides = {}
+        for channel_id, candidate in candidates.items():
+            country = candidate['info']['country'].lower() if candidate['info']['country'] else ''
+            providers = self.country_to_providers.get(country, [])
+            channel_guides[channel_id] = [
+                self.epg_fetcher.guide_url(self.xml_dir_map.get(country, country), provider) for provider in providers
+            ]
+        epgs = self.epg_fetcher.resolve(channel_guides)
+
+        latest_good = self.results_store.latest_good_streams()
+        valid_streams = []
+        for channel_id, epg in epgs.items():
+            info = candidates[channel_id]['info']
+            for stream in candidates[channel_id]['streams']:
+                valid_streams.append({
+                    'stream_url': stream['url'],
+                    'id': channel_id,
+                    'country': info['country'],
+                    'name': info['name'],
+                    'epg_count': len(epg),
+                    'probed_ok': latest_good.get(channel_id, {}).get('url') == stream['url'],
+                })
+        # best first: streams confirmed by a probe, then channels with the most listings
+        valid_streams.sort(key=lambda x: (x['probed_ok'], x['epg_count']), reverse=True)
+
+        self.logger.info(f"Valid streams with EPG: {len(valid_streams)} across {len(epgs)} channels")
         return valid_streams
 
+    @traced('get_epg_for_channel')
     def get_epg_for_channel(self, channel_id: str, country: str, providers: list) -> list:
         self.logger.info(f"getting epg for channel {channel_id}, country {country}, providers {providers}")
+        country = country.lower()
         if not providers:
             self.logger.info(f"No providers found for country '{country}' - skipping EPG for {channel_id}")
             return []
         self.logger.debug(f"Attempting EPG for {channel_id} in {country} with providers: {providers}")
         for provider in providers:
-            xml_url = f"https://iptv-org.github.io/epg/guides/{xml_dir_map.get(country, country)}/{provider}.xml"
+            xml_url = self.epg_fetcher.guide_url(self.xml_dir_map.get(country, country), provider)
             self.logger.debug(f"Trying {xml_url}")
-            try:
-                response = requests.get(xml_url, timeout=10)
-                if response.status_code != 200:
-                    continue
-                root = ET.fromstring(response.content)
-                # Check if channel exists
-                if any(ch.get('id') == channel_id for ch in root.findall('channel')):
-                    programs = []
-                    for prog in root.findall('programme'):
-                        if prog.get('channel') == channel_id:
-                            title = prog.find('title').text if prog.find('title') is not None else None
-                            start = prog.get('start')  # e.g., "20260122180000 +0000"
-                            stop = prog.get('stop')
-                            desc = prog.find('desc').text if prog.find('desc') is not None else None
-                            category = [cat.text for cat in prog.findall('category')] if prog.findall('category') else []
-                            programs.append({
-                                'start': start,
-                                'stop': stop,
-                                'title': title,
-                                'desc': desc,
-                                'categories': category
-                            })
-                    if programs:  # Found listings
-                        return programs  # List of dicts, sorted by start time naturally
-            except Exception:
-                continue
+            programs = self.epg_fetcher.programmes_for_channel(xml_url, channel_id)
+            if programs:  # Found listings
+                return programs  # List of dicts, sorted by start time naturally
         return []  # No EPG found across providers
-
-
-#def get_proxy_base(vpn_country):
-#    # Map vpn_country to proxy container name/IP
-#    if vpn_country == "uk":
-#        return "http://vpn-uk:8080/p/"  # or the proxy's single-stream path
-#    # Add more for ca, etc.
-#    return ""  # direct
-#
-#def record_stream(schedule_id):
-#    session = db_conn.Session()
-#    schedule = session.query(Schedule).get(schedule_id)
-#    if not schedule:
-#        return
-#
-#    channel = schedule.channel
-#    program = schedule.program
-#
-#    recording = Recording(
-#        schedule_id=schedule.id,
-#        channel_id=channel.id,
-#        program_id=program.id,
-#        start_time=schedule.start_time,
-#        end_time=schedule.end_time,
-#        status=RecordingStatus.RECORDING
-#    )
-#    session.add(recording)
-#    session.commit()
-#
-#    url = channel.tuning_json.get("url")
-#    if channel.geo_blocked:
-#        url = get_proxy_base(channel.vpn_country) + url
-#
-#    duration = (schedule.end_time - schedule.start_time).total_seconds()
-#    output_file = f"/mnt/recordings/{channel.name}_{program.title}_{schedule.start_time.strftime('%Y%m%d_%H%M')}.ts"
-#
-#    cmd = [
-#        "ffmpeg",
-#        "-i", url,
-#        "-t", str(duration),
-#        "-c", "copy",
-#        output_file
-#    ]
-#
-#    process = POPEN(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-#    stdout, stderr = process.communicate()
-#    recording.completed_at = datetime.now(timezone.utc)
-#    if process.returncode == 0:
-#        recording.status = RecordingStatus.COMPLETED
-#        recording.file_path = output_file
-#    else:
-#        recording.status = RecordingStatus.FAILED
-#        recording.error_message = stderr.decode()
-#
-#    session.commit()
-#    session.close()
-
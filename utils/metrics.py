@@ -0,0 +1,233 @@
+import bisect
+import contextvars
+import functools
+import http.server
+import itertools
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# No imports from the rest of utils, the VPN sidecar ships this file on its own.
+
+# like the tunnel proxies, only reachable from the host unless METRICS_BIND says otherwise
+METRICS_BIND_ADDRESS = os.getenv("METRICS_BIND", "127.0.0.1")
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in pairs) + '}'
+
+
+class Metric():
+    kind = None
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.values = {}  # label values tuple -> value
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labelnames)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+
+    def samples(self):
+        with self.lock:
+            values = dict(self.values)
+        return [f"{self.name}{format_labels(self.labelnames, key)} {value}" for key, value in values.items()]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    # either set directly, or read from callback() -> {label values tuple: value} when scraped
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, labelnames=(), callback=None):
+        super().__init__(name, help_text, labelnames)
+        self.callback = callback
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def samples(self):
+        if self.callback is None:
+            return super().samples()
+        try:
+            values = self.callback()
+        except Exception:
+            return []
+        if values is None:
+            # nothing to report right now
+            return []
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [f"{self.name}{format_labels(self.labelnames, key)} {value}" for key, value in values.items()]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.values.get(key)
+            if series is None:
+                series = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def samples(self):
+        with self.lock:
+            values = {key: (list(counts), total, count) for key, (counts, total, count) in self.values.items()}
+        lines = []
+        for key, (counts, total, count) in values.items():
+            for bound, cumulative in zip(self.buckets + ('+Inf',), itertools.accumulate(counts)):
+                lines.append(f"{self.name}_bucket{format_labels(self.labelnames, key, [('le', bound)])} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labelnames, key)} {total}")
+            lines.append(f"{self.name}_count{format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class MetricsRegistry():
+    # Counters, gauges and histograms kept in process and rendered in the
+    # Prometheus text format on scrape.  Updating a metric is a dict update under
+    # its own lock, cheap enough to leave on everywhere.  Asking for a metric that
+    # already exists returns it, so modules can declare what they use at import.
+    def __init__(self, max_spans=1000):
+        self.metrics = {}
+        self.lock = threading.Lock()
+        self.spans = deque(maxlen=max_spans)
+        self.span_ids = itertools.count(1)
+        self.current_span = contextvars.ContextVar('current_span', default=None)
+        self.span_seconds = self.histogram('span_duration_seconds', 'Duration of traced operations', ('span', 'outcome'))
+
+    def register(self, cls, name, *args, **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, *args, **kwargs)
+            elif kwargs.get('callback'):
+                metric.callback = kwargs['callback']
+            return metric
+
+    def counter(self, name, help_text, labelnames=()):
+        return self.register(Counter, name, help_text, labelnames)
+
+    def gauge(self, name, help_text, labelnames=(), callback=None):
+        return self.register(Gauge, name, help_text, labelnames, callback=callback)
+
+    def histogram(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram, name, help_text, labelnames, buckets=buckets)
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            samples = metric.samples()
+            if samples:
+                lines += metric.header() + samples
+        return '\n'.join(lines) + '\n'
+
+    @contextmanager
+    def span(self, name, **attributes):
+        # times the block into span_duration_seconds and keeps the last max_spans
+        # finished spans, nested spans point at their parent
+        span = {'id': next(self.span_ids), 'name': name, 'parent': self.current_span.get(), 'attributes': attributes}
+        token = self.current_span.set(span['id'])
+        start = time.perf_counter()
+        span['start'] = time.time()
+        outcome = 'ok'
+        try:
+            yield span
+        except BaseException:
+            outcome = 'error'
+            raise
+        finally:
+            self.current_span.reset(token)
+            span['secs'] = time.perf_counter() - start
+            span['outcome'] = outcome
+            self.span_seconds.observe(span['secs'], span=name, outcome=outcome)
+            self.spans.append(span)
+
+    def recent_spans(self, name=None, limit=100):
+        spans = [span for span in list(self.spans) if name is None or span['name'] == name]
+        return spans[-limit:]
+
+
+REGISTRY = MetricsRegistry()
+span = REGISTRY.span
+
+
+def traced(name):
+    # runs the decorated function inside span(name)
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with REGISTRY.span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def start_metrics_server(port, registry=REGISTRY, host=None):
+    # /metrics and /spans for processes that have no web server of their own
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            route = self.path.split('?')[0]
+            if route == '/metrics':
+                body, content_type = registry.render().encode(), 'text/plain; version=0.0.4'
+            elif route == '/spans':
+                body, content_type = json.dumps(registry.recent_spans()).encode(), 'application/json'
+            else:
+                self.send_response(404)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer((host or METRICS_BIND_ADDRESS, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,122 @@
+import os
+import sqlite3
+import time
+from .catalog_loader import channel_file_path
+from .metrics import REGISTRY
+from .stream_probe import PROBE_FORBIDDEN, PROBE_UNAVAILABLE
+
+PROBE_CACHE_PATH = os.getenv("PROBE_CACHE_PATH", channel_file_path('probe_cache.sqlite'))
+
+# a 403 depends on the VPN endpoint and an unavailable probe on the sidecar, neither on the stream
+UNCACHED_CODES = (PROBE_FORBIDDEN, PROBE_UNAVAILABLE)
+
+CACHE_LOOKUPS = REGISTRY.counter('iptv_probe_cache_lookups_total', 'Probe cache lookups by result (hit, stale, miss)', ('result',))
+
+
+class ProbeCache():
+    # Last probe result per (url, vpn country) in SQLite, so a sweep only probes
+    # streams whose result is stale or missing.  Good results live for ttl
+    # seconds, failures for negative_ttl doubled on every consecutive failure up
+    # to max_backoff, and the least recently used entries are evicted past
+    # max_entries.  403s and probes that never ran are not cached, the next
+    # sweep probes those streams again.
+    def __init__(self, logger, path=None, ttl=None, negative_ttl=None, max_backoff=None, max_entries=None):
+        self.logger = logger
+        self.path = path or PROBE_CACHE_PATH
+        self.ttl = ttl or int(os.getenv("PROBE_CACHE_TTL", "21600"))
+        self.negative_ttl = negative_ttl or int(os.getenv("PROBE_CACHE_NEGATIVE_TTL", "3600"))
+        self.max_backoff = max_backoff or int(os.getenv("PROBE_CACHE_MAX_BACKOFF", "604800"))
+        self.max_entries = max_entries or int(os.getenv("PROBE_CACHE_MAX_ENTRIES", "200000"))
+        self.stats = {'hits': 0, 'stale': 0, 'misses': 0}
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS probe_cache (
+                url TEXT NOT NULL,
+                country TEXT NOT NULL,
+                return_code INTEGER,
+                tested_at REAL NOT NULL,
+                expires_at REAL NOT NULL,
+                failures INTEGER NOT NULL DEFAULT 0,
+                last_access REAL NOT NULL,
+                PRIMARY KEY (country, url)
+            );
+            CREATE INDEX IF NOT EXISTS probe_cache_last_access ON probe_cache (last_access);
+        ''')
+
+    def lookup(self, urls, country, chunk_size=500):
+        # {url: {'return_code', 'tested_at', 'fresh', 'failures'}} for the urls we have any result for
+        now = time.time()
+        found = {}
+        urls = list({url for url in urls if url})
+        for start in range(0, len(urls), chunk_size):
+            chunk = urls[start:start + chunk_size]
+            rows = self.conn.execute(
+                f"SELECT url, return_code, tested_at, expires_at, failures FROM probe_cache "
+                f"WHERE country = ? AND url IN ({', '.join('?' * len(chunk))})",
+                [country] + chunk
+            )
+            for url, return_code, tested_at, expires_at, failures in rows:
+                found[url] = {'return_code': return_code, 'tested_at': tested_at, 'fresh': expires_at > now, 'failures': failures}
+        fresh = [url for url, entry in found.items() if entry['fresh']]
+        self.stats['hits'] += len(fresh)
+        self.stats['stale'] += len(found) - len(fresh)
+        self.stats['misses'] += len(urls) - len(found)
+        CACHE_LOOKUPS.inc(len(fresh), result='hit')
+        CACHE_LOOKUPS.inc(len(found) - len(fresh), result='stale')
+        CACHE_LOOKUPS.inc(len(urls) - len(found), result='miss')
+        with self.conn:
+            for start in range(0, len(fresh), chunk_size):
+                chunk = fresh[start:start + chunk_size]
+                self.conn.execute(
+                    f"UPDATE probe_cache SET last_access = ? WHERE country = ? AND url IN ({', '.join('?' * len(chunk))})",
+                    [now, country] + chunk
+                )
+        return found
+
+    def expiry(self, return_code, failures, now):
+        if return_code == 0:
+            return now + self.ttl
+        return now + min(self.negative_ttl * 2 ** (failures - 1), self.max_backoff)
+
+    def store(self, results, country):
+        # results: [(url, return_code), ...] from a finished probe batch
+        now = time.time()
+        results = [(url, return_code) for url, return_code in results if return_code not in UNCACHED_CODES]
+        if not results:
+            return
+        urls = [url for url, _ in results]
+        previous = {}
+        for start in range(0, len(urls), 500):
+            chunk = urls[start:start + 500]
+            previous.update(self.conn.execute(
+                f"SELECT url, failures FROM probe_cache WHERE country = ? AND url IN ({', '.join('?' * len(chunk))})",
+                [country] + chunk
+            ))
+        rows = []
+        for url, return_code in results:
+            failures = 0 if return_code == 0 else previous.get(url, 0) + 1
+            rows.append((url, country, return_code, now, self.expiry(return_code, failures, now), failures, now))
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO probe_cache VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+        self.evict()
+
+    def evict(self):
+        count = self.conn.execute('SELECT COUNT(*) FROM probe_cache').fetchone()[0]
+        if count <= self.max_entries:
+            return 0
+        with self.conn:
+            deleted = self.conn.execute('''
+                DELETE FROM probe_cache WHERE rowid IN (
+                    SELECT rowid FROM probe_cache ORDER BY last_access LIMIT ?
+                )
+            ''', (count - self.max_entries,)).rowcount
+        self.logger.info(f"probe cache evicted [{deleted}] least recently used entries")
+        return deleted
+
+    def hit_rate(self):
+        total = sum(self.stats.values())
+        return round(self.stats['hits'] / total, 3) if total else None
+
+    def report(self):
+        return dict(self.stats, hit_rate=self.hit_rate())
@@ -0,0 +1,109 @@
+import os
+import queue
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+from .metrics import REGISTRY
+from .stream_probe import PROBE_UNAVAILABLE, probe_outcome
+
+PROBE_SECONDS = REGISTRY.histogram('iptv_probe_duration_seconds', 'Stream probe time by outcome', ('outcome',))
+
+
+def url_host(url):
+    return urlparse(url or '').hostname or ''
+
+
+class ProbeScheduler():
+    # Runs probe_fn(url) for many streams at once.  max_workers caps the number of
+    # probes (ffprobe subprocesses) in flight, per_host_limit caps how many of those
+    # can hit the same host, and channels are handed out in batches so results can
+    # be written back after each batch instead of once at the end.  Each host has
+    # its own queue and a probe is only handed to the pool once its host has a free
+    # slot, so a worker never sits blocked behind a busy host while other hosts wait.
+    def __init__(self, logger, probe_fn, max_workers=None, per_host_limit=None, batch_size=None, max_retries=None):
+        self.logger = logger
+        self.probe_fn = probe_fn
+        self.max_workers = max_workers or int(os.getenv("PROBE_CONCURRENCY", "16"))
+        self.per_host_limit = per_host_limit or int(os.getenv("PROBE_PER_HOST_LIMIT", "2"))
+        self.batch_size = batch_size or int(os.getenv("PROBE_BATCH_CHANNELS", "25"))
+        self.max_retries = max_retries if max_retries is not None else int(os.getenv("PROBE_MAX_RETRIES", "3"))
+
+    def probe(self, url):
+        # returns (return_code, latency_ms)
+        start = time.monotonic()
+        return_code = self.probe_fn(url)
+        secs = time.monotonic() - start
+        PROBE_SECONDS.observe(secs, outcome=probe_outcome(return_code))
+        return return_code, secs * 1000
+
+    def probe_all(self, executor, jobs):
+        # jobs: [(key, url)], returns {key: (return_code, latency_ms)}
+        host_queues = defaultdict(deque)
+        for key, url in jobs:
+            host_queues[url_host(url)].append((key, url))
+        hosts = deque(host_queues)
+        in_flight = defaultdict(int)
+        running = 0
+        completed = queue.Queue()
+        results = {}
+        while hosts or running:
+            # hand out free slots round robin over the hosts that still have work and room
+            for _ in range(len(hosts)):
+                if running >= self.max_workers:
+                    break
+                host = hosts[0]
+                hosts.rotate(-1)
+                if in_flight[host] >= self.per_host_limit:
+                    continue
+                key, url = host_queues[host].popleft()
+                if not host_queues[host]:
+                    hosts.remove(host)
+                in_flight[host] += 1
+                running += 1
+                future = executor.submit(self.probe, url)
+                future.add_done_callback(lambda future, key=key, host=host: completed.put((key, host, future)))
+            key, host, future = completed.get()
+            in_flight[host] -= 1
+            running -= 1
+            try:
+                results[key] = future.result()
+            except Exception as e:
+                self.logger.error(f"probe for {key} raised: {e}")
+                results[key] = (PROBE_UNAVAILABLE, None)
+        return results
+
+    def run(self, channel_streams, on_batch, limit=None, should_probe=None):
+        # channel_streams: {channel_id: [stream, ...]}
+        # on_batch({channel_id: [(stream_index, return_code, latency_ms), ...]}) is called as each batch finishes,
+        # and can return [(channel_id, stream_index), ...] to probe again (403s after a rotation), which are then
+        # reported in a batch of their own, up to max_retries times
+        # should_probe(stream), if given, skips the streams it returns False for
+        channel_ids = list(channel_streams.keys())
+        submitted = 0
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for batch_start in range(0, len(channel_ids), self.batch_size):
+                batch_ids = channel_ids[batch_start:batch_start + self.batch_size]
+                self.logger.info(f"probing channels {batch_start + 1}-{batch_start + len(batch_ids)} of [{len(channel_ids)}]")
+                jobs = []
+                for channel_id in batch_ids:
+                    for index, stream in enumerate(channel_streams[channel_id]):
+                        if limit is not None and submitted >= limit:
+                            break
+                        if should_probe and not should_probe(stream):
+                            continue
+                        jobs.append(((channel_id, index), stream.get('url')))
+                        submitted += 1
+                for attempt in range(self.max_retries + 1):
+                    if not jobs:
+                        break
+                    batch_results = defaultdict(list)
+                    for (channel_id, index), (return_code, latency_ms) in self.probe_all(executor, jobs).items():
+                        batch_results[channel_id].append((index, return_code, latency_ms))
+                    retries = on_batch(batch_results) or []
+                    if retries and attempt < self.max_retries:
+                        self.logger.info(f"probing {len(retries)} streams again")
+                    jobs = [((channel_id, index), channel_streams[channel_id][index].get('url')) for channel_id, index in retries]
+                if limit is not None and submitted >= limit:
+                    self.logger.info(f"probe limit of {limit} reached")
+                    break
@@ -0,0 +1,176 @@
+from tv_detection_common.models import Schedule
+from datetime import datetime, timedelta, timezone
+import heapq
+import os
+import select
+import threading
+from sqlalchemy import and_, func, or_
+from .capture_engine import as_utc
+
+SCHEDULE_NOTIFY_CHANNEL = "schedules_changed"
+# the schedule column bumped on every write, if the models have one
+CHANGED_COLUMN = next((name for name in ('updated_at', 'modified_at') if hasattr(Schedule, name)), None)
+
+
+class RecordingScheduler():
+    # Keeps upcoming schedules in a heap ordered by start time and sleeps until the
+    # next one is due (start minus pre_roll), handing it to the capture engine.
+    # Every refresh_interval the rows changed since the last look are picked up
+    # by their updated_at watermark, new and edited alike (by id watermark, new
+    # rows only, if Schedule has no such column).  A full reload every
+    # full_refresh_interval catches deleted rows and late commits.  On
+    # Postgres a LISTEN on schedules_changed wakes it up as soon as a trigger or
+    # writer sends NOTIFY.
+    def __init__(self, logger, db_conn, capture_engine, pre_roll=None, grace=None,
+                 refresh_interval=60, full_refresh_interval=900):
+        self.logger = logger
+        self.db_conn = db_conn
+        self.capture_engine = capture_engine
+        self.pre_roll = timedelta(seconds=pre_roll if pre_roll is not None else int(os.getenv("RECORDING_PRE_ROLL", "30")))
+        # schedules that started up to this long ago are still worth joining late
+        self.grace = timedelta(seconds=grace if grace is not None else int(os.getenv("RECORDING_GRACE", "300")))
+        self.refresh_interval = refresh_interval
+        self.full_refresh_interval = full_refresh_interval
+        self.heap = []  # (start_time, schedule_id)
+        self.start_times = {}  # schedule_id -> start_time of its live heap entry
+        self.watermark = 0
+        self.changed_since = None
+        if not CHANGED_COLUMN:
+            logger.info("Schedule has no updated_at column, edited schedules wait for the full reload")
+        self.last_refresh = None
+        self.last_full_refresh = None
+        self.wake = threading.Event()
+        self.stopping = threading.Event()
+
+    def push(self, schedule_id, start_time):
+        if self.start_times.get(schedule_id) == start_time:
+            return
+        # any older entry for this id is now stale and skipped when popped
+        self.start_times[schedule_id] = start_time
+        heapq.heappush(self.heap, (start_time, schedule_id))
+
+    def upcoming_query(self, session, now):
+        return session.query(Schedule.id, Schedule.start_time).filter(
+            Schedule.start_time > now - self.grace,
+            ~Schedule.recording.has()
+        )
+
+    def full_refresh(self, now):
+        with self.db_conn.Session() as session:
+            rows = self.upcoming_query(session, now).all()
+            if CHANGED_COLUMN:
+                # the database's own clock, so a skewed recorder clock cannot skip edits
+                self.changed_since = session.query(func.max(getattr(Schedule, CHANGED_COLUMN))).scalar()
+        self.heap = []
+        self.start_times = {}
+        for schedule_id, start_time in rows:
+            self.push(schedule_id, as_utc(start_time))
+            self.watermark = max(self.watermark, schedule_id)
+        self.last_full_refresh = self.last_refresh = now
+        self.logger.info(f"scheduler loaded [{len(self.start_times)}] upcoming schedules")
+
+    def incremental_refresh(self, now):
+        if CHANGED_COLUMN:
+            self.changed_refresh(now)
+            return
+        with self.db_conn.Session() as session:
+            rows = self.upcoming_query(session, now).filter(Schedule.id > self.watermark).all()
+        for schedule_id, start_time in rows:
+            self.push(schedule_id, as_utc(start_time))
+            self.watermark = max(self.watermark, schedule_id)
+        self.last_refresh = now
+        if rows:
+            self.logger.info(f"scheduler picked up [{len(rows)}] new schedules")
+
+    def changed_refresh(self, now):
+        # >= because rows written in the same instant as the watermark may not all have been
+        # seen yet, pushing one twice is a no-op.  Rows written without a changed time fall
+        # back to the id watermark: new ones come in here, edits to them wait for the full reload.
+        changed_at = getattr(Schedule, CHANGED_COLUMN)
+        unstamped = and_(changed_at.is_(None), Schedule.id > self.watermark)
+        with self.db_conn.Session() as session:
+            query = session.query(Schedule.id, Schedule.start_time, Schedule.recording.has(), changed_at)
+            if self.changed_since is not None:
+                query = query.filter(or_(changed_at >= self.changed_since, unstamped))
+            else:
+                query = query.filter(or_(changed_at.isnot(None), unstamped))
+            rows = query.all()
+        for schedule_id, start_time, recorded, changed in rows:
+            start_time = as_utc(start_time)
+            if recorded or start_time <= now - self.grace:
+                # no longer upcoming, its heap entry goes stale
+                self.start_times.pop(schedule_id, None)
+            else:
+                self.push(schedule_id, start_time)
+            if changed is not None and (self.changed_since is None or changed > self.changed_since):
+                self.changed_since = changed
+            self.watermark = max(self.watermark, schedule_id)
+        self.last_refresh = now
+        if rows:
+            self.logger.info(f"scheduler picked up [{len(rows)}] new or changed schedules")
+
+    def refresh(self, now, full=False):
+        if full or self.last_full_refresh is None or now - self.last_full_refresh >= timedelta(seconds=self.full_refresh_interval):
+            self.full_refresh(now)
+        elif now - self.last_refresh >= timedelta(seconds=self.refresh_interval):
+            self.incremental_refresh(now)
+
+    def dispatch_due(self, now):
+        while self.heap and self.heap[0][0] - self.pre_roll <= now:
+            start_time, schedule_id = heapq.heappop(self.heap)
+            if self.start_times.get(schedule_id) != start_time:
+                continue
+            del self.start_times[schedule_id]
+            if now - start_time > self.grace:
+                continue
+            self.logger.info(f"schedule {schedule_id} starting at {start_time} is due")
+            self.capture_engine.submit(schedule_id)
+
+    def seconds_until_next(self, now):
+        wait = self.refresh_interval
+        if self.heap:
+            wait = min(wait, (self.heap[0][0] - self.pre_roll - now).total_seconds())
+        return max(wait, 0)
+
+    def run(self):
+        self.logger.info("entering scheduler loop")
+        self.start_listener()
+        while not self.stopping.is_set():
+            now = datetime.now(timezone.utc)
+            notified = self.wake.is_set()
+            self.wake.clear()
+            try:
+                self.refresh(now, full=notified)
+            except Exception as e:
+                self.logger.error(f"scheduler refresh failed: {e}")
+            self.dispatch_due(now)
+            self.wake.wait(self.seconds_until_next(datetime.now(timezone.utc)))
+
+    def stop(self):
+        self.stopping.set()
+        self.wake.set()
+
+    def start_listener(self):
+        if self.db_conn.engine.dialect.name != 'postgresql':
+            return
+        threading.Thread(target=self.listen, args=(self.db_conn.engine,), daemon=True).start()
+
+    def listen(self, engine):
+        conn = engine.raw_connection()
+        try:
+            dbapi_conn = conn.driver_connection
+            dbapi_conn.autocommit = True
+            with dbapi_conn.cursor() as cursor:
+                cursor.execute(f"LISTEN {SCHEDULE_NOTIFY_CHANNEL}")
+            self.logger.info(f"listening for {SCHEDULE_NOTIFY_CHANNEL} notifications")
+            while not self.stopping.is_set():
+                if select.select([dbapi_conn], [], [], 5) == ([], [], []):
+                    continue
+                dbapi_conn.poll()
+                if dbapi_conn.notifies:
+                    dbapi_conn.notifies.clear()
+                    self.wake.set()
+        except Exception as e:
+            self.logger.error(f"schedule listener stopped, falling back to polling: {e}")
+        finally:
+            conn.close()
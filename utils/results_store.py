@@ -0,0 +1,115 @@
+import os
+import sqlite3
+import time
+from contextlib import closing
+from .catalog_loader import channel_file_path
+
+RESULTS_STORE_PATH = os.getenv("RESULTS_STORE_PATH", channel_file_path('probe_results.sqlite'))
+
+
+class ResultsStore():
+    # Append-only log of probe results.  Each batch is one transaction, so a crash
+    # loses at most the batch in flight, and compact() trims old history.
+    def __init__(self, logger, path=None):
+        self.logger = logger
+        self.path = path or RESULTS_STORE_PATH
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS probe_results (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                channel_id TEXT NOT NULL,
+                url TEXT NOT NULL,
+                status TEXT NOT NULL,
+                return_code INTEGER,
+                tested_at REAL NOT NULL,
+                latency_ms REAL,
+                vpn_endpoint TEXT
+            );
+            CREATE INDEX IF NOT EXISTS probe_results_channel_url ON probe_results (channel_id, url, tested_at);
+        ''')
+
+    def record_batch(self, results):
+        # results: iterable of dicts with channel_id, url, status, return_code, latency_ms, vpn_endpoint
+        now = time.time()
+        rows = [(
+            result['channel_id'],
+            result['url'],
+            result['status'],
+            result.get('return_code'),
+            result.get('tested_at', now),
+            result.get('latency_ms'),
+            result.get('vpn_endpoint'),
+        ) for result in results]
+        with self.conn:
+            self.conn.executemany(
+                'INSERT INTO probe_results (channel_id, url, status, return_code, tested_at, latency_ms, vpn_endpoint) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                rows
+            )
+        return len(rows)
+
+    def latest_results(self, channel_id=None):
+        # newest result for every (channel, url)
+        query = '''
+            SELECT channel_id, url, status, return_code, MAX(tested_at), latency_ms, vpn_endpoint
+            FROM probe_results {where}
+            GROUP BY channel_id, url
+        '''
+        params = ()
+        where = ''
+        if channel_id:
+            where = 'WHERE channel_id = ?'
+            params = (channel_id,)
+        columns = ('channel_id', 'url', 'status', 'return_code', 'tested_at', 'latency_ms', 'vpn_endpoint')
+        return [dict(zip(columns, row)) for row in self.conn.execute(query.format(where=where), params)]
+
+    def latest_good_streams(self):
+        # {channel_id: result} for the most recently confirmed OK url of each channel,
+        # only counting urls whose latest probe was OK
+        good = {}
+        for result in self.latest_results():
+            if result['status'] != 'OK':
+                continue
+            current = good.get(result['channel_id'])
+            if not current or result['tested_at'] > current['tested_at']:
+                good[result['channel_id']] = result
+        return good
+
+    def alternate_urls(self, url, limit=5):
+        # other urls of the channel(s) url was probed for whose latest probe was OK, fastest first.
+        # Called from the capture supervisor thread, so on a connection of its own.
+        with closing(sqlite3.connect(self.path)) as conn:
+            rows = conn.execute('''
+                SELECT url, status, latency_ms, MAX(tested_at) FROM probe_results
+                WHERE channel_id IN (SELECT DISTINCT channel_id FROM probe_results WHERE url = ?) AND url != ?
+                GROUP BY channel_id, url
+            ''', (url, url)).fetchall()
+        good = sorted((latency_ms is None, latency_ms or 0, other) for other, status, latency_ms, _ in rows if status == 'OK')
+        return list(dict.fromkeys(other for _, _, other in good))[:limit]
+
+    def compact(self, keep_per_url=5, older_than_days=None, vacuum_fraction=0.25):
+        # keep the newest keep_per_url rows per (channel, url), and optionally drop
+        # anything older than older_than_days.  The file is only rewritten (VACUUM)
+        # once at least vacuum_fraction of the rows went, SQLite reuses the free
+        # pages of smaller deletes anyway.
+        with self.conn:
+            deleted = self.conn.execute('''
+                DELETE FROM probe_results WHERE id IN (
+                    SELECT id FROM (
+                        SELECT id, ROW_NUMBER() OVER (
+                            PARTITION BY channel_id, url ORDER BY tested_at DESC, id DESC
+                        ) AS position
+                        FROM probe_results
+                    ) WHERE position > ?
+                )
+            ''', (keep_per_url,)).rowcount
+            if older_than_days is not None:
+                cutoff = time.time() - older_than_days * 86400
+                deleted += self.conn.execute('DELETE FROM probe_results WHERE tested_at < ?', (cutoff,)).rowcount
+        remaining = self.conn.execute('SELECT COUNT(*) FROM probe_results').fetchone()[0]
+        vacuum = deleted > 0 and deleted >= vacuum_fraction * (deleted + remaining)
+        if vacuum:
+            self.conn.execute('VACUUM')
+        self.logger.info(f"compacted probe results, removed [{deleted}] rows, [{remaining}] left{', vacuumed' if vacuum else ''}")
+        return deleted
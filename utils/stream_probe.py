@@ -0,0 +1,187 @@
+import os
+import re
+import threading
+import time
+from urllib.parse import urljoin, urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+# probe return codes, 0 and 1 keep their old meaning (ok / geo-blocked)
+PROBE_OK = 0
+PROBE_FORBIDDEN = 1
+PROBE_FAILED = 2
+PROBE_TIMEOUT = 3
+PROBE_DEAD = 4
+# the probe could not run at all (no tunnel, sidecar down), which says nothing about the stream
+PROBE_UNAVAILABLE = 5
+PROBE_OUTCOMES = {PROBE_OK: 'ok', PROBE_FORBIDDEN: 'forbidden', PROBE_FAILED: 'failed', PROBE_TIMEOUT: 'timeout', PROBE_DEAD: 'dead',
+                  PROBE_UNAVAILABLE: 'unavailable'}
+
+FORBIDDEN_STATUSES = (401, 403, 451)
+DEAD_STATUSES = (404, 410)
+TIMEOUT_STATUSES = (408, 504, 522, 524)
+# KEY=value or KEY="quoted, with commas"
+PLAYLIST_ATTRIBUTE = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)')
+
+
+def probe_outcome(return_code):
+    # metric label for a probe return code, anything unknown (None included) is 'other' rather than 'None'
+    return PROBE_OUTCOMES.get(return_code, 'other')
+
+
+def proxy_unreachable(error):
+    # requests' ProxyError wraps urllib3's, whose original_error is why the proxy could not be used
+    reason = getattr(error.args[0] if error.args else None, 'reason', None)
+    original = getattr(reason, 'original_error', reason)
+    return isinstance(original, (NewConnectionError, ConnectionError))
+
+
+def classify_status(status_code):
+    if 200 <= status_code < 300:
+        return PROBE_OK
+    if status_code in FORBIDDEN_STATUSES:
+        return PROBE_FORBIDDEN
+    if status_code in DEAD_STATUSES:
+        return PROBE_DEAD
+    if status_code in TIMEOUT_STATUSES:
+        return PROBE_TIMEOUT
+    return PROBE_FAILED
+
+
+def is_playlist(body, content_type=None):
+    # many iptv-org urls are progressive MPEG-TS or Icecast, not HLS
+    return body.lstrip(b'\xef\xbb\xbf \t\r\n').startswith(b'#EXTM3U') or 'mpegurl' in (content_type or '').lower()
+
+
+def parse_playlist(text, base_url):
+    # returns ('master', [(bandwidth, variant_url), ...]), ('media', [segment_url, ...]) or (None, [])
+    lines = [line.strip() for line in text.lstrip('\ufeff').splitlines() if line.strip()]
+    if not lines or not lines[0].startswith('#EXTM3U'):
+        return None, []
+    variants = []
+    segments = []
+    bandwidth = None
+    for line in lines[1:]:
+        if line.startswith('#EXT-X-STREAM-INF'):
+            attributes = dict(PLAYLIST_ATTRIBUTE.findall(line.split(':', 1)[-1]))
+            try:
+                bandwidth = int(attributes.get('BANDWIDTH', '').strip('"') or 0)
+            except ValueError:
+                bandwidth = 0
+        elif line.startswith('#'):
+            continue
+        elif bandwidth is not None:
+            variants.append((bandwidth, urljoin(base_url, line)))
+            bandwidth = None
+        else:
+            segments.append(urljoin(base_url, line))
+    if variants:
+        return 'master', variants
+    return 'media', segments
+
+
+class StreamProbe():
+    # Cheap first tier of a stream probe.  The manifest is fetched over a pooled
+    # session (one per tunnel proxy), a master playlist is followed to its
+    # smallest variant, and the media playlist must list segments; with
+    # fetch_segment the newest segment's first chunk is read too.  Dead hosts,
+    # 403s and 404s are answered here in one or two requests, and only streams
+    # that pass need the ffprobe tier.  No response body is read past max_bytes
+    # or the timeout, so a live progressive stream is answered by its first
+    # chunk rather than buffered.
+    def __init__(self, logger, timeout=None, fetch_segment=None, pool_size=None, max_bytes=None, chunk_size=8192):
+        self.logger = logger
+        self.timeout = timeout or float(os.getenv("PRE_PROBE_TIMEOUT", "10"))
+        self.max_bytes = max_bytes or int(os.getenv("PRE_PROBE_MAX_BYTES", str(64 << 10)))
+        self.chunk_size = chunk_size
+        if fetch_segment is None:
+            fetch_segment = os.getenv("PRE_PROBE_FETCH_SEGMENT", "false").lower() == "true"
+        self.fetch_segment = fetch_segment
+        self.pool_size = pool_size or int(os.getenv("PROBE_CONCURRENCY", "16"))
+        self.sessions = {}  # proxy url -> requests.Session
+        self.lock = threading.Lock()
+
+    def session(self, proxy_url=None):
+        with self.lock:
+            session = self.sessions.get(proxy_url)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                if proxy_url:
+                    session.proxies = {'http': proxy_url, 'https': proxy_url}
+                self.sessions[proxy_url] = session
+            return session
+
+    def get(self, url, proxy_url=None, max_bytes=None):
+        # returns (return_code, body bytes or None, content type), reading at
+        # most max_bytes of the body and giving up on it after self.timeout
+        max_bytes = max_bytes or self.max_bytes
+        deadline = time.monotonic() + self.timeout
+        try:
+            with self.session(proxy_url).get(url, timeout=self.timeout, stream=True) as response:
+                return_code = classify_status(response.status_code)
+                if return_code != PROBE_OK:
+                    return return_code, None, None
+                body = b''
+                for chunk in response.iter_content(chunk_size=min(self.chunk_size, max_bytes)):
+                    body += chunk
+                    if len(body) >= max_bytes or time.monotonic() > deadline:
+                        break
+                return PROBE_OK, body[:max_bytes], response.headers.get('Content-Type')
+        except requests.Timeout:
+            return PROBE_TIMEOUT, None, None
+        except requests.exceptions.ProxyError as e:
+            # a 502 from the tunnel proxy means it could not reach the host, no proxy to
+            # talk to at all (the tunnel went away) says nothing about the stream
+            if 'Tunnel connection failed' in str(e):
+                return PROBE_DEAD, None, None
+            if proxy_unreachable(e):
+                self.logger.debug(f"proxy {proxy_url} unreachable probing {url}")
+                return PROBE_UNAVAILABLE, None, None
+            return PROBE_FAILED, None, None
+        except requests.ConnectionError:
+            return PROBE_DEAD, None, None
+        except requests.RequestException as e:
+            self.logger.debug(f"pre-probe request error for {url}: {e}")
+            return PROBE_FAILED, None, None
+
+    def get_playlist(self, url, proxy_url=None):
+        # (return_code, kind, entries), kind None for a stream that is not a
+        # playlist, PROBE_FAILED if nothing at all came back
+        return_code, body, content_type = self.get(url, proxy_url)
+        if return_code != PROBE_OK:
+            return return_code, None, []
+        if not body:
+            return PROBE_FAILED, None, []
+        if not is_playlist(body, content_type):
+            return PROBE_OK, None, []
+        if len(body) >= self.max_bytes:
+            # cut off mid line, keep the whole lines
+            body = body[:body.rfind(b'\n') + 1]
+        kind, entries = parse_playlist(body.decode('utf-8', 'replace'), url)
+        return PROBE_OK, kind, entries
+
+    def check(self, url, proxy_url=None):
+        # PROBE_OK if the stream is worth an ffprobe, otherwise why not
+        if urlparse(url or '').scheme not in ('http', 'https'):
+            return PROBE_OK
+        return_code, kind, entries = self.get_playlist(url, proxy_url)
+        if return_code != PROBE_OK or kind is None:
+            # a progressive stream whose first chunk arrived passes as is
+            return return_code
+        if kind == 'master':
+            variant_url = min(entries)[1]
+            return_code, kind, entries = self.get_playlist(variant_url, proxy_url)
+            if return_code != PROBE_OK:
+                return return_code
+            if kind != 'media':
+                return PROBE_OK
+        if not entries:
+            return PROBE_FAILED
+        if self.fetch_segment:
+            return_code, body, _ = self.get(entries[-1], proxy_url, max_bytes=self.chunk_size)
+            return return_code if return_code != PROBE_OK or body else PROBE_FAILED
+        return PROBE_OK
@@ -0,0 +1,373 @@
+import json
+import os
+import random
+import socket
+import threading
+import time
+import zlib
+from sqlalchemy import (
+    Column, Float, Integer, MetaData, String, Table, Text, UniqueConstraint, and_, bindparam, delete, func, insert, or_,
+    select, update
+)
+from .metrics import REGISTRY
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+SHARDS = REGISTRY.counter('iptv_sweep_shards_total', 'Sweep shards handled by this process, by result', ('result',))
+
+metadata = MetaData()
+
+sweep_shards = Table(
+    'sweep_shards', metadata,
+    Column('id', Integer, primary_key=True, autoincrement=True),
+    Column('sweep_id', String(64), nullable=False, index=True),
+    Column('shard_key', String(64), nullable=False),
+    Column('country', String(16), nullable=False),
+    Column('channel_ids', Text, nullable=False),  # JSON list
+    Column('status', String(16), nullable=False, default=PENDING),
+    Column('owner', String(128)),
+    Column('attempts', Integer, nullable=False, default=0),  # bumped on every claim, doubles as the lease token
+    Column('lease_expires_at', Float),
+    Column('heartbeat_at', Float),
+    Column('reported', Integer, nullable=False, default=0),
+    Column('error', Text),
+    Column('created_at', Float),
+    Column('finished_at', Float),
+    UniqueConstraint('sweep_id', 'shard_key'),
+)
+
+sweep_results = Table(
+    'sweep_results', metadata,
+    Column('sweep_id', String(64), primary_key=True),
+    Column('channel_id', String(128), primary_key=True),
+    Column('url', Text, primary_key=True),
+    Column('shard_key', String(64), nullable=False),
+    Column('status', String(16), nullable=False),
+    Column('return_code', Integer),
+    Column('latency_ms', Float),
+    Column('vpn_endpoint', Text),
+    Column('worker', String(128)),
+    Column('tested_at', Float),
+)
+
+
+class SweepLeaseLost(Exception):
+    pass
+
+
+class SweepCatalogMismatch(Exception):
+    # a shard names channels the worker does not know, another worker may
+    pass
+
+
+def shard_channels(channels_with_streams, buckets=1, country_map=None):
+    # {shard_key: (vpn country, [channel_id, ...])}, one shard per country, or
+    # buckets shards per country by a stable hash of the channel id (crc32, not
+    # hash(), so every process puts a channel in the same bucket)
+    country_map = country_map or {}
+    shards = {}
+    for channel_id, entry in channels_with_streams.items():
+        country = (entry.get('channel') or {}).get('country')
+        if not country:
+            continue
+        country = country_map.get(country.lower(), country.lower())
+        bucket = zlib.crc32(channel_id.encode()) % buckets
+        shard_key = country if buckets == 1 else f"{country}-{bucket:03d}"
+        shards.setdefault(shard_key, (country, []))[1].append(channel_id)
+    return shards
+
+
+class SweepCoordinator():
+    # Splits a stream sweep into shards in the shared database and hands them
+    # out to workers.  A worker claims a shard by bumping its attempts counter
+    # with a conditional UPDATE, so two workers can never both win, and the
+    # attempts value it won with is its lease token: heartbeats, reports and
+    # completion only apply while the shard is still leased to it with that
+    # token.  A lease that is not heartbeated for lease_ttl seconds can be
+    # claimed again, and a shard that has been claimed max_attempts times
+    # without finishing is marked failed.  Plain SQL, so it runs the same on
+    # Postgres and on a SQLite file shared by local worker processes.
+    def __init__(self, logger, engine, lease_ttl=None, max_attempts=None):
+        self.logger = logger
+        self.engine = engine
+        self.lease_ttl = lease_ttl or int(os.getenv("SWEEP_LEASE_TTL", "120"))
+        self.max_attempts = max_attempts or int(os.getenv("SWEEP_MAX_ATTEMPTS", "3"))
+        metadata.create_all(self.engine)
+
+    def plan(self, sweep_id, shards):
+        # shards from shard_channels(); planning the same sweep again only adds missing shards
+        now = time.time()
+        with self.engine.begin() as conn:
+            existing = set(conn.execute(select(sweep_shards.c.shard_key).where(sweep_shards.c.sweep_id == sweep_id)).scalars())
+            rows = [{
+                'sweep_id': sweep_id,
+                'shard_key': shard_key,
+                'country': country,
+                'channel_ids': json.dumps(channel_ids),
+                'status': PENDING,
+                'attempts': 0,
+                'reported': 0,
+                'created_at': now,
+            } for shard_key, (country, channel_ids) in shards.items() if shard_key not in existing]
+            if rows:
+                conn.execute(insert(sweep_shards), rows)
+        self.logger.info(f"sweep {sweep_id}: planned [{len(rows)}] new shards, [{len(existing)}] already planned")
+        return len(rows)
+
+    def claimable(self, sweep_id, now, countries=None):
+        condition = and_(
+            sweep_shards.c.sweep_id == sweep_id,
+            sweep_shards.c.attempts < self.max_attempts,
+            or_(
+                sweep_shards.c.status == PENDING,
+                and_(sweep_shards.c.status == LEASED, sweep_shards.c.lease_expires_at < now),
+            ),
+        )
+        if countries:
+            condition = and_(condition, sweep_shards.c.country.in_(countries))
+        return condition
+
+    def claim(self, sweep_id, worker_id, countries=None, candidates=10):
+        # the claimed shard as a dict, or None when there is nothing to claim right now
+        now = time.time()
+        with self.engine.begin() as conn:
+            rows = conn.execute(
+                select(sweep_shards.c.id, sweep_shards.c.attempts)
+                .where(self.claimable(sweep_id, now, countries))
+                .order_by(sweep_shards.c.attempts, sweep_shards.c.id)
+                .limit(candidates)
+            ).all()
+        # workers starting together would all race for the first row
+        random.shuffle(rows)
+        for shard_id, attempts in rows:
+            with self.engine.begin() as conn:
+                claimed = conn.execute(
+                    update(sweep_shards)
+                    .where(sweep_shards.c.id == shard_id, sweep_shards.c.attempts == attempts,
+                           self.claimable(sweep_id, now, countries))
+                    .values(status=LEASED, owner=worker_id, attempts=attempts + 1,
+                            lease_expires_at=now + self.lease_ttl, heartbeat_at=now)
+                ).rowcount
+                if claimed:
+                    row = conn.execute(select(sweep_shards).where(sweep_shards.c.id == shard_id)).mappings().one()
+            if claimed:
+                shard = dict(row, channel_ids=json.loads(row['channel_ids']))
+                if attempts:
+                    self.logger.info(f"sweep {sweep_id}: {worker_id} reclaimed shard {shard['shard_key']} (attempt {attempts + 1})")
+                return shard
+        return None
+
+    def fenced(self, shard):
+        # the shard row, but only while it is still leased to this holder
+        return and_(
+            sweep_shards.c.id == shard['id'],
+            sweep_shards.c.owner == shard['owner'],
+            sweep_shards.c.attempts == shard['attempts'],
+            sweep_shards.c.status == LEASED,
+        )
+
+    def extend(self, conn, shard, **values):
+        now = time.time()
+        values = dict({'heartbeat_at': now, 'lease_expires_at': now + self.lease_ttl}, **values)
+        extended = conn.execute(update(sweep_shards).where(self.fenced(shard)).values(**values)).rowcount
+        if not extended:
+            raise SweepLeaseLost(f"shard {shard['shard_key']} is no longer leased to {shard['owner']}")
+
+    def heartbeat(self, shard):
+        with self.engine.begin() as conn:
+            self.extend(conn, shard)
+
+    def report(self, shard, results):
+        # results: [{'channel_id', 'url', 'status', 'return_code', 'latency_ms', 'vpn_endpoint'}, ...]
+        # written with the heartbeat in one transaction, the newest result per (channel, url) wins
+        if not results:
+            return 0
+        now = time.time()
+        newest = {}
+        for result in results:
+            if not result.get('url'):
+                continue
+            row = {
+                'sweep_id': shard['sweep_id'],
+                'channel_id': result['channel_id'],
+                'url': result['url'],
+                'shard_key': shard['shard_key'],
+                'status': result['status'],
+                'return_code': result.get('return_code'),
+                'latency_ms': result.get('latency_ms'),
+                'vpn_endpoint': result.get('vpn_endpoint'),
+                'worker': shard['owner'],
+                'tested_at': result.get('tested_at', now),
+            }
+            # a channel can list the same url twice, and the table holds one row per (channel, url)
+            key = (row['channel_id'], row['url'])
+            if key not in newest or row['tested_at'] >= newest[key]['tested_at']:
+                newest[key] = row
+        rows = list(newest.values())
+        with self.engine.begin() as conn:
+            self.extend(conn, shard, reported=sweep_shards.c.reported + len(rows))
+            conn.execute(
+                delete(sweep_results).where(
+                    sweep_results.c.sweep_id == bindparam('b_sweep_id'),
+                    sweep_results.c.channel_id == bindparam('b_channel_id'),
+                    sweep_results.c.url == bindparam('b_url'),
+                ),
+                [{'b_sweep_id': row['sweep_id'], 'b_channel_id': row['channel_id'], 'b_url': row['url']} for row in rows]
+            )
+            conn.execute(insert(sweep_results), rows)
+        return len(rows)
+
+    def complete(self, shard):
+        with self.engine.begin() as conn:
+            self.extend(conn, shard, status=DONE, finished_at=time.time(), error=None)
+        SHARDS.inc(result='done')
+
+    def fail(self, shard, error):
+        # back to pending for another worker, or failed for good after max_attempts
+        status = FAILED if shard['attempts'] >= self.max_attempts else PENDING
+        with self.engine.begin() as conn:
+            self.extend(conn, shard, status=status, error=str(error)[:2000], lease_expires_at=None,
+                        finished_at=time.time() if status == FAILED else None)
+        SHARDS.inc(result='failed' if status == FAILED else 'released')
+
+    def reclaim_expired(self, sweep_id):
+        # expired leases back to pending (or failed), claim() would take them anyway,
+        # this just makes progress() honest about them
+        now = time.time()
+        expired = and_(sweep_shards.c.sweep_id == sweep_id, sweep_shards.c.status == LEASED, sweep_shards.c.lease_expires_at < now)
+        with self.engine.begin() as conn:
+            failed = conn.execute(
+                update(sweep_shards).where(expired, sweep_shards.c.attempts >= self.max_attempts)
+                .values(status=FAILED, error='lease expired', finished_at=now)
+            ).rowcount
+            reclaimed = conn.execute(update(sweep_shards).where(expired).values(status=PENDING, error='lease expired')).rowcount
+        if failed or reclaimed:
+            self.logger.info(f"sweep {sweep_id}: [{reclaimed}] expired leases reclaimed, [{failed}] shards out of attempts")
+        return reclaimed + failed
+
+    def unfinished(self, sweep_id):
+        with self.engine.connect() as conn:
+            return conn.execute(
+                select(func.count()).select_from(sweep_shards)
+                .where(sweep_shards.c.sweep_id == sweep_id, sweep_shards.c.status.in_((PENDING, LEASED)))
+            ).scalar()
+
+    def progress(self, sweep_id):
+        now = time.time()
+        with self.engine.connect() as conn:
+            statuses = dict(conn.execute(
+                select(sweep_shards.c.status, func.count()).where(sweep_shards.c.sweep_id == sweep_id)
+                .group_by(sweep_shards.c.status)
+            ).all())
+            leases = [{
+                'shard_key': shard_key,
+                'owner': owner,
+                'heartbeat_age': round(now - heartbeat_at, 1) if heartbeat_at else None,
+                'reported': reported,
+            } for shard_key, owner, heartbeat_at, reported in conn.execute(
+                select(sweep_shards.c.shard_key, sweep_shards.c.owner, sweep_shards.c.heartbeat_at, sweep_shards.c.reported)
+                .where(sweep_shards.c.sweep_id == sweep_id, sweep_shards.c.status == LEASED)
+            )]
+            results = conn.execute(
+                select(func.count()).select_from(sweep_results).where(sweep_results.c.sweep_id == sweep_id)
+            ).scalar()
+        return {'shards': statuses, 'results': results, 'leases': leases}
+
+    def results(self, sweep_id, shard_key=None):
+        query = select(sweep_results).where(sweep_results.c.sweep_id == sweep_id)
+        if shard_key:
+            query = query.where(sweep_results.c.shard_key == shard_key)
+        with self.engine.connect() as conn:
+            return [dict(row) for row in conn.execute(query).mappings()]
+
+    def wait(self, sweep_id, poll_interval=None):
+        # blocks until no shard is pending or leased, reclaiming dead workers' shards on the way
+        poll_interval = poll_interval or int(os.getenv("SWEEP_POLL_INTERVAL", "30"))
+        while True:
+            self.reclaim_expired(sweep_id)
+            progress = self.progress(sweep_id)
+            self.logger.info(f"sweep {sweep_id}: {progress['shards']}, [{progress['results']}] results")
+            if not progress['shards'].get(PENDING) and not progress['shards'].get(LEASED):
+                return progress
+            time.sleep(poll_interval)
+
+
+class SweepWorker():
+    # Claims shards until the sweep has none left and runs
+    # sweep_fn(shard, report) on each.  A background thread heartbeats the
+    # lease; report(results) sends a batch of results and raises SweepLeaseLost
+    # once the lease is gone, which abandons the shard to whoever reclaimed it.
+    # While other workers still hold leases the worker keeps polling, so it can
+    # pick up their shards if they die.
+    def __init__(self, logger, coordinator, sweep_fn, worker_id=None, countries=None, heartbeat_interval=None,
+                 poll_interval=None):
+        self.logger = logger
+        self.coordinator = coordinator
+        self.sweep_fn = sweep_fn
+        self.worker_id = worker_id or os.getenv("SWEEP_WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+        self.countries = countries
+        self.heartbeat_interval = heartbeat_interval or max(1, coordinator.lease_ttl // 4)
+        self.poll_interval = poll_interval or int(os.getenv("SWEEP_POLL_INTERVAL", "30"))
+        self.stopping = threading.Event()
+
+    def run(self, sweep_id):
+        # returns the number of shards this worker finished
+        finished = 0
+        while not self.stopping.is_set():
+            shard = self.coordinator.claim(sweep_id, self.worker_id, self.countries)
+            if shard is None:
+                # shards out of attempts are only marked failed here or by the coordinator
+                self.coordinator.reclaim_expired(sweep_id)
+                if not self.coordinator.unfinished(sweep_id):
+                    break
+                self.stopping.wait(self.poll_interval)
+                continue
+            if self.run_shard(shard):
+                finished += 1
+        self.logger.info(f"sweep {sweep_id}: worker {self.worker_id} finished [{finished}] shards")
+        return finished
+
+    def run_shard(self, shard):
+        self.logger.info(f"sweep {shard['sweep_id']}: {self.worker_id} running shard {shard['shard_key']} "
+                         f"([{len(shard['channel_ids'])}] channels, attempt {shard['attempts']})")
+        lost = threading.Event()
+        done = threading.Event()
+
+        def heartbeat():
+            while not done.wait(self.heartbeat_interval):
+                try:
+                    self.coordinator.heartbeat(shard)
+                except SweepLeaseLost:
+                    lost.set()
+                    return
+                except Exception as e:
+                    # a blip talking to the db, the lease survives until lease_ttl
+                    self.logger.error(f"heartbeat for shard {shard['shard_key']} failed: {e}")
+
+        def report(results):
+            if lost.is_set():
+                raise SweepLeaseLost(f"shard {shard['shard_key']} lease lost")
+            return self.coordinator.report(shard, results)
+
+        heartbeat_thread = threading.Thread(target=heartbeat, daemon=True)
+        heartbeat_thread.start()
+        try:
+            self.sweep_fn(shard, report)
+            self.coordinator.complete(shard)
+            return True
+        except SweepLeaseLost as e:
+            self.logger.info(f"abandoning shard: {e}")
+            SHARDS.inc(result='lost')
+        except Exception as e:
+            self.logger.error(f"shard {shard['shard_key']} failed: {e}")
+            try:
+                self.coordinator.fail(shard, e)
+            except SweepLeaseLost:
+                pass
+        finally:
+            done.set()
+            heartbeat_thread.join()
+        return False
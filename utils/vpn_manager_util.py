@@ -4,63 +4,310 @@ import subprocess
 import json
 import time
 import requests
+import threading
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+from .metrics import REGISTRY
+from .stream_probe import (
+    PROBE_DEAD, PROBE_FAILED, PROBE_FORBIDDEN, PROBE_OK, PROBE_TIMEOUT, PROBE_UNAVAILABLE, FORBIDDEN_STATUSES,
+    DEAD_STATUSES,
+    StreamProbe, probe_outcome
+)
 
 
-VPN_MANAGER_BASE_URL = "http://localhost:8080/"
+VPN_MANAGER_BASE_URL = os.getenv("VPN_MANAGER_BASE_URL", "http://localhost:8080/")
+VPN_READY_TIMEOUT = int(os.getenv("VPN_READY_TIMEOUT", "30"))
+# for calls to the sidecar, a lease may also wait VPN_READY_TIMEOUT for its tunnel
+VPN_MANAGER_TIMEOUT = int(os.getenv("VPN_MANAGER_TIMEOUT", "10"))
+PROBE_WITH_FFPROBE = os.getenv("PROBE_WITH_FFPROBE", "true").lower() == "true"
+
+PROBE_TIERS = REGISTRY.counter('iptv_probe_tier_total', 'Probe results by tier (pre_probe, ffprobe) and outcome', ('tier', 'outcome'))
+LEASE_SECONDS = REGISTRY.histogram('vpn_lease_wait_seconds', 'Time to get an up tunnel from the sidecar', ('route', 'result'))
+
+
+def classify_ffprobe_error(stderr):
+    # ffprobe reports HTTP errors as "Server returned 403 Forbidden (access denied)" and the like
+    if any(f"Server returned {status}" in stderr for status in FORBIDDEN_STATUSES):
+        return PROBE_FORBIDDEN
+    if any(f"Server returned {status}" in stderr for status in DEAD_STATUSES):
+        return PROBE_DEAD
+    if 'Failed to resolve hostname' in stderr or 'Connection refused' in stderr:
+        return PROBE_DEAD
+    if 'timed out' in stderr:
+        return PROBE_TIMEOUT
+    return PROBE_FAILED
 
 class VpnManager():
     def __init__(self, logger=None):
         self.logger = logger
+        # probe outcomes waiting to be sent to the sidecar's endpoint registry
+        self.pending_reports = []
+        self.reports_lock = threading.Lock()
+        self.stream_probe = StreamProbe(self.logger)
+
+    def proxy_url(self, tunnel):
+        # tunnel proxies listen on the sidecar's host, one port per tunnel, on loopback
+        # unless the sidecar sets TUNNEL_PROXY_BIND
+        return f"http://{urlparse(VPN_MANAGER_BASE_URL).hostname}:{tunnel['proxy_port']}"
+
+    def lease(self, country: str, ovpn_file: str = None, exclude: str = None, client: str = None):
+        # returns {'lease_id', 'tunnel', 'proxy_url'} for a tunnel that is up, or None
+        params = {'country': country, 'wait': VPN_READY_TIMEOUT}
+        if ovpn_file:
+            params['ovpn_file'] = ovpn_file
+        if exclude:
+            params['exclude'] = exclude
+        if client:
+            params['client'] = client
+        return self.request_lease('lease', params)
 
-    def connect(self, country: str):
-        restart_url = f"{VPN_MANAGER_BASE_URL}restart?country={country}"
+    def failover(self, lease_id: str, tunnel_id: str = None):
+        # moves the lease to another endpoint of the same country, a warm standby if the sidecar has one.
+        # If the sidecar already moved it off tunnel_id (that tunnel went down), this returns where it went.
+        params = {'lease_id': lease_id, 'wait': VPN_READY_TIMEOUT}
+        if tunnel_id:
+            params['tunnel_id'] = tunnel_id
+        return self.request_lease('failover', params)
+
+    def request_lease(self, route, params):
+        start = time.monotonic()
+        lease = self.request_lease_once(route, params)
+        LEASE_SECONDS.observe(time.monotonic() - start, route=route, result='ok' if lease else 'failed')
+        return lease
+
+    def request_lease_once(self, route, params):
         try:
-            response = requests.get(restart_url)
+            response = requests.get(f"{VPN_MANAGER_BASE_URL}{route}", params=params,
+                                    timeout=VPN_MANAGER_TIMEOUT + params.get('wait', 0))
             response_data = response.json() if response.content else {}
-            if response.status_code != 200 or response_data.get("status") != "started":
-                self.logger.error(f"Failed to request VPN connect: {response.status_code} - {response_data}")
-                print(f"Connect response: {response_data}")  # Debug print
-                return
-            self.logger.info("VPN connect request sent successfully.")
-            print(f"Connect response: {response_data}")  # Debug print to see PID if started
+            if response.status_code != 200 or response_data.get("status") != "leased":
+                self.logger.error(f"Failed to lease a VPN tunnel: {response.status_code} - {response_data}")
+                return None
+            tunnel = response_data.get("tunnel", {})
+            lease_id = response_data.get("lease_id")
+            if tunnel.get('state') != 'up':
+                self.logger.error(f"VPN tunnel {tunnel.get('tunnel_id')} is {tunnel.get('state')}, not up after {VPN_READY_TIMEOUT}s")
+                self.release(lease_id)
+                return None
+            self.logger.info(f"VPN tunnel leased: {tunnel}")
+            return {'lease_id': lease_id, 'tunnel': tunnel, 'proxy_url': self.proxy_url(tunnel)}
+        except Exception as e:
+            self.logger.error(f"Error requesting VPN {route}: {e}")
+            return None
+
+    def release(self, lease_id: str):
+        if not lease_id:
+            return
+        try:
+            requests.get(f"{VPN_MANAGER_BASE_URL}release", params={'lease_id': lease_id}, timeout=VPN_MANAGER_TIMEOUT)
         except Exception as e:
-            self.logger.error(f"Error requesting VPN connect: {e}")
+            self.logger.error(f"Error releasing VPN lease {lease_id}: {e}")
+
+    def session(self, country: str, **kwargs):
+        return VpnSession(self, country, **kwargs)
+
+    def record_probe(self, ovpn_file, return_code):
+        if not ovpn_file:
             return
+        with self.reports_lock:
+            self.pending_reports.append({'ovpn_file': ovpn_file, 'return_code': return_code})
+
+    def record_bandwidth(self, ovpn_file, num_bytes, secs):
+        if not ovpn_file:
+            return
+        with self.reports_lock:
+            self.pending_reports.append({'ovpn_file': ovpn_file, 'bytes': num_bytes, 'secs': secs})
+
+    def flush_reports(self):
+        # one POST for everything recorded since the last flush
+        with self.reports_lock:
+            reports = self.pending_reports
+            self.pending_reports = []
+        if not reports:
+            return
+        try:
+            requests.post(f"{VPN_MANAGER_BASE_URL}report", json=reports, timeout=VPN_MANAGER_TIMEOUT)
+        except Exception as e:
+            self.logger.error(f"Error sending [{len(reports)}] endpoint reports: {e}")
+
+    def endpoint_report(self, country: str = None):
+        try:
+            params = {'country': country} if country else {}
+            return requests.get(f"{VPN_MANAGER_BASE_URL}endpoints", params=params, timeout=VPN_MANAGER_TIMEOUT).json()
+        except Exception as e:
+            self.logger.error(f"Error fetching endpoint stats: {e}")
+            return {}
 
     def test_stream_url_with_vpn(self, country: str, stream_url: str):
-        connected = False
-        max_attempts = 10
-        for attempt in range(max_attempts):
-            self.connect(country)
-            return_code = self.probe_stream_url(stream_url)
-            if return_code == 0:
-                return 0
-            elif return_code == 1:  # we got a 403, try another vpn endpoint
-                time.sleep(1)
-                continue
-            elif return_code == 2:
-                return 2
-        return 1
-        
-    def probe_stream_url(self, stream_url: str):
+        with self.session(country) as session:
+            return session.probe_batch([stream_url])[0]
+
+    def probe_stream_url(self, stream_url: str, proxy_url: str = None):
+        # the HTTP pre-probe weeds out dead, missing and geo-blocked streams, ffprobe only sees the rest
+        return_code = self.stream_probe.check(stream_url, proxy_url)
+        PROBE_TIERS.inc(tier='pre_probe', outcome=probe_outcome(return_code))
+        if return_code != PROBE_OK:
+            self.logger.info(f"pre-probe failed with code {return_code}: {stream_url}")
+            return return_code
+        if not PROBE_WITH_FFPROBE:
+            return PROBE_OK
+        return_code = self.ffprobe_stream_url(stream_url, proxy_url)
+        PROBE_TIERS.inc(tier='ffprobe', outcome=probe_outcome(return_code))
+        return return_code
+
+    def ffprobe_stream_url(self, stream_url: str, proxy_url: str = None):
+        cmd = ["ffprobe", "-v", "error", "-show_format", "-show_streams"]
+        if proxy_url:
+            cmd += ["-http_proxy", proxy_url]
         try:
             result = subprocess.run(
-                ["ffprobe", "-v", "error", "-show_format", "-show_streams", stream_url],
+                cmd + [stream_url],
                 capture_output=True,
                 text=True,
                 timeout=60  # Longer timeout for potential network delays
             )
             if result.returncode == 0:
                 self.logger.info("Successfully probed the stream.")
-                return 0
-            else:
-                self.logger.error(f"Failed attempt to probe the stream (return code {result.returncode}): [{result.stderr.strip()}]")
-                # TODO if it's 403 return 1, else return 2, for now our code assumes 403 if failure, kinda brittle
-                return 1
+                return PROBE_OK
+            stderr = result.stderr.strip()
+            self.logger.error(f"Failed attempt to probe the stream (return code {result.returncode}): [{stderr}]")
+            return classify_ffprobe_error(stderr)
         except subprocess.TimeoutExpired:
             self.logger.error("ffprobe timed out while probing the stream, aborting")
+            return PROBE_TIMEOUT
         except Exception as e:
             self.logger.error(f"Error probing the stream, aborting: {e}")
-        return 2
+        return PROBE_FAILED
+
+class VpnSession():
+    # Holds a lease on one tunnel for a country and probes many streams through
+    # its proxy.  The endpoint is only rotated once its 403 rate goes over
+    # max_forbidden_rate (after at least min_samples probes), and the sidecar
+    # picks the replacement from its endpoint stats, which every probe outcome
+    # is reported to.  Other leases on the old tunnel are not affected by a
+    # rotation.  A probe that cannot reach the proxy at all means the tunnel went
+    # away (the sidecar may already have moved the lease), so the lease is failed
+    # over and the session picks up wherever it now points.
+    def __init__(self, vpn_manager, country, max_forbidden_rate=0.5, min_samples=5, max_rotations=10, max_workers=8):
+        self.vpn_manager = vpn_manager
+        self.logger = vpn_manager.logger
+        self.country = country
+        self.max_forbidden_rate = max_forbidden_rate
+        self.min_samples = min_samples
+        self.max_rotations = max_rotations
+        self.max_workers = max_workers
+        self.ovpn_file = None
+        self.lease_id = None
+        self.tunnel_id = None
+        self.proxy_url = None
+        self.window = {'probes': 0, 'forbidden': 0, 'unavailable': 0}
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        self.connect()
+        return self
 
+    def __exit__(self, exc_type, exc, tb):
+        self.vpn_manager.flush_reports()
+        self.vpn_manager.release(self.lease_id)
+        self.lease_id = None
+        self.logger.info(f"VPN session for {self.country} done, endpoint stats: {self.vpn_manager.endpoint_report(self.country)}")
 
+    def connect(self, exclude=None):
+        # outcomes so far go to the sidecar first, so they count towards its choice
+        self.vpn_manager.flush_reports()
+        lease = self.vpn_manager.lease(self.country, exclude=exclude, client='probe')
+        # the old tunnel stays up for anyone else leasing it, we just let go of it
+        self.vpn_manager.release(self.lease_id)
+        self.use_lease(lease)
+
+    def use_lease(self, lease):
+        tunnel = (lease or {}).get('tunnel', {})
+        with self.lock:
+            self.lease_id = (lease or {}).get('lease_id')
+            self.proxy_url = (lease or {}).get('proxy_url')
+            self.tunnel_id = tunnel.get('tunnel_id')
+            self.ovpn_file = tunnel.get('ovpn_file')
+            self.window = {'probes': 0, 'forbidden': 0, 'unavailable': 0}
+
+    def rotate(self):
+        self.logger.info(f"rotating VPN endpoint away from {self.ovpn_file}, window {self.window}")
+        self.connect(exclude=self.ovpn_file)
+
+    def reconnect(self):
+        # the proxy stopped answering: if the sidecar already moved the lease off the dead tunnel this
+        # returns where it went, otherwise it moves it now.  With no lease left a fresh one is taken.
+        self.logger.info(f"VPN proxy {self.proxy_url} for {self.ovpn_file} unreachable, failing over lease {self.lease_id}")
+        self.vpn_manager.flush_reports()
+        lease = self.vpn_manager.failover(self.lease_id, self.tunnel_id) if self.lease_id else None
+        if lease:
+            self.use_lease(lease)
+        else:
+            self.connect()
+
+    def probe(self, stream_url: str):
+        ovpn_file, proxy_url = self.ovpn_file, self.proxy_url
+        if not proxy_url:
+            # no tunnel, a direct probe would test the wrong country
+            return PROBE_UNAVAILABLE
+        return_code = self.vpn_manager.probe_stream_url(stream_url, proxy_url)
+        self.vpn_manager.record_probe(ovpn_file, return_code)
+        with self.lock:
+            if ovpn_file == self.ovpn_file:
+                self.window['probes'] += 1
+                if return_code == PROBE_FORBIDDEN:
+                    self.window['forbidden'] += 1
+                elif return_code == PROBE_UNAVAILABLE:
+                    self.window['unavailable'] += 1
+        return return_code
+
+    def tunnel_lost(self):
+        with self.lock:
+            return not self.proxy_url or self.window['unavailable'] > 0
+
+    def forbidden_rate_exceeded(self):
+        with self.lock:
+            probes = self.window['probes']
+            return probes >= self.min_samples and self.window['forbidden'] / probes > self.max_forbidden_rate
+
+    def rotate_if_needed(self):
+        # only call this between batches, rotating drops the tunnel under in-flight probes
+        self.vpn_manager.flush_reports()
+        if self.tunnel_lost():
+            self.reconnect()
+            return True
+        if self.forbidden_rate_exceeded():
+            self.rotate()
+            return True
+        return False
+
+    def probe_batch(self, stream_urls):
+        # 403s are retried on a fresh endpoint, and probes the proxy never answered on the
+        # lease's new tunnel, up to max_rotations times
+        results = {}
+        pending = list(stream_urls)
+        for rotation in range(self.max_rotations + 1):
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                return_codes = list(executor.map(self.probe, pending))
+            forbidden = []
+            unavailable = []
+            for stream_url, return_code in zip(pending, return_codes):
+                results[stream_url] = return_code
+                if return_code == PROBE_FORBIDDEN:
+                    forbidden.append(stream_url)
+                elif return_code == PROBE_UNAVAILABLE:
+                    unavailable.append(stream_url)
+            if not (forbidden or unavailable) or rotation == self.max_rotations:
+                break
+            if self.tunnel_lost():
+                self.reconnect()
+                pending = forbidden + unavailable
+                continue
+            if not forbidden:
+                break
+            # a small batch where everything was a 403 also rotates, like the old per-url retry
+            if not self.forbidden_rate_exceeded() and len(forbidden) < len(pending):
+                break
+            self.rotate()
+            pending = forbidden
+        return [results[stream_url] for stream_url in stream_urls]
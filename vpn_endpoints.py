@@ -0,0 +1,166 @@
+import glob
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+
+OVPN_CONFIGS_DIR = os.getenv("OVPN_CONFIGS_DIR", "/configs")
+ENDPOINT_STATS_PATH = os.getenv("ENDPOINT_STATS_PATH", "/var/lib/vpn_manager/endpoint_stats.sqlite")
+
+OVPN_PATTERN = re.compile(r'^([a-z]+)\d+\.nordvpn\.com\.udp\.ovpn$')
+# decayed counters, halved every half_life seconds
+COUNTERS = ('ok', 'forbidden', 'failed', 'connects', 'connect_failures')
+# moving averages, weighted by alpha per observation
+AVERAGES = ('handshake_secs', 'bandwidth_bps')
+
+
+class EndpointRegistry():
+    # The .ovpn configs, scanned once and indexed by country, with per-endpoint
+    # stats: handshake time, probe outcomes and observed bandwidth.  Counts decay
+    # with a half life so old results fade out, and the stats live in SQLite so a
+    # restarted sidecar remembers which servers were bad.  choose() is Thompson
+    # sampling over the endpoint's 403/connect failure record, weighted down for
+    # slow handshakes and low bandwidth, so untried endpoints still get a turn.
+    def __init__(self, logger, configs_dir=None, path=None, half_life=None, alpha=0.3,
+                 handshake_scale=10, bandwidth_scale=1_000_000):
+        self.logger = logger
+        self.configs_dir = configs_dir or OVPN_CONFIGS_DIR
+        self.path = path or ENDPOINT_STATS_PATH
+        self.half_life = half_life or int(os.getenv("ENDPOINT_STATS_HALF_LIFE", "21600"))
+        self.alpha = alpha
+        self.handshake_scale = handshake_scale
+        self.bandwidth_scale = bandwidth_scale
+        self.by_country = {}  # country -> [ovpn_file, ...]
+        self.stats = {}  # ovpn_file -> stats dict
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute(f'''
+            CREATE TABLE IF NOT EXISTS endpoint_stats (
+                ovpn_file TEXT PRIMARY KEY,
+                {', '.join(f'{name} REAL' for name in COUNTERS + AVERAGES)},
+                updated_at REAL,
+                last_used REAL
+            )
+        ''')
+        self.load()
+        self.scan()
+
+    def scan(self):
+        by_country = {}
+        for ovpn_file in glob.glob(os.path.join(self.configs_dir, '*.nordvpn.com.udp.ovpn')):
+            match = OVPN_PATTERN.match(os.path.basename(ovpn_file))
+            if match:
+                by_country.setdefault(match.group(1), []).append(ovpn_file)
+        with self.lock:
+            self.by_country = by_country
+        self.logger.info(f"endpoint registry has [{sum(len(f) for f in by_country.values())}] endpoints in [{len(by_country)}] countries")
+
+    def load(self):
+        columns = ('ovpn_file',) + COUNTERS + AVERAGES + ('updated_at', 'last_used')
+        for row in self.conn.execute(f"SELECT {', '.join(columns)} FROM endpoint_stats"):
+            record = dict(zip(columns, row))
+            self.stats[record.pop('ovpn_file')] = record
+
+    def files(self, country):
+        with self.lock:
+            return list(self.by_country.get(country, []))
+
+    def decayed(self, ovpn_file, now):
+        # the endpoint's stats with counters decayed to now
+        stats = self.stats.get(ovpn_file)
+        if stats is None:
+            stats = dict({name: 0.0 for name in COUNTERS}, **{name: None for name in AVERAGES})
+            stats.update(updated_at=now, last_used=None)
+            self.stats[ovpn_file] = stats
+        factor = 0.5 ** ((now - stats['updated_at']) / self.half_life)
+        for name in COUNTERS:
+            stats[name] *= factor
+        stats['updated_at'] = now
+        return stats
+
+    def average(self, stats, name, value):
+        stats[name] = value if stats[name] is None else stats[name] + self.alpha * (value - stats[name])
+
+    def record_connect(self, ovpn_file, handshake_secs=None):
+        # handshake_secs None means the tunnel never came up
+        with self.lock:
+            stats = self.decayed(ovpn_file, time.time())
+            if handshake_secs is None:
+                stats['connect_failures'] += 1
+            else:
+                stats['connects'] += 1
+                self.average(stats, 'handshake_secs', handshake_secs)
+            stats['last_used'] = stats['updated_at']
+            self.save([ovpn_file])
+
+    def record_probes(self, reports):
+        # reports: [{'ovpn_file', 'return_code'}, ...], 0 ok, 1 forbidden, anything else failed
+        with self.lock:
+            now = time.time()
+            touched = set()
+            for report in reports:
+                stats = self.decayed(report['ovpn_file'], now)
+                return_code = report.get('return_code')
+                stats['ok' if return_code == 0 else 'forbidden' if return_code == 1 else 'failed'] += 1
+                touched.add(report['ovpn_file'])
+            self.save(touched)
+        return len(touched)
+
+    def record_bandwidth(self, ovpn_file, num_bytes, secs):
+        if not secs or secs <= 0:
+            return
+        with self.lock:
+            stats = self.decayed(ovpn_file, time.time())
+            self.average(stats, 'bandwidth_bps', num_bytes / secs)
+            self.save([ovpn_file])
+
+    def save(self, ovpn_files):
+        columns = ('ovpn_file',) + COUNTERS + AVERAGES + ('updated_at', 'last_used')
+        rows = [(ovpn_file,) + tuple(self.stats[ovpn_file][name] for name in columns[1:]) for ovpn_file in ovpn_files]
+        with self.conn:
+            self.conn.executemany(
+                f"INSERT OR REPLACE INTO endpoint_stats ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                rows
+            )
+
+    def score(self, stats):
+        # a draw from Beta(successes + 1, failures + 1), 5xx/dead streams are not the endpoint's fault
+        successes = stats['ok'] + stats['connects']
+        failures = stats['forbidden'] + stats['connect_failures']
+        score = random.betavariate(successes + 1, failures + 1)
+        if stats['handshake_secs'] is not None:
+            score /= 1 + stats['handshake_secs'] / self.handshake_scale
+        bandwidth = stats['bandwidth_bps'] if stats['bandwidth_bps'] is not None else self.bandwidth_scale
+        return score * bandwidth / (bandwidth + self.bandwidth_scale)
+
+    def choose(self, country, exclude=None, avoid=()):
+        # best scoring endpoint for the country other than exclude, preferring
+        # ones not in avoid (already connected); exclude is only handed back
+        # when it is the country's only endpoint
+        files = self.files(country)
+        if not files:
+            return None
+        candidates = [f for f in files if f != exclude and f not in avoid] or [f for f in files if f != exclude] or files
+        with self.lock:
+            now = time.time()
+            return max(candidates, key=lambda f: self.score(self.decayed(f, now)))
+
+    def report(self, country=None):
+        with self.lock:
+            now = time.time()
+            countries = [country] if country else sorted(self.by_country)
+            report = {}
+            for code in countries:
+                for ovpn_file in self.by_country.get(code, []):
+                    stats = self.decayed(ovpn_file, now)
+                    judged = stats['ok'] + stats['forbidden']
+                    report[os.path.basename(ovpn_file)] = dict(
+                        {name: round(stats[name], 3) if stats[name] is not None else None for name in COUNTERS + AVERAGES},
+                        country=code,
+                        success_rate=round(stats['ok'] / judged, 3) if judged >= 0.5 else None,
+                        last_used=stats['last_used'],
+                    )
+            return report
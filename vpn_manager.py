@@ -1,13 +1,11 @@
 from fastapi import FastAPI
-from fastapi.responses import JSONResponse
-from subprocess import Popen, PIPE
+from fastapi.responses import JSONResponse, PlainTextResponse
 import sys
-import glob
 import os
 import logging
-import threading
-import random
-import signal
+from vpn_endpoints import EndpointRegistry
+from vpn_tunnels import TunnelPool, TunnelPoolError
+from utils.metrics import REGISTRY, span
 
 logging.basicConfig(
     level=logging.INFO,
@@ -23,55 +21,96 @@ with open(auth_file, "w") as f:
     f.write(f"{os.getenv('NORD_USERNAME')}\n{os.getenv('NORD_PASSWORD')}\n")
 logger.info(f"auth file written")
 
-vpn_info = {}
+registry = EndpointRegistry(logger)
+pool = TunnelPool(logger, auth_file, registry)
+pool.start()
 
 app = FastAPI()
 
 
-@app.get("/connect")
-def connect(country: str):
-    global vpn_info
-    if vpn_info:
-        err_msg = 'vpn already running, you need to shut it down first'
-        logger.info(err_msg)
-        return JSONResponse({"status": "failed", "message": err_msg})
-
-    match_pattern = f"/configs/{country}*.nordvpn.com.udp.ovpn"
-    files_arr = glob.glob(match_pattern)
-    if not files_arr:
-        err_msg = f'no ovpn endpoints found for country {country}'
-        logger.info(err_msg)
-        return JSONResponse({"status": "failed", "message": err_msg})
-
-    ovpn_file = random.choice(files_arr) 
-    process = Popen(["openvpn", "--config", ovpn_file, "--auth-user-pass", auth_file], stdout=PIPE, stderr=PIPE)
-    threading.Thread(target=log_pipe, args=(process.stdout,)).start()
-    threading.Thread(target=log_pipe, args=(process.stderr, "error")).start()
-    logger.info(f'process pid is {process.pid}')
-    vpn_info = {'country': country, 'pid': process.pid, 'ovpn_file': ovpn_file}
-    return JSONResponse({"status": "started", "vpn_info": vpn_info})
-
-def log_pipe(pipe, level="info"):
-    for line in iter(pipe.readline, b''):
-        logger.info(f"OpenVPN {level}: {line.decode().strip()}")  # Or use print()
-
-@app.get("/disconnect")
-def disconnect():
-    global vpn_info
-    if not vpn_info:
-        return JSONResponse({"status": "not running"})
-    os.kill(vpn_info.get('pid'), signal.SIGTERM)
-    vpn_info = {}
-    return JSONResponse({"status": "stopped"})
-
-@app.get("/restart")
-def restart(country: str):
-    disconnect()
-    return connect(country)
+@app.get("/lease")
+def lease(country: str, client: str = None, ovpn_file: str = None, exclude: str = None, wait: float = 0):
+    # with wait, the response comes back once the tunnel is up (or after wait seconds)
+    try:
+        with span('lease', country=country):
+            lease_id, tunnel = pool.lease(country, client=client, ovpn_file=ovpn_file, exclude=exclude, wait=wait)
+    except TunnelPoolError as e:
+        logger.info(str(e))
+        return JSONResponse({"status": "failed", "message": str(e)})
+    except Exception as e:
+        logger.error(f"could not open a tunnel for {country}: {e}")
+        return JSONResponse({"status": "failed", "message": str(e)})
+    return JSONResponse({"status": "leased", "lease_id": lease_id, "tunnel": tunnel})
+
+@app.get("/release")
+def release(lease_id: str):
+    if not pool.release(lease_id):
+        return JSONResponse({"status": "not found"})
+    return JSONResponse({"status": "released"})
+
+@app.get("/failover")
+def failover(lease_id: str, wait: float = 0, tunnel_id: str = None):
+    # tunnel_id is the tunnel the caller is leaving, a lease already moved off it is not moved again
+    try:
+        with span('failover'):
+            lease_id, tunnel = pool.failover(lease_id, wait=wait, tunnel_id=tunnel_id)
+    except Exception as e:
+        logger.error(f"failover for lease {lease_id} failed: {e}")
+        return JSONResponse({"status": "failed", "message": str(e)})
+    return JSONResponse({"status": "leased", "lease_id": lease_id, "tunnel": tunnel})
+
+@app.get("/ready")
+def ready(tunnel_id: str, timeout: float = 30):
+    # blocks until the tunnel is up or down, or timeout seconds have passed
+    try:
+        tunnel = pool.wait_until_up(tunnel_id, timeout)
+    except TunnelPoolError as e:
+        return JSONResponse({"status": "failed", "message": str(e)})
+    return JSONResponse({"status": tunnel['state'], "tunnel": tunnel})
+
+@app.get("/tunnels")
+def tunnels():
+    return JSONResponse(pool.snapshot())
+
+@app.get("/endpoints")
+def endpoints(country: str = None, rescan: bool = False):
+    if rescan:
+        registry.scan()
+    return JSONResponse(registry.report(country.lower() if country else None))
+
+@app.post("/report")
+def report(reports: list[dict]):
+    # [{'ovpn_file', 'return_code'}] for probes, [{'ovpn_file', 'bytes', 'secs'}] for recordings
+    probes = [r for r in reports if r.get('ovpn_file') and 'return_code' in r]
+    registry.record_probes(probes)
+    for r in reports:
+        if r.get('ovpn_file') and 'bytes' in r:
+            registry.record_bandwidth(r['ovpn_file'], r['bytes'], r.get('secs'))
+    return JSONResponse({"status": "recorded", "reports": len(reports)})
+
+@app.get("/metrics")
+def metrics():
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/spans")
+def spans(name: str = None, limit: int = 100):
+    return JSONResponse(REGISTRY.recent_spans(name, limit))
 
 @app.get("/status")
 def status():
-    return JSONResponse(vpn_info)
+    snapshot = pool.snapshot()
+    return JSONResponse({
+        "tunnels": len(snapshot),
+        "max_tunnels": pool.max_tunnels,
+        "leases": sum(t['leases'] for t in snapshot),
+        "countries": sorted({t['country'] for t in snapshot}),
+        "states": {state: sum(1 for t in snapshot if t['state'] == state) for state in {t['state'] for t in snapshot}},
+        "standby": {country: sum(1 for t in snapshot if t['standby'] and t['country'] == country) for country in pool.standby_counts},
+    })
+
+@app.on_event("shutdown")
+def shutdown():
+    pool.stop_all()
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,609 @@
+import ipaddress
+import os
+import random
+import re
+import selectors
+import socket
+import socketserver
+import struct
+import threading
+import time
+import uuid
+from subprocess import Popen, PIPE
+from urllib.parse import urlsplit
+from utils.metrics import REGISTRY
+
+OPENVPN_BIN = os.getenv("OPENVPN_BIN", "openvpn")
+PROXY_BASE_PORT = int(os.getenv("TUNNEL_PROXY_BASE_PORT", "8100"))
+# the proxies are open relays into the VPN, only the recorder next door should reach them
+PROXY_BIND_ADDRESS = os.getenv("TUNNEL_PROXY_BIND", "127.0.0.1")
+# used until the server pushes its own with dhcp-option DNS
+TUNNEL_DNS_SERVERS = [server.strip() for server in os.getenv("TUNNEL_DNS_SERVERS", "").split(',') if server.strip()]
+DNS_PUSH = re.compile(r'dhcp-option DNS ([0-9A-Fa-f.:]+)')
+DNS_A = 1
+DNS_AAAA = 28
+SO_BINDTODEVICE = getattr(socket, 'SO_BINDTODEVICE', 25)
+
+CONNECTING = 'connecting'
+UP = 'up'
+DEGRADED = 'degraded'
+DOWN = 'down'
+
+# first match wins, so the more specific lines come first
+LOG_EVENTS = (
+    ('Initialization Sequence Completed With Errors', DEGRADED),
+    ('Initialization Sequence Completed', UP),
+    ('AUTH_FAILED', DOWN),
+    ('Exiting due to fatal error', DOWN),
+    ('SIGTERM', DOWN),
+    ('Connection reset', DEGRADED),
+    ('Inactivity timeout', DEGRADED),
+    ('TLS Error', DEGRADED),
+    ('SIGUSR1', DEGRADED),
+    ('Restart pause', DEGRADED),
+)
+
+
+CONNECT_SECONDS = REGISTRY.histogram('vpn_tunnel_connect_seconds', 'OpenVPN start to Initialization Sequence Completed', ('country',))
+STATE_CHANGES = REGISTRY.counter('vpn_tunnel_state_changes_total', 'Tunnel state transitions by new state', ('state',))
+PROXY_CONNECTIONS = REGISTRY.counter('vpn_proxy_connections_total', 'Tunnel proxy connections by result', ('tunnel', 'result'))
+
+
+class TunnelPoolError(Exception):
+    pass
+
+
+def parse_country_counts(counts_str):
+    # "uk:1,ca:2" -> {'uk': 1, 'ca': 2}
+    counts = {}
+    for part in (counts_str or '').split(','):
+        if ':' in part:
+            country, count = part.split(':', 1)
+            counts[country.strip().lower()] = int(count)
+    return counts
+
+
+def dns_query(host, qtype, query_id):
+    header = struct.pack('>HHHHHH', query_id, 0x0100, 1, 0, 0, 0)  # recursion desired, one question
+    qname = b''.join(bytes([len(label)]) + label for label in host.encode('idna').split(b'.') if label) + b'\0'
+    return header + qname + struct.pack('>HH', qtype, 1)
+
+
+def skip_dns_name(data, offset):
+    while True:
+        length = data[offset]
+        if length == 0:
+            return offset + 1
+        if length & 0xC0 == 0xC0:
+            # compression pointer, always the end of a name
+            return offset + 2
+        offset += 1 + length
+
+
+def parse_dns_response(data, query_id):
+    # [(family, address)] from the A and AAAA records of the answer, ValueError if it is not ours
+    query, flags, questions, answers = struct.unpack('>HHHH', data[:8])
+    if query != query_id or not flags & 0x8000:
+        raise ValueError('not a response to our query')
+    if flags & 0x000F:
+        # NXDOMAIN and friends
+        return []
+    offset = 12
+    for _ in range(questions):
+        offset = skip_dns_name(data, offset) + 4
+    addresses = []
+    for _ in range(answers):
+        offset = skip_dns_name(data, offset)
+        rtype, _, _, length = struct.unpack('>HHIH', data[offset:offset + 10])
+        offset += 10
+        rdata = data[offset:offset + length]
+        offset += length
+        if rtype == DNS_A and length == 4:
+            addresses.append((socket.AF_INET, socket.inet_ntop(socket.AF_INET, rdata)))
+        elif rtype == DNS_AAAA and length == 16:
+            addresses.append((socket.AF_INET6, socket.inet_ntop(socket.AF_INET6, rdata)))
+    return addresses
+
+
+def resolve_through(host, servers, device=None, timeout=3):
+    # [(family, address)] for host from the first of servers ((address, port) pairs) that answers, asked
+    # from a socket bound to device so the lookup leaves through the tunnel like the connection will
+    error = None
+    for qtype in (DNS_A, DNS_AAAA):
+        for server, port in servers:
+            query_id = random.randrange(1 << 16)
+            family = socket.AF_INET6 if ':' in server else socket.AF_INET
+            with socket.socket(family, socket.SOCK_DGRAM) as sock:
+                try:
+                    if device:
+                        sock.setsockopt(socket.SOL_SOCKET, SO_BINDTODEVICE, device.encode())
+                    sock.settimeout(timeout)
+                    sock.sendto(dns_query(host, qtype, query_id), (server, port))
+                    while True:
+                        data, _ = sock.recvfrom(4096)
+                        try:
+                            addresses = parse_dns_response(data, query_id)
+                            break
+                        except (ValueError, struct.error, IndexError):
+                            continue
+                except OSError as e:
+                    error = e
+                    continue
+            if addresses:
+                return addresses
+            break
+    raise OSError(f"could not resolve {host} through {servers}: {error or 'no address'}")
+
+
+class ProxyHandler(socketserver.StreamRequestHandler):
+    # Minimal HTTP proxy: CONNECT for https, absolute-URI requests for plain http.
+    # Upstream sockets are bound to the tunnel's device, so whatever goes through
+    # this port leaves through that tunnel and nothing else.  Names are looked up
+    # through the tunnel too, from the DNS servers the VPN pushed, so geo-DNS
+    # CDNs answer for the tunnel's country and lookups do not leak.
+    rbufsize = 0
+
+    def handle(self):
+        request_line = self.rfile.readline(65537).decode('latin-1').strip()
+        headers = []
+        while True:
+            line = self.rfile.readline(65537)
+            if line in (b'\r\n', b'\n', b''):
+                break
+            headers.append(line.decode('latin-1').rstrip('\r\n'))
+        try:
+            method, target, version = request_line.split(' ', 2)
+        except ValueError:
+            return
+        try:
+            if method.upper() == 'CONNECT':
+                host, _, port = target.rpartition(':')
+                upstream = self.server.open_upstream(host.strip('[]'), int(port))
+                self.connection.sendall(b'HTTP/1.1 200 Connection established\r\n\r\n')
+            else:
+                url = urlsplit(target)
+                if url.scheme != 'http' or not url.hostname:
+                    self.connection.sendall(b'HTTP/1.1 400 Bad Request\r\nConnection: close\r\n\r\n')
+                    return
+                upstream = self.server.open_upstream(url.hostname, url.port or 80)
+                path = url.path or '/'
+                if url.query:
+                    path += f"?{url.query}"
+                kept = [h for h in headers if not h.lower().startswith(('proxy-', 'connection:'))]
+                head = '\r\n'.join([f"{method} {path} {version}"] + kept + ['Connection: close', '', ''])
+                upstream.sendall(head.encode('latin-1'))
+        except OSError as e:
+            self.server.tunnel.logger.info(f"{self.server.tunnel.id} proxy could not reach {target}: {e}")
+            PROXY_CONNECTIONS.inc(tunnel=self.server.tunnel.id, result='unreachable')
+            self.connection.sendall(b'HTTP/1.1 502 Bad Gateway\r\nConnection: close\r\n\r\n')
+            return
+        PROXY_CONNECTIONS.inc(tunnel=self.server.tunnel.id, result='ok')
+        with upstream:
+            self.pipe(self.connection, upstream)
+
+    def pipe(self, client, upstream, idle_timeout=120):
+        selector = selectors.DefaultSelector()
+        selector.register(client, selectors.EVENT_READ, upstream)
+        selector.register(upstream, selectors.EVENT_READ, client)
+        try:
+            while True:
+                events = selector.select(idle_timeout)
+                if not events:
+                    return
+                for key, _ in events:
+                    data = key.fileobj.recv(1 << 16)
+                    if not data:
+                        return
+                    key.data.sendall(data)
+        except OSError:
+            return
+        finally:
+            selector.close()
+
+
+class TunnelProxy(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, tunnel, bind_device=True, connect_timeout=15, bind_address=None):
+        self.tunnel = tunnel
+        self.bind_device = bind_device
+        self.connect_timeout = connect_timeout
+        super().__init__((bind_address or PROXY_BIND_ADDRESS, tunnel.proxy_port), ProxyHandler)
+
+    def resolve(self, host):
+        # [(family, address)], only through the tunnel when bound to its device
+        try:
+            address = ipaddress.ip_address(host)
+            return [(socket.AF_INET6 if address.version == 6 else socket.AF_INET, host)]
+        except ValueError:
+            pass
+        if not self.bind_device:
+            return [(family, address[0]) for family, _, _, _, address in socket.getaddrinfo(host, None, 0, socket.SOCK_STREAM)]
+        servers = self.tunnel.dns_servers or TUNNEL_DNS_SERVERS
+        if not servers:
+            raise OSError(f"no DNS server known for {self.tunnel.id}, not resolving {host} outside the tunnel")
+        return resolve_through(host, [(server, 53) for server in servers], self.tunnel.dev, self.connect_timeout / 3)
+
+    def open_upstream(self, host, port):
+        error = None
+        for family, address in self.resolve(host):
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            try:
+                if self.bind_device:
+                    sock.setsockopt(socket.SOL_SOCKET, SO_BINDTODEVICE, self.tunnel.dev.encode())
+                sock.settimeout(self.connect_timeout)
+                sock.connect((address, port))
+                sock.settimeout(None)
+                return sock
+            except OSError as e:
+                sock.close()
+                error = e
+        raise error or OSError(f"could not resolve {host}")
+
+
+class Tunnel():
+    # One OpenVPN process on its own tun device.  Pushed routes are ignored, so it
+    # never takes over the default route, and traffic reaches it only through the
+    # tunnel's own proxy port.  The OpenVPN log is parsed into a state
+    # (connecting/up/degraded/down) that callers can block on.
+    def __init__(self, logger, index, country, ovpn_file, auth_file, bind_device=True, standby=False, on_connect=None):
+        self.logger = logger
+        self.index = index
+        self.id = f"tun{index}"
+        self.dev = f"tun{index}"
+        self.country = country
+        self.ovpn_file = ovpn_file
+        self.auth_file = auth_file
+        self.bind_device = bind_device
+        self.proxy_port = PROXY_BASE_PORT + index
+        self.leases = {}  # lease id -> client name
+        self.standby = standby
+        self.started_at = None
+        self.idle_since = time.monotonic()
+        self.process = None
+        self.proxy = None
+        self.state = CONNECTING
+        self.state_since = time.monotonic()
+        self.state_changed = threading.Condition()
+        self.last_event = None
+        self.dns_servers = []  # pushed by the server
+        self.connect_secs = None
+        self.reconnects = 0
+        self.on_connect = on_connect  # on_connect(tunnel, handshake_secs or None if it never came up)
+
+    def start(self):
+        cmd = [
+            OPENVPN_BIN, "--config", self.ovpn_file, "--auth-user-pass", self.auth_file,
+            "--dev", self.dev, "--dev-type", "tun", "--route-nopull",
+        ]
+        self.state_since = time.monotonic()
+        self.process = Popen(cmd, stdout=PIPE, stderr=PIPE)
+        threading.Thread(target=self.log_pipe, args=(self.process.stdout,), daemon=True).start()
+        threading.Thread(target=self.log_pipe, args=(self.process.stderr, "error"), daemon=True).start()
+        self.proxy = TunnelProxy(self, bind_device=self.bind_device)
+        threading.Thread(target=self.proxy.serve_forever, daemon=True).start()
+        self.started_at = time.time()
+        self.logger.info(f"{self.id} started for {self.country} with {self.ovpn_file}, pid {self.process.pid}, proxy port {self.proxy_port}")
+
+    def log_pipe(self, pipe, level="info"):
+        for line in iter(pipe.readline, b''):
+            line = line.decode(errors='replace').strip()
+            self.logger.info(f"OpenVPN {self.id} {level}: {line}")
+            self.parse_line(line)
+        self.set_state(DOWN, 'openvpn exited')
+
+    def parse_line(self, line):
+        if 'PUSH_REPLY' in line:
+            self.dns_servers = DNS_PUSH.findall(line)
+        for pattern, state in LOG_EVENTS:
+            if pattern in line:
+                self.set_state(state, line)
+                return
+
+    def set_state(self, state, event=None):
+        connect_result = False
+        with self.state_changed:
+            if state == self.state:
+                return
+            now = time.monotonic()
+            if state == UP:
+                if self.connect_secs is None:
+                    self.connect_secs = now - self.state_since
+                    connect_result = self.connect_secs
+                else:
+                    self.reconnects += 1
+            elif state == DOWN and self.connect_secs is None and event != 'stopped':
+                connect_result = None
+            self.logger.info(f"{self.id} {self.state} -> {state} after {now - self.state_since:.1f}s: {event}")
+            self.state = state
+            self.state_since = now
+            self.last_event = event
+            self.state_changed.notify_all()
+        STATE_CHANGES.inc(state=state)
+        if connect_result:
+            CONNECT_SECONDS.observe(connect_result, country=self.country)
+        if connect_result is not False and self.on_connect:
+            self.on_connect(self, connect_result)
+
+    def wait_until_up(self, timeout):
+        # returns the state once the tunnel is up or down, or whatever it is at the timeout
+        with self.state_changed:
+            self.state_changed.wait_for(lambda: self.state in (UP, DOWN), timeout)
+            return self.state
+
+    def stop(self):
+        if self.proxy:
+            self.proxy.shutdown()
+            self.proxy.server_close()
+        self.set_state(DOWN, 'stopped')
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except Exception:
+                self.process.kill()
+        self.logger.info(f"{self.id} stopped ({self.country}, {self.ovpn_file})")
+
+    def is_running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def load(self):
+        return len(self.leases)
+
+    def info(self):
+        return {
+            'tunnel_id': self.id,
+            'country': self.country,
+            'ovpn_file': self.ovpn_file,
+            'pid': self.process.pid if self.process else None,
+            'running': self.is_running(),
+            'state': self.state,
+            'state_secs': round(time.monotonic() - self.state_since, 1),
+            'last_event': self.last_event,
+            'connect_secs': round(self.connect_secs, 2) if self.connect_secs is not None else None,
+            'reconnects': self.reconnects,
+            'standby': self.standby,
+            'proxy_port': self.proxy_port,
+            'dns_servers': self.dns_servers,
+            'leases': self.load(),
+            'clients': sorted(set(filter(None, self.leases.values()))),
+            'started_at': self.started_at,
+        }
+
+
+class TunnelPool():
+    # Up to max_tunnels OpenVPN tunnels, each shared by up to max_leases clients.
+    # lease() hands out the least loaded running tunnel for the country, opens a
+    # new one while there is room, and otherwise recycles the longest idle tunnel
+    # of any country.  Idle tunnels are closed after idle_timeout seconds.  A
+    # monitor thread keeps standby_counts pre-connected spare tunnels per country,
+    # so a failover or a new lease can take one that is already up, and kills
+    # tunnels that are still not up after connect_timeout seconds.  Leases on a
+    # tunnel that goes down are moved to another one of the country, a standby
+    # if there is one, and failover() from the dead tunnel then just reports
+    # where the lease went.  Endpoints are picked by the registry, which is fed
+    # every handshake.
+    def __init__(self, logger, auth_file, registry, max_tunnels=None, max_leases=None, idle_timeout=None, bind_device=None,
+                 standby_counts=None, connect_timeout=None, monitor_interval=5):
+        self.logger = logger
+        self.auth_file = auth_file
+        self.registry = registry
+        self.max_tunnels = max_tunnels or int(os.getenv("VPN_MAX_TUNNELS", "4"))
+        self.max_leases = max_leases or int(os.getenv("TUNNEL_MAX_LEASES", "8"))
+        self.idle_timeout = idle_timeout if idle_timeout is not None else int(os.getenv("TUNNEL_IDLE_TIMEOUT", "300"))
+        if bind_device is None:
+            bind_device = os.getenv("TUNNEL_BIND_DEVICE", "true").lower() == "true"
+        self.bind_device = bind_device
+        self.standby_counts = standby_counts if standby_counts is not None else parse_country_counts(os.getenv("VPN_STANDBY"))
+        self.connect_timeout = connect_timeout or int(os.getenv("TUNNEL_CONNECT_TIMEOUT", "60"))
+        self.monitor_interval = monitor_interval
+        self.tunnels = {}  # tunnel id -> Tunnel
+        self.leases = {}  # lease id -> tunnel id
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        REGISTRY.gauge('vpn_tunnels', 'Tunnels by country and state', ('country', 'state'), callback=self.count_by_state)
+        REGISTRY.gauge('vpn_tunnel_leases', 'Leases held on each tunnel', ('tunnel', 'country'),
+                       callback=lambda: {(t.id, t.country): t.load() for t in list(self.tunnels.values())})
+        REGISTRY.gauge('vpn_tunnel_state_seconds', 'Time each tunnel has been in its current state', ('tunnel', 'state'),
+                       callback=lambda: {(t.id, t.state): round(time.monotonic() - t.state_since, 1) for t in list(self.tunnels.values())})
+
+    def start(self):
+        threading.Thread(target=self.monitor_loop, daemon=True).start()
+
+    def lease(self, country, client=None, ovpn_file=None, exclude=None, wait=0):
+        # returns (lease_id, tunnel info), raises TunnelPoolError if no tunnel can be had.
+        # With wait, blocks up to that many seconds for the tunnel to come up.
+        country = country.lower()
+        with self.lock:
+            tunnel = self.acquire(country, ovpn_file, exclude)
+            lease_id = uuid.uuid4().hex
+            tunnel.leases[lease_id] = client
+            self.leases[lease_id] = tunnel.id
+            self.logger.info(f"lease {lease_id} on {tunnel.id} for {client or 'anonymous'}, load {tunnel.load()}")
+        if wait:
+            tunnel.wait_until_up(wait)
+        return lease_id, tunnel.info()
+
+    def failover(self, lease_id, wait=0, tunnel_id=None):
+        # moves a lease to another endpoint of the same country, standby first.  With
+        # tunnel_id, the tunnel the holder is failing over from, a lease the monitor
+        # already moved off it stays where it is.
+        with self.lock:
+            old = self.tunnels.get(self.leases.get(lease_id))
+            if not old:
+                raise TunnelPoolError(f"unknown lease {lease_id}")
+            if tunnel_id and old.id != tunnel_id:
+                tunnel = old
+                self.logger.info(f"lease {lease_id} already moved from {tunnel_id} to {tunnel.id}")
+            else:
+                tunnel = self.move_lease(lease_id, old)
+        if wait:
+            tunnel.wait_until_up(wait)
+        return lease_id, tunnel.info()
+
+    def move_lease(self, lease_id, old):
+        tunnel = self.acquire(old.country, exclude=old.ovpn_file)
+        tunnel.leases[lease_id] = old.leases.pop(lease_id, None)
+        self.leases[lease_id] = tunnel.id
+        if not old.leases:
+            old.idle_since = time.monotonic()
+        self.logger.info(f"lease {lease_id} failed over from {old.id} ({old.state}) to {tunnel.id} ({tunnel.state})")
+        return tunnel
+
+    def wait_until_up(self, tunnel_id, timeout):
+        with self.lock:
+            tunnel = self.tunnels.get(tunnel_id)
+        if not tunnel:
+            raise TunnelPoolError(f"unknown tunnel {tunnel_id}")
+        tunnel.wait_until_up(timeout)
+        return tunnel.info()
+
+    def release(self, lease_id):
+        with self.lock:
+            tunnel_id = self.leases.pop(lease_id, None)
+            tunnel = self.tunnels.get(tunnel_id)
+            if not tunnel:
+                return False
+            tunnel.leases.pop(lease_id, None)
+            if not tunnel.leases:
+                tunnel.idle_since = time.monotonic()
+            self.logger.info(f"lease {lease_id} released from {tunnel.id}, load {tunnel.load()}")
+            return True
+
+    def acquire(self, country, ovpn_file=None, exclude=None):
+        tunnel = self.pick(country, ovpn_file, exclude)
+        if tunnel is None:
+            tunnel = self.open_tunnel(country, ovpn_file, exclude)
+        if tunnel.standby:
+            # promoted, the monitor starts a new spare
+            tunnel.standby = False
+        return tunnel
+
+    def pick(self, country, ovpn_file=None, exclude=None):
+        # tunnels that are up beat ones still connecting, and working tunnels are
+        # filled before a standby is taken
+        candidates = [
+            t for t in self.tunnels.values()
+            if t.country == country and t.is_running() and t.state != DOWN and t.load() < self.max_leases
+            and t.ovpn_file != exclude and (not ovpn_file or t.ovpn_file == ovpn_file)
+        ]
+        return min(candidates, key=lambda t: (t.state != UP, t.standby, t.load())) if candidates else None
+
+    def free_index(self):
+        used = {t.index for t in self.tunnels.values()}
+        if len(used) < self.max_tunnels:
+            return min(set(range(self.max_tunnels)) - used)
+        idle = [t for t in self.tunnels.values() if not t.leases]
+        if not idle:
+            return None
+        oldest = min(idle, key=lambda t: t.idle_since)
+        self.close_tunnel(oldest)
+        return oldest.index
+
+    def open_tunnel(self, country, ovpn_file=None, exclude=None, standby=False):
+        files = self.registry.files(country)
+        if not files:
+            raise TunnelPoolError(f"no ovpn endpoints found for country {country}")
+        if ovpn_file and ovpn_file not in files:
+            self.logger.info(f"requested endpoint {ovpn_file} not found for country {country}, picking one")
+            ovpn_file = None
+        if not ovpn_file:
+            in_use = {t.ovpn_file for t in self.tunnels.values()}
+            ovpn_file = self.registry.choose(country, exclude=exclude, avoid=in_use)
+        index = self.free_index()
+        if index is None:
+            raise TunnelPoolError(f"all {self.max_tunnels} tunnels are busy")
+        tunnel = Tunnel(self.logger, index, country, ovpn_file, self.auth_file, bind_device=self.bind_device, standby=standby,
+                        on_connect=self.record_connect)
+        try:
+            tunnel.start()
+        except Exception:
+            tunnel.stop()
+            raise
+        self.tunnels[tunnel.id] = tunnel
+        return tunnel
+
+    def record_connect(self, tunnel, handshake_secs):
+        try:
+            self.registry.record_connect(tunnel.ovpn_file, handshake_secs)
+        except Exception as e:
+            self.logger.error(f"could not record handshake for {tunnel.ovpn_file}: {e}")
+
+    def detach_tunnel(self, tunnel):
+        # out of the pool, the caller stops it once it has let go of the lock
+        for lease_id in tunnel.leases:
+            self.leases.pop(lease_id, None)
+        self.tunnels.pop(tunnel.id, None)
+        return tunnel
+
+    def close_tunnel(self, tunnel):
+        # only where the tunnel's index is reused right away, stopping can take a while
+        self.detach_tunnel(tunnel).stop()
+
+    def migrate_leases(self, tunnel):
+        # moves the leases off a dead tunnel, any that cannot be moved yet are tried again next check
+        for lease_id in list(tunnel.leases):
+            try:
+                self.move_lease(lease_id, tunnel)
+            except Exception as e:
+                self.logger.error(f"could not move lease {lease_id} off {tunnel.id}: {e}")
+                return
+
+    def check_tunnels(self):
+        now = time.monotonic()
+        closing = []
+        with self.lock:
+            for tunnel in list(self.tunnels.values()):
+                if tunnel.state == CONNECTING and now - tunnel.state_since >= self.connect_timeout:
+                    self.logger.info(f"{tunnel.id} not up after {self.connect_timeout}s, giving up on {tunnel.ovpn_file}")
+                    tunnel.set_state(DOWN, 'connect timeout')
+                dead = not tunnel.is_running() or tunnel.state == DOWN
+                if dead and tunnel.leases:
+                    self.migrate_leases(tunnel)
+                if tunnel.leases:
+                    continue
+                idle = not tunnel.standby and now - tunnel.idle_since >= self.idle_timeout
+                if dead or idle:
+                    closing.append(self.detach_tunnel(tunnel))
+            self.replenish_standby()
+        for tunnel in closing:
+            tunnel.stop()
+
+    def replenish_standby(self):
+        for country, wanted in self.standby_counts.items():
+            spares = sum(1 for t in self.tunnels.values() if t.country == country and t.standby and t.state != DOWN)
+            for _ in range(wanted - spares):
+                if len(self.tunnels) >= self.max_tunnels:
+                    return
+                try:
+                    self.open_tunnel(country, standby=True)
+                except Exception as e:
+                    self.logger.error(f"could not start a standby tunnel for {country}: {e}")
+                    break
+
+    def monitor_loop(self):
+        while not self.stopping.is_set():
+            try:
+                self.check_tunnels()
+            except Exception as e:
+                self.logger.error(f"tunnel monitor error: {e}")
+            self.stopping.wait(self.monitor_interval)
+
+    def stop_all(self):
+        self.stopping.set()
+        with self.lock:
+            closing = [self.detach_tunnel(tunnel) for tunnel in list(self.tunnels.values())]
+        for tunnel in closing:
+            tunnel.stop()
+
+    def count_by_state(self):
+        counts = {}
+        for tunnel in list(self.tunnels.values()):
+            key = (tunnel.country, tunnel.state)
+            counts[key] = counts.get(key, 0) + 1
+        return counts
+
+    def snapshot(self):
+        with self.lock:
+            return [t.info() for t in sorted(self.tunnels.values(), key=lambda t: t.index)]